@@ -6,20 +6,10 @@ from os.path import join
 import numpy as np
 import matplotlib.pyplot as plt
 
-# ---
-
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
-
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
+from utils.keithley_6517 import setup_6517_data_format, fetch_6517
+from utils.waveforms import append_reverse
 
-    appended_arr = np.concatenate((arr, reversed_arr))
-
-    return appended_arr
+# ---
 
 def if_not_create(filepath):
     if not os.path.exists(filepath):
@@ -42,6 +32,7 @@ Imax = 1e-6
 NPLC = 1  # (default = 1) Set integration rate in line cycles (0.01 to 10)
 elements_sense = 'READ,TST,VSO'  # Current, Timestamp, Voltage Source
 idxC, idxT, idxV = 0, 1, 2
+data_format = 'ASCii'  # ASCii, SREal, DREal: binary formats skip float formatting/parsing and send fewer bytes
 num_elements = len(elements_sense.split(','))
 
 assm = 'ASSM8'
@@ -80,7 +71,7 @@ k3.write(':DISP:ENAB ON')   # Enable or disable the front-panel display
 k3.write(':SYST:TSC OFF')    # Enable or disable external temperature readings (default: ON)
 k3.write(':SYST:TST:TYPE REL')  # Configure timestamp type: RELative or RTClock
 k3.write(':TRAC:FEED:CONT NEV')  # disable buffer control
-k3.write(':FORM:DATA ASCii')  # Select data format: ASCii, REAL, SREal, DREal
+setup_6517_data_format(k3, data_format)  # Select data format: ASCii, REAL, SREal, DREal
 k3.write(':FORM:ELEM READ,TST,VSO')  # data elements: VSOurce, READing, CHANnel, RNUMber, UNITs, TSTamp, STATus, ETEM, HUM
 
 # --- Define Trigger Model
@@ -129,7 +120,7 @@ k3.write(':INIT')           # Move from IDLE state to ARM Layer 1
 data = []
 for Vapp in Vs:
     k3.write(':SOUR:VOLT ' + str(Vapp))  # Set voltage level
-    data.append(k3.query_ascii_values(':FETCh?'))
+    data.append(fetch_6517(k3, data_format))
 
 k3.write(':SOUR:VOLT 0')    # Set voltage level to 0
 """time.sleep(0.05)
@@ -7,23 +7,16 @@ import numpy as np
 from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
 
+from utils.broker import open_instrument, BrokerInstrument
+from utils.keithley_6517 import setup_6517_data_format, fetch_6517, query_6517_values, run_6517_buffered_sweep
+from utils.timing import summarize_sampling, print_sampling_summary
+from utils.waveforms import append_reverse
+
 # ---
 
 def fit_line(x, a, b):
     return a * x + b
 
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
-
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
-
-    appended_arr = np.concatenate((arr, reversed_arr))
-
-    return appended_arr
 
 def if_not_create(filepath):
     if not os.path.exists(filepath):
@@ -47,7 +40,12 @@ Imax = 1e-6  # NOTE: if CURRent RANGe is too high, then you will measure a relat
 NPLC = 10  # (default = 1) Set integration rate in line cycles (0.01 to 10)
 elements_sense = 'READ,TST,VSO'  # Current, Timestamp, Voltage Source
 idxC, idxT, idxV = 0, 1, 2
+data_format = 'ASCii'  # ASCii, SREal, DREal: binary formats skip float formatting/parsing and send fewer bytes
 num_elements = len(elements_sense.split(','))
+# LOOP: :SOUR:VOLT + :FETCh? per point; TIMER, TSEQ: readings are stored in the buffer and read once at the end
+sweep_engine = 'LOOP'
+step_time = 0.5  # (s) dwell time at each voltage (TIMER, TSEQ)
+sampling_interval = None  # (s) (TIMER only) time between readings (default: one reading per step)
 
 assm = 'w18'
 path_results = r'C:\Users\Pennathur Lab\sean\Zipper\RepeatabilityTesting\test_keithley'
@@ -73,7 +71,18 @@ print("Min. total sampling time ({} samples): {} s".format(num_points, np.round(
 
 # open instrument
 rm = pyvisa.ResourceManager()
-k3 = rm.open_resource('GPIB{}::{}::INSTR'.format(BoardIndex, GPIB))
+# NOTE: if the instrument broker is running (python -m utils.broker), the session is kept open between runs
+use_broker = True
+k3 = open_instrument(rm, 'GPIB{}::{}::INSTR'.format(BoardIndex, GPIB), use_broker=use_broker)
+# If the broker shadows settings (--shadow or --skip-reset), only settings that changed since the last run are sent,
+# and with --skip-reset, *RST is skipped too.
+# NOTE: *RST is only skipped if every setting of the last run is verified against the instrument.
+reuse_instrument_state = True
+if isinstance(k3, BrokerInstrument):
+    if reuse_instrument_state:
+        print("Settings changed since the last run (if any, *RST is sent): {}".format(k3.verify()))
+    else:
+        k3.invalidate()
 
 # RESET to defaults
 k3.write('*RST')
@@ -89,7 +98,7 @@ k3.write(':DISP:ENAB ON')   # Enable or disable the front-panel display
 k3.write(':SYST:TSC OFF')    # Enable or disable external temperature readings (default: ON)
 k3.write(':SYST:TST:TYPE REL')  # Configure timestamp type: RELative or RTClock
 k3.write(':TRAC:FEED:CONT NEV')  # disable buffer control
-k3.write(':FORM:DATA ASCii')  # Select data format: ASCii, REAL, SREal, DREal
+setup_6517_data_format(k3, data_format)  # Select data format: ASCii, REAL, SREal, DREal
 k3.write(':FORM:ELEM READ,TST,VSO')  # data elements: VSOurce, READing, CHANnel, RNUMber, UNITs, TSTamp, STATus, ETEM, HUM
 
 # --- Define Trigger Model
@@ -140,18 +149,21 @@ k3.write('OUTP ON')         # Turn source ON
 # k3.write(':SYST:ZCOR ON')   # Enable (ON) or disable (OFF) zero correct (default: OFF)
 
 k3.write(':SYST:TST:REL:RES')   # Reset relative timestamp to zero seconds
-k3.write(':INIT')           # Move from IDLE state to ARM Layer 1
-
-data = []
-for Vapp in Vs:
-    k3.write(':SOUR:VOLT ' + str(Vapp))  # Set voltage level
-    meas = k3.query_ascii_values(':FETCh?')
-    print(meas)
-    data.append(meas)
-    #meas2 = k3.query_ascii_values(':SENS:DATA:FRESh?')
-    #print(meas2)
-    meas3 = k3.query_ascii_values(':SENS:DATA:FRESh?')
-    print(meas3)
+
+if sweep_engine == 'LOOP':
+    k3.write(':INIT')           # Move from IDLE state to ARM Layer 1
+    data = []
+    for Vapp in Vs:
+        k3.write(':SOUR:VOLT ' + str(Vapp))  # Set voltage level
+        meas = fetch_6517(k3, data_format)
+        print(meas)
+        data.append(meas)
+        #meas2 = k3.query_ascii_values(':SENS:DATA:FRESh?')
+        #print(meas2)
+        meas3 = query_6517_values(k3, ':SENS:DATA:FRESh?', data_format)
+        print(meas3)
+else:
+    data = run_6517_buffered_sweep(k3, Vs, step_time, sampling_interval=sampling_interval, mode=sweep_engine)
 
 k3.write(':SOUR:VOLT 0')    # Set voltage level to 0
 k3.write(':OUTP OFF')       # turn output off
@@ -163,11 +175,12 @@ k3.close()                  # close instrument
 # POST-PROCESSING
 
 # reshape array
-data_struct = np.reshape(data, (num_points, num_elements))
+data_struct = np.reshape(data, (-1, num_elements))
 num_samples = len(data_struct[:, 1])
 t_total = data_struct[-1, 1] - data_struct[0, 1]
 sampling_rate = t_total / num_samples
 sampling_freq = 1 / sampling_rate
+print_sampling_summary(summarize_sampling(data_struct[:, idxT]), label='Actual ({})'.format(sweep_engine))
 
 """print("--- Actual:")
 print("Sampling rate: {} ms".format(np.round(sampling_rate * 1e3, 2)))
@@ -7,23 +7,16 @@ import numpy as np
 from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
 
+from utils.keithley_6517 import run_6517_buffered_sweep
+from utils.scpi import ShadowStateInstrument, default_state_file
+from utils.timing import summarize_sampling, print_sampling_summary
+from utils.waveforms import append_reverse
+
 # ---
 
 def fit_line(x, a, b):
     return a * x + b
 
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
-
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
-
-    appended_arr = np.concatenate((arr, reversed_arr))
-
-    return appended_arr
 
 def if_not_create(filepath):
     if not os.path.exists(filepath):
@@ -49,6 +42,10 @@ NPLC = 0.1  # (default = 1) Set integration rate in line cycles (0.01 to 10)
 elements_sense = 'READ,TST,VSO'  # Current, Timestamp, Voltage Source
 idxC, idxT, idxV = 0, 1, 2
 num_elements = len(elements_sense.split(','))
+# LOOP: :SOUR:VOLT + :FETCh? per point; TIMER, TSEQ: readings are stored in the buffer and read once at the end
+sweep_engine = 'LOOP'
+step_time = 0.5  # (s) dwell time at each voltage (TIMER, TSEQ)
+sampling_interval = None  # (s) (TIMER only) time between readings (default: one reading per step)
 
 assm = 'w18'
 path_results = r'C:\Users\nanolab\Desktop\sean\PASSM5\Keithley6517b_Etest'
@@ -74,6 +71,14 @@ print("Min. total sampling time ({} samples): {} s".format(num_points, np.round(
 # open instrument
 rm = pyvisa.ResourceManager()
 k3 = rm.open_resource('GPIB{}::{}::INSTR'.format(BoardIndex, GPIB))
+# Only send settings that changed since the last run (e.g., :SOUR:VOLT:RANG, :TRIG:COUN) and skip *RST.
+# NOTE: *RST is only skipped if every setting of the last run is verified against the instrument.
+reuse_instrument_state = False
+k3 = ShadowStateInstrument(k3, state_file=default_state_file, skip_reset=reuse_instrument_state)
+if reuse_instrument_state:
+    print("Settings changed since the last run (if any, *RST is sent): {}".format(k3.verify()))
+else:
+    k3.invalidate()
 
 # RESET to defaults
 k3.write('*RST')
@@ -135,13 +140,18 @@ k3.write(':SENS:CURR:DIG 6')                # Specify measurement resolution: 4
 # Execute configured measurement
 k3.write('OUTP ON')         # Turn source ON
 k3.write(':SYST:TST:REL:RES')   # Reset relative timestamp to zero seconds
-k3.write(':INIT')           # Move from IDLE state to ARM Layer 1
 
-data = []
-for cycle_i in range(num_cycles):
-    for Vapp in Vs:
-        k3.write(':SOUR:VOLT ' + str(Vapp))  # Set voltage level
-        data.append(k3.query_ascii_values(':FETCh?'))
+if sweep_engine == 'LOOP':
+    k3.write(':INIT')           # Move from IDLE state to ARM Layer 1
+    data = []
+    for cycle_i in range(num_cycles):
+        for Vapp in Vs:
+            k3.write(':SOUR:VOLT ' + str(Vapp))  # Set voltage level
+            data.append(k3.query_ascii_values(':FETCh?'))
+else:
+    k3.write(':ARM:LAYer2:COUN 1')  # all cycles are stored in one buffer
+    data = run_6517_buffered_sweep(k3, np.tile(Vs, num_cycles), step_time,
+                                   sampling_interval=sampling_interval, mode=sweep_engine)
 
 k3.write(':SOUR:VOLT 0')    # Set voltage level to 0
 k3.write(':OUTP OFF')       # turn output off
@@ -153,7 +163,7 @@ k3.close()                  # close instrument
 # POST-PROCESSING
 
 # reshape array
-data_struct = np.reshape(data, (num_points * num_cycles, num_elements))
+data_struct = np.reshape(data, (-1, num_elements))
 num_samples = len(data_struct[:, 1])
 t_total = data_struct[-1, 1] - data_struct[0, 1]
 sampling_rate = t_total / num_samples
@@ -163,6 +173,7 @@ print("--- Actual:")
 print("Sampling rate: {} ms".format(np.round(sampling_rate * 1e3, 2)))
 print("Sampling frequency: {} Hz".format(np.round(sampling_freq, 1)))
 print("Min. total sampling time ({} samples): {} s".format(num_samples, np.round(t_total, 3)))
+print_sampling_summary(summarize_sampling(data_struct[:, idxT]), label='Actual ({})'.format(sweep_engine))
 
 # ---
 
@@ -177,10 +188,17 @@ I = data_struct[:, idxC] * 1e9  # convert to nano Amps
 fig, (ax1, ax2) = plt.subplots(nrows=2, gridspec_kw={'height_ratios': [1, 2]})
 
 # split data between cycles
+if sweep_engine == 'LOOP':
+    cycle_index = np.arange(num_samples) // num_points
+else:
+    # buffered sweeps take one reading per sampling_interval (not per step): split by the duration of each cycle
+    cycle_index = np.minimum(np.floor(t / (num_points * step_time)).astype(int), num_cycles - 1)
 for i in range(num_cycles):
-    tc = t[i * num_points:(i + 1) * num_points]
-    Vc = V[i * num_points:(i + 1) * num_points]
-    Ic = I[i * num_points:(i + 1) * num_points]
+    tc = t[cycle_index == i]
+    Vc = V[cycle_index == i]
+    Ic = I[cycle_index == i]
+    if len(Ic) == 0:
+        continue
 
     if Vmax > 0:
         Imax = np.max(Ic)
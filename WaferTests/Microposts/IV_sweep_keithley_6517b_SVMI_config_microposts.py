@@ -7,23 +7,16 @@ import numpy as np
 from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
 
+from utils.keithley_6517 import run_6517_buffered_sweep
+from utils.scpi import ShadowStateInstrument, default_state_file
+from utils.timing import summarize_sampling, print_sampling_summary
+from utils.waveforms import append_reverse
+
 # ---
 
 def fit_line(x, a, b):
     return a * x + b
 
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
-
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
-
-    appended_arr = np.concatenate((arr, reversed_arr))
-
-    return appended_arr
 
 def if_not_create(filepath):
     if not os.path.exists(filepath):
@@ -48,6 +41,10 @@ NPLC = 2  # (default = 1) Set integration rate in line cycles (0.01 to 10)
 elements_sense = 'READ,TST,VSO'  # Current, Timestamp, Voltage Source
 idxC, idxT, idxV = 0, 1, 2
 num_elements = len(elements_sense.split(','))
+# LOOP: :SOUR:VOLT + :FETCh? per point; TIMER, TSEQ: readings are stored in the buffer and read once at the end
+sweep_engine = 'LOOP'
+step_time = 0.5  # (s) dwell time at each voltage (TIMER, TSEQ)
+sampling_interval = None  # (s) (TIMER only) time between readings (default: one reading per step)
 
 # dx = 100, 300, 500
 # dia = {100: bottom=10, middle=15, top=25}
@@ -90,6 +87,14 @@ print("Min. total sampling time ({} samples): {} s".format(num_points, np.round(
 # open instrument
 rm = pyvisa.ResourceManager()
 k3 = rm.open_resource('GPIB{}::{}::INSTR'.format(BoardIndex, GPIB))
+# Only send settings that changed since the last run (e.g., :SOUR:VOLT:RANG, :TRIG:COUN) and skip *RST.
+# NOTE: *RST is only skipped if every setting of the last run is verified against the instrument.
+reuse_instrument_state = False
+k3 = ShadowStateInstrument(k3, state_file=default_state_file, skip_reset=reuse_instrument_state)
+if reuse_instrument_state:
+    print("Settings changed since the last run (if any, *RST is sent): {}".format(k3.verify()))
+else:
+    k3.invalidate()
 
 # RESET to defaults
 k3.write('*RST')
@@ -151,12 +156,15 @@ k3.write(':SENS:CURR:DIG 6')                # Specify measurement resolution: 4
 # Execute configured measurement
 k3.write('OUTP ON')         # Turn source ON
 k3.write(':SYST:TST:REL:RES')   # Reset relative timestamp to zero seconds
-k3.write(':INIT')           # Move from IDLE state to ARM Layer 1
 
-data = []
-for Vapp in Vs:
-    k3.write(':SOUR:VOLT ' + str(Vapp))  # Set voltage level
-    data.append(k3.query_ascii_values(':FETCh?'))
+if sweep_engine == 'LOOP':
+    k3.write(':INIT')           # Move from IDLE state to ARM Layer 1
+    data = []
+    for Vapp in Vs:
+        k3.write(':SOUR:VOLT ' + str(Vapp))  # Set voltage level
+        data.append(k3.query_ascii_values(':FETCh?'))
+else:
+    data = run_6517_buffered_sweep(k3, Vs, step_time, sampling_interval=sampling_interval, mode=sweep_engine)
 
 k3.write(':SOUR:VOLT 0')    # Set voltage level to 0
 k3.write(':OUTP OFF')       # turn output off
@@ -168,7 +176,7 @@ k3.close()                  # close instrument
 # POST-PROCESSING
 
 # reshape array
-data_struct = np.reshape(data, (num_points, num_elements))
+data_struct = np.reshape(data, (-1, num_elements))
 num_samples = len(data_struct[:, 1])
 t_total = data_struct[-1, 1] - data_struct[0, 1]
 sampling_rate = t_total / num_samples
@@ -178,6 +186,7 @@ print("--- Actual:")
 print("Sampling rate: {} ms".format(np.round(sampling_rate * 1e3, 2)))
 print("Sampling frequency: {} Hz".format(np.round(sampling_freq, 1)))
 print("Min. total sampling time ({} samples): {} s".format(num_samples, np.round(t_total, 3)))
+print_sampling_summary(summarize_sampling(data_struct[:, idxT]), label='Actual ({})'.format(sweep_engine))
 
 # ---
 
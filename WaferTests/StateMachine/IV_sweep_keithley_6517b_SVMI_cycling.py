@@ -7,23 +7,13 @@ import numpy as np
 from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
 
+from utils.timing import RunDurationModel
+
 # ---
 
 def fit_line(x, a, b):
     return a * x + b
 
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
-
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
-
-    appended_arr = np.concatenate((arr, reversed_arr))
-
-    return appended_arr
 
 def if_not_create(filepath):
     if not os.path.exists(filepath):
@@ -74,7 +64,9 @@ if save_:
 num_points = len(Vs) * max_num_cycles
 sampling_period = NPLC / 60
 
-estimated_timeout = num_points * (sampling_period * 4) * 1000 + 200  # (ms)
+# timeout is predicted from previous runs (falls back to a multiple of the theoretical duration)
+run_model = RunDurationModel()
+estimated_timeout = run_model.timeout('6517a', num_points, nplc=NPLC, display='ON', mode='FETCH_LOOP') * 1000  # (ms)
 
 
 print("Theoretical:")
@@ -152,6 +144,7 @@ k3.write(':SENS:CURR:DIG 6')                # Specify measurement resolution: 4
 k3.write('OUTP ON')         # Turn source ON
 k3.write(':SYST:TST:REL:RES')   # Reset relative timestamp to zero seconds
 k3.write(':INIT')           # Move from IDLE state to ARM Layer 1
+time_start = time.perf_counter()
 
 
 current_threshold = 20e-3
@@ -173,6 +166,9 @@ for j in range(max_num_cycles):
         """
 
 k3.write(':SOUR:VOLT 0')    # Set voltage level to 0
+if data:
+    # only runs that fetched their readings are recorded (otherwise, the duration is only the :SOUR:VOLT writes)
+    run_model.record('6517a', len(data), time.perf_counter() - time_start, nplc=NPLC, display='ON', mode='FETCH_LOOP')
 k3.write(':OUTP OFF')       # turn output off
 k3.close()                  # close instrument
 
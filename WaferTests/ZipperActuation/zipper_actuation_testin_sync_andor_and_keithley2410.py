@@ -1,25 +1,19 @@
 import os
 from os.path import join
+import time
 
 import pandas as pd
 import pyvisa
 import numpy as np
 import matplotlib.pyplot as plt
 
-# --- FUNCTION FOR CONVERTING NUMPY ARRAY TO STRING LIST FOR KEITHLEY
-
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
-
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
-
-    appended_arr = np.concatenate((arr, reversed_arr))
+from utils.instrument_group import InstrumentGroup
+from utils.keithley_2410 import upload_list_sweep, run_list_sweep
+from utils.scpi import BatchWriter, dict_max_message_length
+from utils.timing import RunDurationModel
+from utils.waveforms import append_reverse, staircase_trace
 
-    return appended_arr
+# --- FUNCTION FOR CONVERTING NUMPY ARRAY TO STRING LIST FOR KEITHLEY
 
 def numpy_array_to_string(arr, sig_figs=4):
     # Convert the NumPy array elements to strings
@@ -118,12 +112,7 @@ def post_process_data(data_struct, idxVCTRS, source_measure_delay, NPLC, path_re
     arr_V = data_struct[:, idxV]
     arr_I = data_struct[:, idxC]
     # add time points to show V(t) in between current sampling times
-    arr_Tt = arr_T - source_measure_delay - integration_period
-    # concat
-    arr_T2 = np.concatenate((arr_Tt, arr_T))
-    arr_V2 = np.concatenate((arr_V, arr_V))
-    # sort by time
-    arr_T2, arr_V2 = list(zip(*sorted(zip(arr_T2, arr_V2))))
+    arr_T2, arr_V2 = staircase_trace(arr_T, arr_V, edge_time=source_measure_delay + integration_period, edge='applied')
     # --- plotting
     # setup
     if len(arr_T) > 25:
@@ -176,7 +165,7 @@ if __name__ == "__main__":
         raise ValueError("Check instruments are connected.")
 
     k1_source_GPIB, k1_source_board_index = 25, 1  # Keithley: source measure unit
-    k2_trigger_GPIB, k2_trigger_board_index, k2_inst = 24, 0, '6517a'  # '6517a' or None: trigger Keithley
+    k2_trigger_GPIB, k2_trigger_board_index, k2_inst = 24, 0, '6517a'  # '2410', '6517a' or None: trigger Keithley model
     # MCONNECT hardware configuration for 6517 trigger keithley
 
     # --- INPUTS
@@ -248,12 +237,15 @@ if __name__ == "__main__":
     current_range = 10e-6  # 20E-3
     current_compliance = 100e-6  # 20E-3
     # VOLTAGE
-    values_lst = numpy_array_to_string(values_up_and_down)
+    # NOTE: lists longer than the instrument's list are uploaded in pieces and run as consecutive sweeps
     num_points = len(values_up_and_down)
-    if num_points > 120:
-        raise ValueError("Number of points is too large. Will cause Keithley error.")
     # FREQUENCY
-    estimated_timeout = num_points * source_measure_delay * 1000 * 2 + 200  # (ms)
+    # timeout is predicted from previous runs (falls back to a multiple of the theoretical duration)
+    run_model = RunDurationModel()
+    estimated_timeout = run_model.timeout('2410', num_points, nplc=NPLC, source_delay=source_measure_delay,
+                                          mode='LIST_SWEEP') * 1000  # (ms)
+    print("Predicted duration: {} s".format(np.round(
+        run_model.predict('2410', num_points, nplc=NPLC, source_delay=source_measure_delay, mode='LIST_SWEEP'), 2)))
     # DATA TYPES
     elements_sense = 'VOLTage, CURRent, TIME'  #, RESistance, STATus
     idxVCTRS = 0, 1, 2, 3, 4
@@ -289,21 +281,26 @@ if __name__ == "__main__":
     k1.write(':SENS:CURR:NPLC %g' % NPLC)  # Specify integration rate (in line cycles): [0.01 to 10E3] (default = 1)
 
     k1.write(':SOUR:VOLT:MODE LIST')  # List volts sweep mode.
-    k1.write(':SOUR:LIST:VOLT ' + values_lst)  # List sweep points.
-    k1.write(':TRIG:COUN ' + str(num_points))  # Trigger count = # sweep points.
     k1.write(':SOUR:DEL %g' % source_measure_delay)  # 50ms source delay.
+    # the (first) list and trigger count are uploaded before the trigger Keithley is armed, so the sweep starts with a
+    # single :INIT after the camera is triggered (longer lists are uploaded between sweeps by run_list_sweep())
+    upload_list_sweep(k1, values_up_and_down)
 
     # - set up trigger keithley
+    # NOTE: the run is timed from the start of the list sweep (after the trigger Keithley is set up)
     if k2_inst is None:
         # --- Execute source-measure action
         k1.write(':OUTP ON')  # Turn on voltage source output
-        k1.write(':INIT')  # Trigger voltage readings.
-        data_stimulus = k1.query_ascii_values(':FETCh?', container=np.array)  # request data.
+        time_start = time.perf_counter()
+        data_stimulus = run_list_sweep(k1, values_up_and_down, num_elements, idxT=idxVCTRS[2],
+                                       uploaded=True)  # Trigger and request data.
         data_elements = k1.query(':FORMat:ELEMents:SENSe?')
         k1.write(':OUTP OFF')
     elif k2_inst == '2410':
-        setup_2410_trigger(keithley_inst=k2, voltage_levels=trigger_voltage,
-                           delay=trigger_source_measure_delay, nplc=trigger_NPLC)
+        # k2 is the Keithley 2410 (k2_inst): its setup is batched into messages of up to 1024 characters
+        with BatchWriter(k2, max_length=dict_max_message_length[k2_inst]) as k2_batch:
+            setup_2410_trigger(keithley_inst=k2_batch, voltage_levels=trigger_voltage,
+                               delay=trigger_source_measure_delay, nplc=trigger_NPLC)
         """
         k2.write('*RST')  # Restore GPIB default
         k2.write(':FORMat:ELEMents:SENSe ' + elements_sense)
@@ -323,26 +320,34 @@ if __name__ == "__main__":
 
         # --- Execute source-measure action
 
+        # k1 and k2 are on different GPIB boards, so their requests are sent concurrently (one thread per instrument)
+        group = InstrumentGroup({'k1': k1, 'k2': k2})
+
         # Initialize both Keithleys (but don't set a voltage level)
-        k2.write(':OUTP ON')  # Turn on camera trigger output.
-        k1.write(':OUTP ON')  # Turn on voltage source output.
+        group.write({'k2': ':OUTP ON', 'k1': ':OUTP ON'})  # Turn on camera trigger and voltage source outputs.
 
         # Trigger a very fast reading from trigger Keithley, then trigger source Keithley
-        k2.write(':INIT')  # Trigger camera readings.
-        k1.write(':INIT')  # Trigger voltage readings.
-
-        data_stimulus = k1.query_ascii_values(':FETCh?', container=np.array)  # request data.
-        data_delay = k2.query_ascii_values(':FETCh?', container=np.array)  # request data.
+        group.write({'k2': ':INIT'})  # Trigger camera readings.
+        time_start = time.perf_counter()
+        data = group.run({
+            'k1': lambda inst: run_list_sweep(inst, values_up_and_down, num_elements, idxT=idxVCTRS[2],
+                                              uploaded=True),  # :INIT only
+            'k2': lambda inst: inst.query_ascii_values(':FETCh?', container=np.array),
+        })  # Trigger voltage readings and request data from both instruments.
+        data_stimulus, data_delay = data['k1'], data['k2']
         data_elements = k1.query(':FORMat:ELEMents:SENSe?')
 
         # close instruments
-        k1.write(':OUTP OFF')
-        k2.write(':OUTP OFF')
+        group.write(':OUTP OFF')
+        group.close()
+        print(group.timings())
     elif k2_inst == '6517a':
         # NOTE: the variable voltage_levels and nplc have no effect on Keithley 6517 triggering.
         # All "synchronization" settings are pre-programmed to be as fast as possible
         # and no data is recorded.
-        setup_6517_trigger(keithley_inst=k2, voltage_levels=trigger_voltage, nplc=trigger_NPLC)
+        # k2 is the Keithley 6517a (k2_inst): its setup is batched into messages of up to 512 characters
+        with BatchWriter(k2, max_length=dict_max_message_length[k2_inst]) as k2_batch:
+            setup_6517_trigger(keithley_inst=k2_batch, voltage_levels=trigger_voltage, nplc=trigger_NPLC)
         """
         # Execute configured measurement
         k3.write('OUTP ON')  # Turn source ON
@@ -359,8 +364,9 @@ if __name__ == "__main__":
         k2.write(':OUTP ON')  # Turn on trigger voltage source to whatever voltage level was set.
 
         # Trigger the source Keithley
-        k1.write(':INIT')  # Trigger voltage readings.
-        data_stimulus = k1.query_ascii_values(':FETCh?', container=np.array)  # request data.
+        time_start = time.perf_counter()
+        data_stimulus = run_list_sweep(k1, values_up_and_down, num_elements, idxT=idxVCTRS[2],
+                                       uploaded=True)  # Trigger and request data.
         data_elements = k1.query(':FORMat:ELEMents:SENSe?')  # :FORM:ELEM?
         # close instruments
         k1.write(':OUTP OFF')
@@ -368,6 +374,8 @@ if __name__ == "__main__":
         k2.write(':OUTP OFF')
     else:
         raise ValueError("Trigger instrument not understood.")
+    run_model.record('2410', len(data_stimulus), time.perf_counter() - time_start, nplc=NPLC,
+                     source_delay=source_measure_delay, mode='LIST_SWEEP')
 
     # --- Execute source-measure action
 
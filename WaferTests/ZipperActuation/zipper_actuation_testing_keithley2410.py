@@ -1,24 +1,16 @@
 from os.path import join
+import time
 
 import pandas as pd
 import pyvisa
 import numpy as np
 import matplotlib.pyplot as plt
 
-# --- FUNCTION FOR CONVERTING NUMPY ARRAY TO STRING LIST FOR KEITHLEY
-
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
-
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
+from utils.keithley_2410 import run_2410_settle_pulse, plan_settle_times, run_settled_list_sweep
+from utils.timing import RunDurationModel
+from utils.waveforms import append_reverse, staircase_trace
 
-    appended_arr = np.concatenate((arr, reversed_arr))
-
-    return appended_arr
+# --- FUNCTION FOR CONVERTING NUMPY ARRAY TO STRING LIST FOR KEITHLEY
 
 def numpy_array_to_string(arr):
     # Convert the NumPy array elements to strings
@@ -47,6 +39,11 @@ if __name__ == "__main__":
     Vmax, Vstep = 5, 0.5
     save_id = 'test1_test{}_{}V'.format(test_num, Vmax)
     save_fig = True
+    # settle-time planning: None = use source_measure_delay and NPLC (below) for every step; otherwise, characterize
+    # the DUT with a short pulse and use the shortest delay and NPLC at each step for this accuracy (relative to the
+    # settled current), but never longer than source_measure_delay
+    settle_accuracy = None  # e.g., 0.01
+    settle_min_current = None  # (A) smallest tolerance; None = noise at the pulse NPLC
 
     BOARD_INDEX = 1
     GPIB = 25
@@ -121,7 +118,7 @@ if __name__ == "__main__":
     num_points = len(values_up_and_down)
     # FREQUENCY
     integration_period = NPLC / 60
-    estimated_timeout = num_points * source_measure_delay * 1000 * 2 + 0.2  # (ms)
+    estimated_timeout = num_points * source_measure_delay * 1000 * 2 + 200  # (ms)
 
     # DATA TYPES
     elements_sense = 'VOLTage, CURRent, TIME'  #, RESistance, STATus
@@ -158,7 +155,26 @@ if __name__ == "__main__":
 
     keithley.write(':OUTP ON')  # Turn on source output.
 
-    data = keithley.query_ascii_values(':READ?', container=np.array)  # Trigger sweep, request data.
+    if settle_accuracy is None:
+        data = keithley.query_ascii_values(':READ?', container=np.array)  # Trigger sweep, request data.
+    else:
+        keithley.timeout = 10000  # (ms) the pulse (500 readings at 0.01 NPLC) takes a few seconds
+        settling = run_2410_settle_pulse(keithley, step_voltage=np.max(np.abs(np.diff(values_up_and_down))))
+        print("Settling: tau = {} ms, noise = {} pA".format(np.round(settling['tau'] * 1e3, 2),
+                                                           np.round(settling['noise'] * 1e12, 2)))
+        delays, nplcs = plan_settle_times(values_up_and_down, settling, accuracy=settle_accuracy,
+                                          min_current=settle_min_current, max_delay=source_measure_delay)
+        print("Planned source delays: {} s (mean), NPLC: {} (mean)".format(np.round(np.mean(delays), 3),
+                                                                           np.round(np.mean(nplcs), 2)))
+        # timeout is predicted from previous settled sweeps (the features are linear in the per-step settings, so the
+        # mean delay and NPLC give the total)
+        run_model = RunDurationModel()
+        keithley.timeout = run_model.timeout('2410', num_points, nplc=np.mean(nplcs), source_delay=np.mean(delays),
+                                             mode='SETTLED_LIST_SWEEP') * 1000  # (ms)
+        time_start = time.perf_counter()
+        data = run_settled_list_sweep(keithley, values_up_and_down, delays, nplcs, num_elements, idxT)
+        run_model.record('2410', len(data), time.perf_counter() - time_start, nplc=np.mean(nplcs),
+                         source_delay=np.mean(delays), mode='SETTLED_LIST_SWEEP')
 
     # --- POST-PROCESSING
     data_elements = keithley.query(':FORMat:ELEMents:SENSe?')
@@ -186,13 +202,7 @@ if __name__ == "__main__":
     arr_V = data_struct[:, idxV]
     arr_I = data_struct[:, idxC]
     # add time points to show V(t) in between current sampling times
-    arr_Tt = arr_T[1:] - integration_period
-    arr_Vt = arr_V[:-1]
-    # concat
-    arr_T2 = np.concatenate((arr_T, arr_Tt))
-    arr_V2 = np.concatenate((arr_V, arr_Vt))
-    # sort by time
-    arr_T2, arr_V2 = list(zip(*sorted(zip(arr_T2,arr_V2))))
+    arr_T2, arr_V2 = staircase_trace(arr_T, arr_V, edge_time=integration_period, edge='leading')
 
     # --- plotting
 
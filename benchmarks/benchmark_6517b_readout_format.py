@@ -0,0 +1,111 @@
+import os
+from os.path import join
+import time
+import numpy as np
+import pandas as pd
+
+from utils.keithley_6517 import setup_6517_data_format, query_6517_values, estimate_6517_transfer_size
+from utils.simulated import get_resource_manager
+
+
+def setup_6517_fill_buffer(keithley_inst, num_points, nplc, elements):
+    """
+    Fill the reading buffer as fast as possible so the same readings can be dumped in every data format.
+    """
+    keithley_inst.write('*RST')
+    keithley_inst.write(':SYST:ZCH ON')  # Enable (ON) or disable (OFF) zero check (default: OFF)
+    keithley_inst.write(':SYST:TSC OFF')  # Enable or disable external temperature readings (default: ON)
+    keithley_inst.write(':SYST:LSYNC:STAT 0')  # disable power line synchronization
+    keithley_inst.write(':DISP:ENAB OFF')  # Disable the front-panel display
+    keithley_inst.write(':SENS:FUNC "CURR"')  # 'VOLTage[:DC]', 'CURRent[:DC]', 'RESistance', 'CHARge'
+    keithley_inst.write(':SENS:CURR:NPLC ' + str(nplc))  # (default = 1) Set integration rate in line cycles (0.01 to 10)
+    keithley_inst.write(':FORM:ELEM ' + elements)  # data elements: READing, TSTamp, VSOurce, ...
+    keithley_inst.write(':TRAC:ELEM TST,VSO')  # data elements: TSTamp, VSOurce, CHANnel, ETEMperature, HUMidity, NONE
+    keithley_inst.write(':TRAC:CLE')  # Clear buffer
+    keithley_inst.write(':TRAC:POIN ' + str(num_points))  # Specify the size of the buffer
+    keithley_inst.write(':TRIG:COUN ' + str(num_points))  # Set measure count (1 to 99999 or INF)
+    keithley_inst.write(':TRIG:DEL 0')  # After receiving Measure Event, delay before Device Action
+    keithley_inst.write(':TRAC:FEED:CONT NEXT')  # Buffer control: Fill-and-stop
+    keithley_inst.write(':SYST:ZCH OFF')  # Enable (ON) or disable (OFF) zero check (default: OFF)
+    keithley_inst.write(':INIT')  # Move from IDLE state to ARM Layer 1
+    # wait for buffer full
+    while int(float(keithley_inst.query(':TRAC:POIN:ACT?'))) < num_points:
+        time.sleep(0.25)
+
+
+def time_ascii_readout(keithley_inst, command):
+    """ The current path: format on the instrument, transfer text, parse floats on the host. """
+    setup_6517_data_format(keithley_inst, data_format='ASCii')
+    tic = time.perf_counter()
+    keithley_inst.write(command)
+    raw = keithley_inst.read_raw()
+    values = np.array(raw.decode().strip().split(','), dtype=float)
+    toc = time.perf_counter()
+    return values, len(raw), toc - tic
+
+
+def time_binary_readout(keithley_inst, command, data_format, byte_order):
+    setup_6517_data_format(keithley_inst, data_format=data_format, byte_order=byte_order)
+    tic = time.perf_counter()
+    values = query_6517_values(keithley_inst, command, data_format=data_format, byte_order=byte_order)
+    toc = time.perf_counter()
+    return values, estimate_6517_transfer_size(len(values), data_format), toc - tic
+
+
+if __name__ == "__main__":
+    """
+    Compare bytes on the bus and readings/s for ASCii, SREal and DREal transfers of the same buffer (:TRAC:DATA?).
+
+    NOTES:
+        * The buffer is filled once, then dumped NUM_REPEATS times per data format.
+        * Binary transfer sizes are computed from the block length ('#0' + values + LF).
+        * Set BACKEND = '@lab-sim' to run the benchmark without hardware.
+    """
+    BACKEND = ''  # '' = pyvisa default (NI-VISA); '@lab-sim' = simulated instruments (see utils/simulated.py)
+    rm = get_resource_manager(BACKEND)
+    K1_GPIB, K1_BOARD_INDEX = 27, 0  # Keithley 6517b
+
+    NUM_POINTS = 5000
+    NPLC = 0.01
+    ELEMENTS = 'READ,TST,VSO'
+    NUM_ELEMENTS = len(ELEMENTS.split(','))
+    NUM_REPEATS = 5
+    DATA_FORMATS = ['ASCii', 'SREal', 'DREal']
+    BYTE_ORDER = 'SWAPped'
+
+    SAVE_DIR = r'C:\Users\nanolab\Desktop\test\benchmarks'
+    SAVE_ID = 'benchmark_6517b_readout_format_{}pts'.format(NUM_POINTS)
+    save_ = False
+
+    # ---
+
+    k1 = rm.open_resource('GPIB{}::{}::INSTR'.format(K1_BOARD_INDEX, K1_GPIB))
+    k1.timeout = 60000  # (ms)
+    setup_6517_fill_buffer(keithley_inst=k1, num_points=NUM_POINTS, nplc=NPLC, elements=ELEMENTS)
+
+    results = []
+    for data_format in DATA_FORMATS:
+        for rep in range(NUM_REPEATS):
+            if data_format == 'ASCii':
+                values, num_bytes, dt = time_ascii_readout(k1, ':TRAC:DATA?')
+            else:
+                values, num_bytes, dt = time_binary_readout(k1, ':TRAC:DATA?', data_format, BYTE_ORDER)
+            num_readings = len(values) // NUM_ELEMENTS
+            results.append([data_format, rep, num_readings, num_bytes, num_bytes / num_readings, dt,
+                            num_readings / dt])
+
+    setup_6517_data_format(k1, data_format='ASCii')
+    k1.close()
+
+    df = pd.DataFrame(results, columns=['data_format', 'rep', 'num_readings', 'num_bytes', 'bytes_per_reading',
+                                        'transfer_time', 'readings_per_second'])
+    dfg = df.groupby('data_format')[['num_bytes', 'bytes_per_reading', 'transfer_time', 'readings_per_second']].mean()
+    dfg['speedup'] = dfg['readings_per_second'] / dfg.loc['ASCii', 'readings_per_second']
+    print(dfg)
+
+    if save_:
+        if not os.path.exists(SAVE_DIR):
+            os.makedirs(SAVE_DIR)
+        with pd.ExcelWriter(join(SAVE_DIR, SAVE_ID + '.xlsx')) as writer:
+            df.to_excel(writer, sheet_name='data', index=False)
+            dfg.to_excel(writer, sheet_name='summary', index=True)
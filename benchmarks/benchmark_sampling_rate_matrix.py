@@ -0,0 +1,236 @@
+import os
+from os.path import join
+import itertools
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+
+from utils.keithley_6517 import setup_6517_data_format, query_6517_values, wait_for_6517_buffer
+from utils.simulated import get_resource_manager
+from utils.timing import summarize_sampling
+
+
+# every combination of these settings is benchmarked, per instrument
+#   source_delay: :TRIG:DEL (6517b) or :SOUR:DEL (2410)
+#   autozero: :SYST:ZCOR (6517b, zero correct) or :SYST:AZER (2410)
+#   elements: :FORM:ELEM (6517b) or :FORM:ELEM:SENS (2410); the first element is the reading
+#   readout: 'fetch' (:INIT + :FETCh? per reading), 'read' (:READ? per reading) or 'buffer' (every reading in one
+#            transfer: :TRAC:DATA? on the 6517b, :FETCh? with :TRIG:COUN on the 2410)
+dict_benchmark_factors = {
+    '6517b': {
+        'nplc': [0.01, 0.1, 1],
+        'source_delay': [0, 0.005],
+        'display': ['ON', 'OFF'],
+        'autozero': ['OFF', 'ON'],
+        'data_format': ['ASCii', 'SREal'],
+        'elements': ['READ', 'READ,TST'],
+        'readout': ['fetch', 'read', 'buffer'],
+    },
+    '2410': {
+        'nplc': [0.01, 0.1, 1],
+        'source_delay': [0, 0.005],
+        'display': ['ON', 'OFF'],
+        'autozero': ['ON', 'OFF'],
+        'data_format': ['ASCii', 'SREal'],
+        'elements': ['CURR', 'CURR,TIME'],
+        'readout': ['fetch', 'read', 'buffer'],
+    },
+}
+
+# name of the timestamp element of each instrument
+dict_timestamp_element = {
+    '6517b': 'TST',
+    '2410': 'TIME',
+}
+
+# order in which the 2410 sends its elements (:FORM:ELEM:SENS only selects which are sent)
+sense_elements_2410 = ['VOLT', 'CURR', 'RES', 'TIME', 'STAT']
+
+
+def benchmark_configurations(instrument, factors=None):
+    """ Every combination of the factors (default: dict_benchmark_factors[instrument]), as a list of dicts. """
+    factors = dict_benchmark_factors[instrument] if factors is None else factors
+    return [dict(zip(factors.keys(), values)) for values in itertools.product(*factors.values())]
+
+
+def setup_6517_benchmark(keithley_inst, config, current_range):
+    keithley_inst.write('*RST')
+    keithley_inst.write(':SYST:ZCH ON')  # Enable (ON) or disable (OFF) zero check (default: OFF)
+    keithley_inst.write(':SYST:TSC OFF')  # Enable or disable external temperature readings (default: ON)
+    keithley_inst.write(':SYST:TST:TYPE REL')  # Configure timestamp type: RELative or RTClock
+    keithley_inst.write(':DISP:ENAB ' + config['display'])  # Enable or disable the front-panel display
+    keithley_inst.write(':SENS:FUNC "CURR"')  # 'VOLTage[:DC]', 'CURRent[:DC]', 'RESistance', 'CHARge'
+    keithley_inst.write(':SENS:CURR:NPLC ' + str(config['nplc']))  # Set integration rate in line cycles (0.01 to 10)
+    keithley_inst.write(':SENS:CURR:RANG:AUTO OFF')  # Enable (ON) or disable (OFF) autorange
+    keithley_inst.write(':SENS:CURR:RANG ' + str(current_range))  # Select current range: 0 to 20e-3
+    if config['autozero'] == 'ON':
+        keithley_inst.write(':SYST:ZCOR:ACQ')  # Acquire zero correct value (zero check must be enabled)
+    keithley_inst.write(':SYST:ZCOR ' + config['autozero'])  # Enable (ON) or disable (OFF) zero correct
+    keithley_inst.write(':TRIG:DEL ' + str(config['source_delay']))  # After Measure Event, delay before Device Action
+    keithley_inst.write(':FORM:ELEM ' + config['elements'])  # data elements: READing, TSTamp, VSOurce, ...
+    setup_6517_data_format(keithley_inst, data_format=config['data_format'])
+    keithley_inst.write(':SYST:ZCH OFF')  # Enable (ON) or disable (OFF) zero check (default: OFF)
+
+
+def setup_2410_benchmark(keithley_inst, config, current_range):
+    keithley_inst.write('*RST')
+    keithley_inst.write(':SOUR:FUNC VOLT')  # Volts source function.
+    keithley_inst.write(':SOUR:VOLT:MODE FIX')  # Fixed voltage mode.
+    keithley_inst.write(':SOUR:VOLT 0')  # Specify source voltage
+    keithley_inst.write(':SOUR:DEL ' + str(config['source_delay']))  # Specify settling time
+    keithley_inst.write(':SENS:FUNC "CURR"')  # Current sense function.
+    keithley_inst.write(':SENS:CURR:PROT ' + str(current_range))  # Current compliance.
+    keithley_inst.write(':SENS:CURR:RANG ' + str(current_range))  # Current range.
+    keithley_inst.write(':SENS:CURR:NPLC ' + str(config['nplc']))  # Specify integration rate (in line cycles)
+    keithley_inst.write(':SYST:AZER ' + config['autozero'])  # Enable (ON) or disable (OFF) autozero
+    keithley_inst.write(':DISP:ENAB ' + config['display'])  # Enable or disable the front-panel display
+    keithley_inst.write(':FORM:ELEM:SENS ' + config['elements'])  # VOLT, CURR, RES, TIME, STAT
+    setup_6517_data_format(keithley_inst, data_format=config['data_format'])  # same :FORM:DATA/:FORM:BORD commands
+    keithley_inst.write(':OUTP ON')  # Turn on output.
+
+
+def readout_loop(keithley_inst, config, num_points, num_elements):
+    """ One reading per host round trip: return (readings, host time of each reading) """
+    data, host_times = [], []
+    for i in range(num_points):
+        if config['readout'] == 'fetch':
+            keithley_inst.write(':INIT')  # Move from IDLE state to ARM Layer 1
+            datum = query_6517_values(keithley_inst, ':FETCh?', data_format=config['data_format'])
+        else:
+            datum = query_6517_values(keithley_inst, ':READ?', data_format=config['data_format'])
+        host_times.append(time.perf_counter())
+        data.append(datum[:num_elements])
+    return np.array(data), np.array(host_times)
+
+
+def readout_buffer(keithley_inst, instrument, config, num_points, num_elements):
+    """ Every reading in one transfer: return (readings, None) """
+    keithley_inst.write(':TRIG:COUN ' + str(num_points))  # Set measure count
+    if instrument == '6517b':
+        keithley_inst.write(':TRAC:ELEM ' + ('TST' if 'TST' in config['elements'] else 'NONE'))
+        keithley_inst.write(':TRAC:CLE')  # Clear buffer
+        keithley_inst.write(':TRAC:POIN ' + str(num_points))  # Specify the size of the buffer
+        keithley_inst.write(':TRAC:FEED:CONT NEXT')  # Buffer control: Fill-and-stop
+        keithley_inst.write(':INIT')  # Move from IDLE state to ARM Layer 1
+        wait_for_6517_buffer(keithley_inst, num_points, poll_interval=0.01)
+        data = query_6517_values(keithley_inst, ':TRAC:DATA?', data_format=config['data_format'])
+    else:
+        keithley_inst.write(':INIT')  # Move from IDLE state to ARM Layer 1
+        data = query_6517_values(keithley_inst, ':FETCh?', data_format=config['data_format'])
+    return np.reshape(data, (-1, num_elements)), None
+
+
+def benchmark_configuration(keithley_inst, instrument, config, num_points, current_range=2e-9):
+    """
+    Configure the instrument, take num_points readings with the selected readout and measure the sampling rate,
+    timestamp jitter and noise.
+
+    NOTE: jitter is computed from the instrument timestamps if they are in the element list, otherwise from the host
+    time of each reading (loops only).
+    """
+    if instrument == '6517b':
+        setup_6517_benchmark(keithley_inst, config, current_range)
+        elements = config['elements'].split(',')
+    else:
+        setup_2410_benchmark(keithley_inst, config, current_range)
+        elements = [x for x in sense_elements_2410 if x in config['elements'].split(',')]
+    tic = time.perf_counter()
+    if config['readout'] == 'buffer':
+        data, host_times = readout_buffer(keithley_inst, instrument, config, num_points, len(elements))
+    else:
+        data, host_times = readout_loop(keithley_inst, config, num_points, len(elements))
+    elapsed = time.perf_counter() - tic
+    if instrument == '2410':
+        keithley_inst.write(':OUTP OFF')  # Turn off output.
+
+    readings = data[:, elements.index('CURR' if instrument == '2410' else 'READ')]
+    result = dict(config, instrument=instrument, num_points=len(data), elapsed=elapsed,
+                  samples_per_second=len(data) / elapsed, noise=np.std(readings))
+    if dict_timestamp_element[instrument] in elements:
+        sampling = summarize_sampling(data[:, elements.index(dict_timestamp_element[instrument])])
+        result.update(timestamp_source='instrument', **sampling)
+    elif host_times is not None:
+        result.update(timestamp_source='host', **summarize_sampling(host_times))
+    else:
+        result.update(timestamp_source='none')
+    return result
+
+
+def save_benchmark_results(df, db_file, table='sampling_rate'):
+    """ Append results to a SQLite table, so every run can be queried together (see fastest_configuration). """
+    with sqlite3.connect(db_file) as conn:
+        df.to_sql(table, conn, if_exists='append', index=False)
+
+
+def fastest_configuration(db_file, instrument, noise_budget, readouts=None, backend='visa', table='sampling_rate'):
+    """
+    Fastest configuration (highest samples/s) whose noise (standard deviation of the readings) is within noise_budget.
+
+    :param db_file: SQLite file written by save_benchmark_results
+    :param instrument: '6517b' or '2410'
+    :param noise_budget: (A) max noise
+    :param readouts: only consider these readout strategies (e.g., ['fetch', 'read'] if every reading must be
+        available to the host as soon as it is taken)
+    :param backend: only consider results from this backend ('visa' for hardware, '@lab-sim' for simulated runs)
+    :return: pd.Series (or None if no configuration meets the noise budget)
+    """
+    query = "SELECT * FROM {} WHERE backend = ? AND instrument = ? AND noise <= ?".format(table)
+    params = [backend, instrument, noise_budget]
+    if readouts is not None:
+        query += " AND readout IN ({})".format(','.join('?' * len(readouts)))
+        params += list(readouts)
+    with sqlite3.connect(db_file) as conn:
+        df = pd.read_sql_query(query + " ORDER BY samples_per_second DESC LIMIT 1", conn, params=params)
+    return df.iloc[0] if len(df) else None
+
+
+if __name__ == "__main__":
+    """
+    Benchmark every combination of NPLC, source delay, display, autozero/zero correct, data format, element list and
+    readout strategy (see dict_benchmark_factors) on the 6517b and 2410, and append the achieved samples/s, timestamp
+    jitter and noise to a SQLite table.
+
+    NOTES:
+        * Readings are taken with the input open (6517b) or at 0 V (2410), so noise is the instrument noise floor.
+        * Set BACKEND = '@lab-sim' to run the benchmark without hardware.
+    """
+    BACKEND = ''  # '' = pyvisa default (NI-VISA); '@lab-sim' = simulated instruments (see utils/simulated.py)
+    rm = get_resource_manager(BACKEND)
+    INSTRUMENTS = {
+        '6517b': 'GPIB0::27::INSTR',
+        '2410': 'GPIB0::25::INSTR',
+    }
+
+    NUM_POINTS = 100
+    CURRENT_RANGE = 2e-9  # (A) fixed range, so autoranging does not add to the reading time
+    NOISE_BUDGET = 1e-13  # (A) used to report the fastest configuration that meets the budget
+
+    SAVE_DIR = r'C:\Users\nanolab\Desktop\test\benchmarks'
+    DB_FILE = join(SAVE_DIR, 'benchmark_sampling_rate.sqlite')
+    save_ = False
+
+    # ---
+
+    results = []
+    for instrument, resource_name in INSTRUMENTS.items():
+        inst = rm.open_resource(resource_name)
+        inst.timeout = 60000  # (ms)
+        for config in benchmark_configurations(instrument):
+            results.append(benchmark_configuration(inst, instrument, config, NUM_POINTS, current_range=CURRENT_RANGE))
+            print(results[-1])
+        inst.write('*RST')
+        inst.close()
+
+    df = pd.DataFrame(results)
+    df.insert(0, 'run_time', pd.Timestamp.now().isoformat())
+    df.insert(1, 'backend', BACKEND or 'visa')
+    print(df.sort_values(['instrument', 'samples_per_second'], ascending=False).to_string())
+
+    if save_:
+        if not os.path.exists(SAVE_DIR):
+            os.makedirs(SAVE_DIR)
+        save_benchmark_results(df, DB_FILE)
+        for instrument in INSTRUMENTS.keys():
+            print("--- Fastest {} configuration within {} A noise:".format(instrument, NOISE_BUDGET))
+            print(fastest_configuration(DB_FILE, instrument, NOISE_BUDGET, backend=BACKEND or 'visa'))
@@ -2,191 +2,9 @@
 *** Copyright Tektronix, Inc.                           ***
 *** See www.tek.com/sample-license for licensing terms. ***
 ***********************************************************"""
-import socket
-import struct
-import math
 import time
-import sys
 
-echo_cmd = 1
-
-
-"""*********************************************************************************
-	Function: instrument_connect(my_socket, ip_address string, my_port int) 
-	
-	Purpose: Open an instance of an instrument object for remote communication
-		 over LAN/Ethernet.
-
-	Parameters:
-                my_socket - Instance of a socket object.
-                
-		ip_address (string) - The TCP/IP address string associated with the
-                                      target instrument. 
-		my_port (int) - The instrument connection port. 
-
-	Returns:
-		my_socket - Updated instance of a socket object that includes
-                            attributes of a valid connection. 
-
-	Revisions:
-		2019-07-30    JJB    Initial revision.
-*********************************************************************************"""
-def instrument_connect(my_socket, my_address, my_port, timeout, do_reset, do_id_query):
-    my_socket.connect((my_address, my_port)) # input to connect must be a tuple
-    my_socket.settimeout(timeout)
-    if do_reset == 1:
-        instrument_write(my_socket, "*RST")
-    if do_id_query == 1:
-        tmp_id = instrument_query(my_socket, "*IDN?", 100)
-        print(tmp_id)
-    return my_socket
-
-
-"""*********************************************************************************
-	Function: instrument_disconnect(my_socket)
-	
-	Purpose: Break the LAN/Ethernet connection between the controlling computer
-			 and the target instrument.
-
-	Parameters:
-		my_socket - The TCP instrument connection object used for sending
-							  and receiving data.
-
-	Returns:
-		None
-
-	Revisions:
-		2019-07-30    JJB    Initial revision.
-*********************************************************************************"""
-def instrument_disconnect(my_socket):
-    my_socket.close()
-    return
-
-
-"""*********************************************************************************
-	Function: instrument_write(my_socket, my_command)
-	
-	Purpose: This function issues control commands to the target instrument.
-
-	Parameters:
-		my_socket - The TCP instrument connection object used for sending
-			    and receiving data.
-		my_command (string) - The command issued to the instrument to make it 
-				      perform some action or service. 
-	Returns:
-		None
-
-	Revisions:
-		2019-07-30    JJB    Initial revision.
-*********************************************************************************"""
-def instrument_write(my_socket, my_command):
-    if echo_cmd == 1:
-        print(my_command)
-    cmd = "{0}\n".format(my_command)
-    my_socket.send(cmd.encode())
-    return
-
-
-"""*********************************************************************************
-	Function: instrument_read(my_socket, receive_size)
-	
-	Purpose: This function asks the connected instrument to reply with some
-                 previously requested information, typically queued up from a call
-                 to instrument_write().
-
-	Parameters:
-		my_socket - The TCP instrument connection object used for sending
-			    and receiving data.
-		receive_size (int) - Size of the data/string to be returned to
-                                     the caller. 
-
-	Returns:
-		reply_string (string) - The requested information returned from the 
-					target instrument.
-
-	Revisions:
-		2019-07-30    JJB    Initial revision.
-*********************************************************************************"""
-def instrument_read(my_socket, receive_size):
-    return my_socket.recv(receive_size).decode()    
-
-
-"""*********************************************************************************
-	Function: instrument_query(my_socket, my_command, receive_size)
-	
-	Purpose: This function issues control commands to the target instrument with
-                 the expectation that data will be returned. For this function
-                 instance, the returned data is (typically) in string format. 
-
-	Parameters:
-		my_socket - The TCP instrument connection object used for sending
-			    and receiving data.
-		my_command (string) - The command issued to the instrument to make it 
-				      perform some action or service.
-		receive_size (int) - The approximate number of bytes of data the caller
-                                     expects to be returned in the response from the
-                                     instrument. 
-	Returns:
-		reply_string (string) - The requested information returned from the 
-					target instrument. Obtained by way of a caller
-					to instrument_read().
-
-	Revisions:
-		2019-07-30    JJB    Initial revision.
-*********************************************************************************"""
-def instrument_query(my_socket, my_command, receive_size):
-    instrument_write(my_socket, my_command)
-    time.sleep(0.1)
-    return instrument_read(my_socket, receive_size)
-
-
-"""*********************************************************************************
-	Function: instrument_query_binary(my_socket, my_command, expected_number_of_readings)
-	
-	Purpose: This function issues control commands to the target instrument with
-                 the expectation that data will be returned. For this function
-                 instance, the returned data is specifically) expected to be in
-                 binary format. Note that this function does not handle directing
-                 the target instrument to return its data in binary format - it is
-                 the user's responsibility to understand/issue the commands that
-                 manage the binary formats.
-
-                 Binary formatting can promote either single or double floating point
-                 format of IEEE Std 754. This function assumes the following defaults:
-                     * Normal byte order (non-swapped)
-                     * Single precision format
-                     * Little endian byte order
-
-	Parameters:
-		my_socket - The TCP instrument connection object used for sending
-			    and receiving data.
-		my_command (string) - The command issued to the instrument to make it 
-				      perform some action or service.
-		expected_number_of_readings (int) - This is number of readings that
-                                                    is being requested to be returned
-                                                    from the instrument to the caller. 
-	Returns:
-		reply_string (string) - The requested information returned from the 
-					target instrument. Obtained by way of a caller
-					to instrument_read().
-
-	Revisions:
-		2019-08-29    JJB    Initial revision.
-*********************************************************************************"""
-def instrument_query_binary(my_socket, my_command, expected_number_of_readings):
-    receive_size = expected_number_of_readings * sys.getsizeof(float())
-
-    instrument_write(my_socket, my_command)
-    response = my_socket.recv(receive_size)
-    fmtStr = '%df' % expected_number_of_readings
-    altResp = struct.unpack(fmtStr, response[2:-1]) # Note the index offset applied
-                                                    # to the response data. This is
-                                                    # applicable to a majority of
-                                                    # Keithley measurment tools. If
-                                                    # you choose to repurpose this
-                                                    # code for use with equipment from
-                                                    # another vendor
-    return altResp
+from utils.broker import open_instrument
 
 
 """*********************************************************************************
@@ -203,25 +21,27 @@ def instrument_query_binary(my_socket, my_command, expected_number_of_readings):
 ip_address = "192.168.1.25"     # Place your instrument's IP address here.
 my_port = 5025
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)                 # Establish a TCP/IP socket object
-# Open the socket connection
-instrument_connect(s, ip_address, my_port, 20000, 0, 1)
+# Open the socket connection (SOCKET resources are opened as a non-blocking raw socket, see utils/lan.py)
+s = open_instrument(None, "TCPIP0::{}::{}::SOCKET".format(ip_address, my_port))
+s.timeout = 20000
+print(s.query("*IDN?"))
 
 t1 = time.time()                    # Start the timer...
 
-instrument_write(s, "*RST")                                             # Reset the SMU
-instrument_write(s, "TRIG:LOAD \"SimpleLoop\", 100")                    # Configure Simple Loop trigger model template to make 100 readings.
-instrument_write(s, "SENS:FUNC \"RES\"")                                # Set to measure resistance.
-instrument_write(s, "SENS:RES:RANG:AUTO ON")                            # Turn on auto range.
-instrument_write(s, "SENS:RES:OCOM ON")                                 # Enable offset compensation.
-instrument_write(s, "SENS:RES:RSEN ON")                                 # Set to use 4-wire sense mode.
-instrument_write(s, "DISP:SCR SWIPE_GRAPh")                             # Show the GRAPH swipe screen.
-instrument_write(s, "OUTP ON")                                          # Turn on the output.
-instrument_write(s, "INIT")                                             # Initiate readings
-instrument_write(s, "*WAI")                                             # Allow time for all measurements to complete.
-readings_1 = instrument_query(s, "TRAC:DATA? 1, 50, \"defbuffer1\", READ, REL", (16*100)).rstrip()
-readings_2 = instrument_query(s, "TRAC:DATA? 51, 100, \"defbuffer1\", READ, REL", (16*100)).rstrip()
-instrument_write(s, "OUTP OFF")                                          # Turn off the output.
+s.write("*RST")                                             # Reset the SMU
+s.write("TRIG:LOAD \"SimpleLoop\", 100")                    # Configure Simple Loop trigger model template to make 100 readings.
+s.write("SENS:FUNC \"RES\"")                                # Set to measure resistance.
+s.write("SENS:RES:RANG:AUTO ON")                            # Turn on auto range.
+s.write("SENS:RES:OCOM ON")                                 # Enable offset compensation.
+s.write("SENS:RES:RSEN ON")                                 # Set to use 4-wire sense mode.
+s.write("DISP:SCR SWIPE_GRAPh")                             # Show the GRAPH swipe screen.
+s.write("OUTP ON")                                          # Turn on the output.
+s.write("INIT")                                             # Initiate readings
+s.write("*WAI")                                             # Allow time for all measurements to complete.
+# both halves of the buffer are requested in one message; each response is read in full (no fixed receive size)
+readings_1, readings_2 = s.query_pipelined(["TRAC:DATA? 1, 50, \"defbuffer1\", READ, REL",
+                                            "TRAC:DATA? 51, 100, \"defbuffer1\", READ, REL"])
+s.write("OUTP OFF")                                          # Turn off the output.
 
 #print(readings_1)
 #print(readings_2)
@@ -243,7 +63,7 @@ while counter <= 100:
     index += 2
     
 # Close the socket connection
-instrument_disconnect(s)
+s.close()
 t2 = time.time()
 
 # Notify the user of completion and the data streaming rate achieved. 
@@ -6,6 +6,8 @@ Trigger Synchronization of Multiple series 2400 SourceMeter Instruments
 import pyvisa
 import numpy as np
 
+from utils.instrument_group import InstrumentGroup
+
 # ---
 
 # --- INSTRUMENT ADDRESSES
@@ -157,24 +159,26 @@ for keithley in [k1, k2]:
 # ---
 
 
+# k1 and k2 are on different GPIB boards, so requests to both are sent concurrently (one thread per instrument)
+group = InstrumentGroup({'k1': k1, 'k2': k2})
+
 # Turn on output
-k1.write(':OUTP ON')  # Output on before measuring.
-k2.write(':OUTP ON')  # Output on before measuring.
+group.write(':OUTP ON')  # Output on before measuring.
 
-# The following begins testing
-k2.write(':INIT')
-k1.write(':INIT')
+# The following begins testing (SMU2 must be armed before SMU1 sources and outputs its trigger)
+group.write_in_order([('k2', ':INIT'), ('k1', ':INIT')])
 
 # The following requests the measurement results and enters them into PC via GPIB bus.
-data2 = k2.query_ascii_values(':FETCh?', container=np.array)  # Initialize and ask for data
-data1 = k1.query_ascii_values(':FETCh?', container=np.array)  # Initialize and ask for data
+data = group.query_ascii_values(':FETCh?', container=np.array)  # Ask both instruments for data
+data1, data2 = data['k1'], data['k2']
 
 # Turn on output
-k1.write(':OUTP OFF')  # Output on before measuring.
-k2.write(':OUTP OFF')  # Output on before measuring.
+group.write(':OUTP OFF')  # Output on before measuring.
+group.close()
 
 print(data2)
 print(data1)
+print(group.timings())
 
 print('Program completed execution without errors.')
 
@@ -6,29 +6,9 @@ from os.path import join
 import numpy as np
 import matplotlib.pyplot as plt
 
-# ---
-
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
-
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
-
-    appended_arr = np.concatenate((arr, reversed_arr))
+from utils.waveforms import concatenate, hold, pulse
 
-    return appended_arr
-
-def keep_voltage(Voltage, length):
-    """Applies defined voltage for n amount of points"""
-    return [Voltage for _ in range(length)]
-
-def pulse(Vinit, Vmax, length):
-    """Creates a pulse going from Vinit to Vmax, staying for n amount of points at Vmax and going back to Vinit"""
-    return append_reverse(arr=np.concatenate((np.arange(Vinit, Vmax + Vmax / np.abs(Vmax), Vmax), keep_voltage(Vmax,length))),
-                   single_point_max=True)
+# ---
 
 def if_not_create(filepath):
     if not os.path.exists(filepath):
@@ -46,12 +26,13 @@ Vo, Vmax = 0, 250
 dV = Vmax
 # V_up = [Vmax for _ in range(1)]
 # Vs = np.concatenate((V_ramp_up,V_up))
-V_pos_cycle = pulse(Vo, Vmax, 2)
-V_neg_cycle = pulse(Vo, -Vmax, 2)
-# Vs = np.concatenate((keep_voltage(0,5),pulse(Vo,Vmax,2),keep_voltage(0,20),pulse(Vo,-40,1),keep_voltage(0,20),
-#                      pulse(Vo,-Vmax,2),keep_voltage(0,20),pulse(Vo,40,1),keep_voltage(0,5)))
-Vs = np.concatenate((keep_voltage(0,5),pulse(0,50,3),keep_voltage(0,10),pulse(0,-10,2),keep_voltage(0,20),
-                     pulse(0,-90,3),keep_voltage(0,10),pulse(0,10,2),keep_voltage(0,5)))
+# pulse(base, peak, width): base, then peak for width points, then base
+V_pos_cycle = pulse(Vo, Vmax, 5).V
+V_neg_cycle = pulse(Vo, -Vmax, 5).V
+# Vs = concatenate(hold(0,5),pulse(Vo,Vmax,5),hold(0,20),pulse(Vo,-40,3),hold(0,20),
+#                  pulse(Vo,-Vmax,5),hold(0,20),pulse(Vo,40,3),hold(0,5)).V
+Vs = concatenate(hold(0,5),pulse(0,50,7),hold(0,10),pulse(0,-10,5),hold(0,20),
+                 pulse(0,-90,7),hold(0,10),pulse(0,10,5),hold(0,5)).V
 print(Vs)
 # SENSING
 Imax = 1e-3
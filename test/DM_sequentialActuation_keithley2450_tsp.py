@@ -0,0 +1,106 @@
+import pyvisa
+import pandas as pd
+import os
+from os.path import join
+import numpy as np
+import matplotlib.pyplot as plt
+
+from utils.waveforms import concatenate, hold, pulse
+from utils.tsp import TSPSweepDeployer
+from utils.timing import summarize_sampling, print_sampling_summary
+
+# ---
+# The pulse sequence of DM_sequentialActuation.py, run on a Keithley 2450 in TSP mode (MENU > System > Settings >
+# Command Set: TSP). The sweep function and the sequence's levels and dwells are uploaded once (each named by a hash
+# of its contents) and then called by name, so the timing runs on the instrument and repeated runs skip the upload.
+# NOTE: the 6517b (DM_sequentialActuation.py) is SCPI-only and cannot run TSP.
+
+
+def if_not_create(filepath):
+    if not os.path.exists(filepath):
+        os.makedirs(filepath)
+
+# ---
+# inputs
+
+# Keithley 2450
+GPIB = 18
+BoardIndex = 0
+
+# SOURCING
+dwell = 0.01  # (s) each level is held for dwell, then measured
+# pulse(base, peak, width): base, then peak for width points, then base
+Vs = concatenate(hold(0, 5, dwell), pulse(0, 50, 7, dwell), hold(0, 10, dwell), pulse(0, -10, 5, dwell),
+                 hold(0, 20, dwell), pulse(0, -90, 7, dwell), hold(0, 10, dwell), pulse(0, 10, 5, dwell),
+                 hold(0, 5, dwell))
+print(Vs.V)
+# SENSING
+Imax = 1e-3
+NPLC = 0.01  # (default = 1) Set integration rate in line cycles (0.01 to 10)
+idxC, idxT, idxV = 0, 1, 2  # Current, Timestamp, Voltage Source
+
+assm = 'ASSM45'
+path_results = r'C:\Users\nanolab\Desktop\Damien\ASSM46'
+save_name = '{}_{}test_2450'.format(assm, np.max(np.abs(Vs.V)))
+plot_title = '{}: Keithley 2450 (TSP), NPLC={}'.format(assm, NPLC)
+
+save_ = True
+if save_:
+    if_not_create(path_results)
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+num_points = len(Vs)
+
+print("Theoretical:")
+print("Sampling period: {} ms".format(np.round((dwell + NPLC / 60) * 1e3, 2)))
+print("Min. total sampling time ({} samples): {} s".format(num_points, np.round(Vs.duration, 3)))
+
+# ----------------------------------------------------------------------------------------------------------------------
+# RUN MEASUREMENT
+
+# open instrument
+rm = pyvisa.ResourceManager()
+smu = rm.open_resource('GPIB{}::{}::INSTR'.format(BoardIndex, GPIB))
+smu.timeout = int((Vs.duration * 3 + 10) * 1000)  # (ms)
+
+deployer = TSPSweepDeployer(smu)
+data_struct = deployer.run_sequence(Vs, nplc=NPLC, irange=Imax)  # (N, 3): reading, relative timestamp, source value
+print("Script uploads: {}".format(deployer.num_uploads))  # 0 if the sweep was already on the instrument
+
+smu.close()                  # close instrument
+
+# ----------------------------------------------------------------------------------------------------------------------
+# POST-PROCESSING
+
+print_sampling_summary(summarize_sampling(data_struct[:, idxT]))
+
+# - PLOTTING
+
+# arrays to plot
+t = data_struct[:, idxT] - data_struct[0, idxT]  # convert to relative time since start
+V = data_struct[:, idxV]
+I = data_struct[:, idxC] * 1e6  # convert to micro Amps
+
+fig, (ax1, ax2) = plt.subplots(nrows=2, gridspec_kw={'height_ratios': [1, 2]})
+
+ax1.plot(t, V, '-o', color='blue')
+ax1.set_xlabel('TSTamp (s)')
+ax1.set_ylabel('VOLTage (V)')
+
+ax2.plot(t, I, '-o', color='b')
+ax2.set_xlabel('TSTamp (s)')
+ax2.set_ylabel('CURRent (uA)')
+ax2.grid(alpha=0.25)
+
+plt.suptitle(plot_title)
+plt.tight_layout()
+if save_:
+    plt.savefig(join(path_results, save_name + '.png'), dpi=300)
+plt.show()
+plt.close()
+
+# --- export to excel
+if save_:
+    df = pd.DataFrame(data_struct, columns=['I', 't', 'V'])
+    df.to_excel(join(path_results, save_name + '.xlsx'))
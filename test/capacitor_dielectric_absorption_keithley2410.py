@@ -7,20 +7,10 @@ import matplotlib.pyplot as plt
 import time
 from datetime import datetime
 
-# --- FUNCTION FOR CONVERTING NUMPY ARRAY TO STRING LIST FOR KEITHLEY
-
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
+from utils.timing import sleep_until
+from utils.waveforms import staircase_trace
 
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
-
-    appended_arr = np.concatenate((arr, reversed_arr))
-
-    return appended_arr
+# --- FUNCTION FOR CONVERTING NUMPY ARRAY TO STRING LIST FOR KEITHLEY
 
 def numpy_array_to_string(arr):
     # Convert the NumPy array elements to strings
@@ -163,7 +153,7 @@ if __name__ == "__main__":
     # keithley.write(':OUTP ON')  # Turn on source output.
     # data = keithley.query_ascii_values(':READ?', container=np.array)  # Trigger sweep, request data.
     print("DISCHARGING!")
-    time.sleep(t_discharge)
+    sleep_until(time.perf_counter() + t_discharge)
     # ------------------------------------------------------------------------------------------------------------------
     # ------------------------------------------------------------------------------------------------------------------
     # 3. Output a current of 0 A on as low a current range as possible and measure voltage
@@ -221,13 +211,7 @@ if __name__ == "__main__":
     arr_V = data_struct[:, idxV]
     arr_I = data_struct[:, idxC]
     # add time points to show V(t) in between current sampling times
-    arr_Tt = arr_T[1:] - integration_period
-    arr_Vt = arr_V[:-1]
-    # concat
-    arr_T2 = np.concatenate((arr_T, arr_Tt))
-    arr_V2 = np.concatenate((arr_V, arr_Vt))
-    # sort by time
-    arr_T2, arr_V2 = list(zip(*sorted(zip(arr_T2,arr_V2))))
+    arr_T2, arr_V2 = staircase_trace(arr_T, arr_V, edge_time=integration_period, edge='leading')
 
     # --- plotting
 
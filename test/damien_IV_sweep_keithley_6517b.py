@@ -7,44 +7,18 @@ from os.path import join
 import numpy as np
 import matplotlib.pyplot as plt
 
-# ---
-
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
-
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
-
-    appended_arr = np.concatenate((arr, reversed_arr))
+from utils.broker import open_instrument, BrokerInstrument
+from utils.keithley_6517 import run_6517_buffered_sweep, run_6517_pilot_sweep, estimate_6517_currents, \
+    plan_6517_current_ranges
+from utils.timing import summarize_sampling, print_sampling_summary
+from utils.waveforms import append_reverse
 
-    return appended_arr
+# ---
 
 def if_not_create(filepath):
     if not os.path.exists(filepath):
         os.makedirs(filepath)
 
-def generate_bipolar_square_wave(Vmax, n_cycles):
-    """
-    Generate a bipolar square wave of voltages.
-
-    Parameters:
-        Vmax (float): Maximum voltage value.
-        n_cycles (int): Number of cycles of the waveform.
-
-    Returns:
-        numpy.ndarray: An array of the voltage values representing the bipolar square wave.
-    """
-    # Define one full cycle of the bipolar square wave
-    single_cycle = [0, Vmax, 0, -Vmax, 0]
-
-    # Repeat the single cycle 'n_cycles' times
-    bipolar_wave = np.tile(single_cycle, n_cycles)
-
-    return bipolar_wave
-
 
 # ---
 # inputs
@@ -73,6 +47,15 @@ NPLC = 10  # (default = 1) Set integration rate in line cycles (0.01 to 10)
 elements_sense = 'READ,TST,VSO'  # Current, Timestamp, Voltage Source
 idxC, idxT, idxV = 0, 1, 2
 num_elements = len(elements_sense.split(','))
+# LOOP: :SOUR:VOLT + :FETCh? per point; TIMER, TSEQ: readings are stored in the buffer and read once at the end
+sweep_engine = 'LOOP'
+step_time = 0.5  # (s) dwell time at each voltage (TIMER, TSEQ)
+sampling_interval = None  # (s) (TIMER only) time between readings (default: one reading per step)
+# RANGING: None = fixed range (Imax); 'PILOT' = plan the current range of each step from a fast autoranged pilot sweep;
+# path to a previous run of the same device (.xlsx exported below) = plan from that run's currents
+range_plan = None
+range_headroom = 1.25  # each range must be >= range_headroom x |expected current|
+range_min_points = 1  # (>1) hold a range for at least this many steps (fewer range changes)
 
 assm = '05312025_W13-A3_Pad-Only' # C18-30pT-25+10nmAu
 tid = 21
@@ -98,7 +81,18 @@ print("Min. total sampling time ({} samples): {} s".format(num_points, np.round(
 
 # open instrument
 rm = pyvisa.ResourceManager()
-k3 = rm.open_resource('GPIB{}::{}::INSTR'.format(BoardIndex, GPIB))
+# NOTE: if the instrument broker is running (python -m utils.broker), the session is kept open between runs
+use_broker = True
+k3 = open_instrument(rm, 'GPIB{}::{}::INSTR'.format(BoardIndex, GPIB), use_broker=use_broker)
+# If the broker shadows settings (--shadow or --skip-reset), only settings that changed since the last run are sent,
+# and with --skip-reset, *RST is skipped too.
+# NOTE: *RST is only skipped if every setting of the last run is verified against the instrument.
+reuse_instrument_state = True
+if isinstance(k3, BrokerInstrument):
+    if reuse_instrument_state:
+        print("Settings changed since the last run (if any, *RST is sent): {}".format(k3.verify()))
+    else:
+        k3.invalidate()
 k3.timeout = 5 * 1000
 
 # RESET to defaults
@@ -162,15 +156,33 @@ time_started = current_time.strftime('%H:%M:%S')
 
 # Execute configured measurement
 k3.write('OUTP ON')         # Turn source ON
+
+# plan the current range of each step (range changes are only written where needed)
+ranges = None
+if range_plan == 'PILOT':
+    expected_currents = run_6517_pilot_sweep(k3, Vs, step_time)
+elif range_plan is not None:
+    data_previous = pd.read_excel(range_plan, index_col=0).to_numpy()
+    expected_currents = estimate_6517_currents(Vs, data_previous[:, idxV], data_previous[:, idxC])
+if range_plan is not None:
+    ranges = plan_6517_current_ranges(expected_currents, headroom=range_headroom, min_points=range_min_points)
+    print("Current ranges: {}".format(ranges))
+
 k3.write(':SYST:TST:REL:RES')   # Reset relative timestamp to zero seconds
-k3.write(':INIT')           # Move from IDLE state to ARM Layer 1
 
-data = []
-for Vapp in Vs:
-    k3.write(':SOUR:VOLT ' + str(Vapp))  # Set voltage level
-    meas = k3.query_ascii_values(':FETCh?')
-    print(meas)
-    data.append(meas)
+if sweep_engine == 'LOOP':
+    k3.write(':INIT')           # Move from IDLE state to ARM Layer 1
+    data = []
+    for i, Vapp in enumerate(Vs):
+        if ranges is not None and (i == 0 or ranges[i] != ranges[i - 1]):
+            k3.write(':SENS:CURR:RANG ' + str(ranges[i]))  # Select current range
+        k3.write(':SOUR:VOLT ' + str(Vapp))  # Set voltage level
+        meas = k3.query_ascii_values(':FETCh?')
+        print(meas)
+        data.append(meas)
+else:
+    data = run_6517_buffered_sweep(k3, Vs, step_time, sampling_interval=sampling_interval, mode=sweep_engine,
+                                   ranges=ranges)
 
 k3.write(':SOUR:VOLT 0')    # Set voltage level to 0
 """time.sleep(0.05)
@@ -188,7 +200,7 @@ k3.close()                  # close instrument
 # POST-PROCESSING
 
 # reshape array
-data_struct = np.reshape(data, (num_points, num_elements))
+data_struct = np.reshape(data, (-1, num_elements))
 num_samples = len(data_struct[:, 1])
 t_total = data_struct[-1, 1] - data_struct[0, 1]
 ramp_rate = Vmax / (t_total / 2)
@@ -200,6 +212,7 @@ print("Voltage ramp rate: {} V/s".format(np.round(ramp_rate, 2)))
 print("Sampling rate: {} ms".format(np.round(sampling_rate * 1e3, 2)))
 print("Sampling frequency: {} Hz".format(np.round(sampling_freq, 1)))
 print("Min. total sampling time ({} samples): {} s".format(num_samples, np.round(t_total, 3)))
+print_sampling_summary(summarize_sampling(data_struct[:, idxT]), label='Actual ({})'.format(sweep_engine))
 
 # ---
 
@@ -5,97 +5,54 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import pyvisa
 import time
+import queue
+import threading
 
+from utils.keithley_6517 import parse_ascii, setup_6517_buffer_full_srq, wait_for_6517_buffer_full, drain_6517_buffer, \
+    ZeroCorrectCache
+from utils.scpi import BatchWriter, dict_max_message_length, wait_for_operation_complete
 
-dict_ascii_lut = {
-    'VDC': 'Volts',
-    'ADC': 'Amps',
-    'OHM': 'Ohms',
-    'N': 'Normal',
-    'Z': 'ZeroCheckEnabled',
-    'O': 'Overflow',
-    'U': 'Underflow',
-    'R': 'Reference(Rel)',
-    'L': 'OutOfLimit',
-}
-
-dict_dtypes = {
-    'num': int,
-    'status': str,
-    'timestamp': float,
-    'voltage': float,
-    'measure': float,
-    'units': str,
-}
-
-def parse_ascii_readings(s):
-    c, u, st = [], [], []
-    for x in s:
-        curr, other = x.split('E')
-        exp, su = other[:3], other[3:]
-        curr, status, units = float(curr + 'E' + exp), su[0], su[1:]
-        c.append(curr)
-        u.append(dict_ascii_lut[units])
-        st.append(dict_ascii_lut[status])
-    return c, u, st
-
-
-def parse_ascii(d, e, as_type='pd.DataFrame'):
-    d = d.replace("\n", "").split(',')  # remove trailing newline character
-    e = e.split(',')  # split data elements
-    # - reshape
-    num_vals = len(d)
-    num_elem = len(e) - 2  # minus 2 because three data elements are buried within a single ','
-    num_meas = num_vals // num_elem
-    d = np.reshape(d, (num_meas, num_elem))
-    # - get list of individual data elements
-    readings = d[:, 0]
-    timestamps = d[:, 1]
-    reading_nums = d[:, 2]
-    voltages = d[:, 3]
-    # - parse
-    curr, units, status = parse_ascii_readings(readings)
-    timestamps = [float(x[:-4]) for x in timestamps]
-    reading_nums = [int(x[:-5]) for x in reading_nums]
-    voltages = [float(x[:-4]) for x in voltages]
-    # - reshape
-    d = np.vstack([reading_nums, status, timestamps, voltages, curr, units]).T
-
-    if as_type == 'pd.DataFrame':
-        d = pd.DataFrame(d, columns=['num', 'status', 'timestamp', 'voltage', 'measure', 'units'])
-        d = d.astype(dict_dtypes)
-
-    return d
-
+# (s) time for the input to settle after zero check is turned off or the source is turned on
+# NOTE: *OPC only waits for the commands to be processed, not for the input to settle
+input_settle_time = 0.5
 
 # ----------------------------------------------------------------------------------------------------------------------
 # ----------------------------------------------------------------------------------------------------------------------
 
-def wrapper_6517a_test_sequence(keithley_inst, test_type, dict_sense, set_timeout, **kwargs):
+def wrapper_6517a_test_sequence(keithley_inst, test_type, dict_sense, set_timeout, zero_correct_cache=None, **kwargs):
     num_points = kwargs['num_points']
 
+    # NOTE: setup commands are joined into a few semicolon-separated messages (one GPIB transaction each)
+    max_length = dict_max_message_length['6517a']
     # --- INITIALIZE KEITHLEY 6517a
-    initialize_6517a(keithley_inst, nplc=dict_sense['nplc'], set_timeout=set_timeout)
-    # -
-    # --- PERFORM ZERO CORRECT
-    perform_6517a_zero_correct(keithley_inst)
-    # -
-    # --- DEFINE TRIGGER MODEL
-    setup_6517a_trigger_model(keithley_inst, num_points)
-    # -
-    # --- DEFINE BUFFER CONTROL
-    setup_6517a_buffer_control(keithley_inst, num_points)
+    with BatchWriter(keithley_inst, max_length=max_length) as keithley_batch:
+        initialize_6517a(keithley_batch, nplc=dict_sense['nplc'], set_timeout=set_timeout)
     # -
-    # --- DEFINE SENSE FUNCTIONS
-    setup_6517a_sense_functions(keithley_inst, dict_sense)
+    # --- PERFORM ZERO CORRECT (not batched because it waits for each step to complete)
+    if zero_correct_cache is None:
+        perform_6517a_zero_correct(keithley_inst)
+    elif zero_correct_cache.ensure(keithley_inst, current_range=dict_sense['rang']):
+        print("Zero correction acquired on the {} A range.".format(dict_sense['rang']))
+    else:
+        print("Zero correction reused (acquired less than {} s ago).".format(zero_correct_cache.max_age))
     # -
-    # --- DEFINE TEST SEQUENCE
-    setup_6517a_test_sequence(keithley_inst, test_type, **kwargs)
+    with BatchWriter(keithley_inst, max_length=max_length) as keithley_batch:
+        # --- DEFINE TRIGGER MODEL
+        setup_6517a_trigger_model(keithley_batch, num_points)
+        # -
+        # --- DEFINE BUFFER CONTROL
+        setup_6517a_buffer_control(keithley_batch, num_points)
+        # -
+        # --- DEFINE SENSE FUNCTIONS
+        setup_6517a_sense_functions(keithley_batch, dict_sense)
+        # -
+        # --- DEFINE TEST SEQUENCE
+        setup_6517a_test_sequence(keithley_batch, test_type, **kwargs)
     # -
     # --- PERFORM TEST SEQUENCE and RETRIEVE DATA FROM BUFFER
-    data = perform_6517a_test_sequence(keithley_inst, test_type, **kwargs)
+    df = perform_6517a_test_sequence(keithley_inst, test_type, **kwargs)
 
-    return data
+    return df
 
 
 def initialize_6517a(keithley_inst, nplc, set_timeout):
@@ -277,48 +234,59 @@ def perform_6517a_test_sequence(keithley_inst, test_type, **kwargs):
     # - Turn zero check off only immediately before test (i.e., after specifying all functions)
     # see page 79-81 of manual for zero correct procedure
     keithley_inst.write(':SYST:ZCH OFF')  # Enable (ON) or disable (OFF) zero check (default: OFF)
-    time.sleep(0.05)
     keithley_inst.write(':SYST:ZCOR ON')  # Enable (ON) or disable (OFF) zero correct (default: OFF)
-    time.sleep(0.1)
+    wait_for_operation_complete(keithley_inst, timeout=5)
+    time.sleep(input_settle_time)
     what_zero_correct = keithley_inst.query(':SYST:ZCOR?')
     print("Zero Correct: {}".format(what_zero_correct))
 
     # ---
 
+    # - Request service when the buffer is full (i.e., measurements done recording)
+    setup_6517_buffer_full_srq(keithley_inst)
+
     # - Start test sequence
     keithley_inst.write("TSEQ:ARM")  # Arm the selected test sequence
 
-    # --- Wait for buffer full (i.e., measurements done recording)
-    """
-    There seem to be three ways of doing this: *SRQ, *OPC?, and inputting a manual time delay (e.g., time.sleep(3))
-    I have only figured out how to do the manual time delay but page 238 of the manual describes a method to use
-    *OPC?, although this didn't work for me. I think because of how I set up the trigger model. 
-    """
-    # --- Dump buffer readings to computer CRT:
-    if test_type == 'ALTP':
-        num_meas = kwargs['number_of_readings_to_store']
-        sleep_time = kwargs['sleep_before_read_buffer']
-        sleep_dt = sleep_time / 4
-        dt0 = 0
-        data = ""
-        for i in range(num_meas):
-            dt = 0
-            for j in range(4):
-                time.sleep(sleep_dt)
-                dt += sleep_dt
-                dt0 += sleep_dt
-                print("Time elapsed: {} s/meas, {} s total".format(dt, dt0))
-            datum = keithley_inst.query(":TRAC:LAST?")
-            print(datum)
-            if i == 0:
-                data = datum.replace("\n", "")
-            else:
-                data = "{},{}".format(data, datum.replace("\n", ""))
+    timeout = kwargs.get('buffer_full_timeout', keithley_inst.timeout / 1000)
+    data_elements = keithley_inst.query(':FORMat:ELEM?')
+    if kwargs.get('drain_interval') is not None:
+        # --- Read new readings while the buffer is filling (e.g., ALTP tests that run for hours)
+        consumer_queue = queue.Queue()
+        monitor = threading.Thread(target=print_buffer_chunks, args=(consumer_queue,), daemon=True)
+        monitor.start()
+        df = drain_6517_buffer(keithley_inst, num_points=kwargs['num_points'], data_elements=data_elements,
+                               poll_interval=kwargs['drain_interval'], timeout=timeout,
+                               consumer_queue=consumer_queue)
+        monitor.join()
+        keithley_inst.query(':STAT:MEAS:EVEN?')  # Clear the Buffer Full event
     else:
+        # --- Wait for buffer full
+        """
+        *OPC? does not work here because the test sequence is "complete" as soon as it is armed. Instead, the Buffer
+        Full bit of the Measurement Event Register is summarized in the status byte (see page 296 of 6517b manual),
+        which is serial polled (or SRQ, if use_srq=True) so the buffer is read as soon as the last reading is stored.
+        """
+        wait_for_6517_buffer_full(keithley_inst, timeout=timeout, use_srq=kwargs.get('use_srq', False),
+                                  callback=lambda status_byte, elapsed: print("Buffer full after {} s".format(
+                                      np.round(elapsed, 2))))
+        # --- Dump buffer readings to computer CRT:
         data = keithley_inst.query(":TRAC:DATA?")
         print(data)
+        df = parse_ascii(d=data, e=data_elements, as_type='pd.DataFrame')
+
+    return df
+
 
-    return data
+def print_buffer_chunks(consumer_queue):
+    """ Print each chunk of readings put on the queue by drain_6517_buffer(), until the buffer is full (None). """
+    while True:
+        item = consumer_queue.get()
+        if item is None:
+            break
+        start, chunk = item
+        for i in range(len(chunk['measure'])):
+            print("{}: {}".format(start + i, {k: v[i] for k, v in chunk.items()}))
 
 
 def perform_6517a_zero_correct(keithley_inst):
@@ -338,9 +306,10 @@ def perform_6517a_zero_correct(keithley_inst):
     keithley_inst.write('OUTP ON')  # Turn source ON
     # k3.write(':INIT')  # Move from IDLE state to ARM Layer 1
     # k3.write(':SOUR:VOLT 0')  # Set voltage level to 0
-    time.sleep(0.5)
+    wait_for_operation_complete(keithley_inst, timeout=5)
+    time.sleep(input_settle_time)
     keithley_inst.write(':SYST:ZCOR:ACQ')  # Acquire zero correction value (could not get this function to work)
-    time.sleep(0.5)
+    wait_for_operation_complete(keithley_inst, timeout=5)
     # keithley_inst.write(':SYST:ZCOR ON')  # Enable (ON) or disable (OFF) zero correct (default: OFF)
     keithley_inst.write(':OUTP OFF')  # turn output off
     keithley_inst.write(':SYST:ZCH ON')  # Enable (ON) or disable (OFF) zero check (default: OFF)
@@ -394,6 +363,9 @@ if __name__ == "__main__":
     # open instrument
     k1_source_GPIB, k1_source_board_index = 24, 0  # Keithley 6517a electrometer
     k1 = rm.open_resource('GPIB{}::{}::INSTR'.format(k1_source_board_index, k1_source_GPIB))
+    # zero correct only when the last correction is older than max_age (s) or was acquired on another range
+    # NOTE: after power cycling the 6517, call zero_correct_cache.invalidate()
+    zero_correct_cache = ZeroCorrectCache(max_age=3600)
 
     # ---
     # -
@@ -470,11 +442,12 @@ if __name__ == "__main__":
         dict_settings.update(dict_sense)
         # -
         # --- Perform test sequence
-        data = wrapper_6517a_test_sequence(
+        df = wrapper_6517a_test_sequence(
             keithley_inst=k1,
             test_type=test_type,
             dict_sense=dict_sense,
             set_timeout=estimated_timeout,
+            zero_correct_cache=zero_correct_cache,
             high_voltage_level=high_voltage_level,
             time_at_high_level=time_at_high_level,
             low_voltage_level=low_voltage_level,
@@ -509,11 +482,12 @@ if __name__ == "__main__":
         dict_settings.update(dict_sense)
         # -
         # --- Perform test sequence
-        data = wrapper_6517a_test_sequence(
+        df = wrapper_6517a_test_sequence(
             keithley_inst=k1,
             test_type=test_type,
             dict_sense=dict_sense,
             set_timeout=estimated_timeout,
+            zero_correct_cache=zero_correct_cache,
             start_voltage=start_voltage,
             stop_voltage=stop_voltage,
             step_voltage=step_voltage,
@@ -540,11 +514,12 @@ if __name__ == "__main__":
         dict_settings.update(dict_sense)
         # -
         # --- Perform test sequence
-        data = wrapper_6517a_test_sequence(
+        df = wrapper_6517a_test_sequence(
             keithley_inst=k1,
             test_type=test_type,
             dict_sense=dict_sense,
             set_timeout=estimated_timeout,
+            zero_correct_cache=zero_correct_cache,
             bias_voltage=bias_voltage,
             number_of_readings=number_of_readings,
             time_interval=time_interval,
@@ -565,9 +540,9 @@ if __name__ == "__main__":
         # set PyVisa timeout
         estimated_meas_time = \
             ((number_of_readings_to_discard + number_of_readings_to_store + 4) * measure_time)  # (s)
-        sleep_before_read_buffer = estimated_meas_time * 1.1
+        buffer_full_timeout = estimated_meas_time * 1.1 + 5  # (s) estimated_meas_time includes every reading
         estimated_timeout = number_of_readings_to_store * estimated_meas_time * 1.5 * 1000
-        print("Sleep time before read buffer: {} s".format(sleep_before_read_buffer))
+        print("Buffer full timeout: {} s".format(buffer_full_timeout))
         print("PyVISA timeout set to: {} s".format(estimated_timeout / 1000))
         # --- export settings
         dict_settings = {
@@ -577,25 +552,28 @@ if __name__ == "__main__":
             'number_of_readings_to_discard': number_of_readings_to_discard,
             'number_of_readings_to_store': number_of_readings_to_store,
             'num_points': number_of_readings_to_store,
-            'sleep_before_read_buffer': sleep_before_read_buffer,
+            'buffer_full_timeout': buffer_full_timeout,
+            'drain_interval': measure_time,
         }
         dict_settings.update(dict_sense)
         # -
         # --- Perform test sequence
-        data = wrapper_6517a_test_sequence(
+        df = wrapper_6517a_test_sequence(
             keithley_inst=k1,
             test_type=test_type,
             dict_sense=dict_sense,
             set_timeout=estimated_timeout,
+            zero_correct_cache=zero_correct_cache,
             offset_voltage=offset_voltage,
             alternating_voltage=alternating_voltage,
             measure_time=measure_time,
             number_of_readings_to_discard=number_of_readings_to_discard,
             number_of_readings_to_store=number_of_readings_to_store,
             num_points=number_of_readings_to_store,
-            sleep_before_read_buffer=sleep_before_read_buffer,
+            buffer_full_timeout=buffer_full_timeout,
+            drain_interval=measure_time,
         )
-        # NOTE: use command :TRAC:LAST? to read the last reading stored in buffer (applies only to ALTP test)
+        # NOTE: readings are read from the buffer every measure_time while the test runs (see drain_6517_buffer)
     else:
         raise ValueError("Only 'SQSW', 'STSW', 'CLE', and 'ALTP' test are implemented.")
     # -
@@ -603,8 +581,6 @@ if __name__ == "__main__":
     # k3.close()  # close instrument
     # -
     # --- parse, package, and export
-    data_elements = k1.query(':FORMat:ELEM?')
-    df = parse_ascii(d=data, e=data_elements, as_type='pd.DataFrame')
     df_settings = pd.DataFrame.from_dict(data=dict_settings, orient='index')
 
     file = join(save_dir, '{}_data.xlsx'.format(save_id))
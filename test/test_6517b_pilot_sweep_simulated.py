@@ -0,0 +1,63 @@
+"""
+Run a pilot sweep (run_6517_pilot_sweep) on the simulated 6517b, then the :SOUR:VOLT + :FETCh? loop of
+damien_IV_sweep_keithley_6517b.py (sweep_engine='LOOP', range_plan='PILOT'). The loop must read the same data
+elements it was set up with, i.e., the pilot must restore every setting it changes.
+
+    python -m pytest test/test_6517b_pilot_sweep_simulated.py  (or: python test/test_6517b_pilot_sweep_simulated.py)
+"""
+import numpy as np
+
+from utils.simulated import get_resource_manager
+from utils.keithley_6517 import run_6517_pilot_sweep, plan_6517_current_ranges, pilot_sweep_settings
+
+
+def setup_6517b_loop(k3, num_points, Imax=20e-9):
+    """ Subset of the setup in damien_IV_sweep_keithley_6517b.py """
+    k3.write('*RST')
+    k3.write(':SYST:ZCOR ON')
+    k3.write(':SYST:ZCH OFF')
+    k3.write(':TRAC:FEED:CONT NEV')
+    k3.write(':FORM:DATA ASCii')
+    k3.write(':FORM:ELEM READ,TST,VSO')
+    k3.write(':INIT:CONT OFF')
+    k3.write(':TRIG:COUN ' + str(num_points))
+    k3.write(':TRIG:SOUR IMM')
+    k3.write(':SOUR:VOLT:MCON ON')
+    k3.write(':SOUR:VOLT 0')
+    k3.write(':SENS:FUNC "CURR"')
+    k3.write(':SENS:CURR:NPLC 1')
+    k3.write(':SENS:CURR:RANG:AUTO OFF')
+    k3.write(':SENS:CURR:RANG ' + str(Imax))
+    k3.write('OUTP ON')
+
+
+def test_pilot_then_loop_fetch():
+    Vs = np.array([0, 50, 100, 50, 0], dtype=float)
+    rm = get_resource_manager('@lab-sim', time_scale=0.05, seed=0)
+    k3 = rm.open_resource('GPIB0::27::INSTR')
+    k3.timeout = 20 * 1000
+    setup_6517b_loop(k3, num_points=len(Vs))
+    settings = {x: k3.query(x + '?').strip() for x in pilot_sweep_settings}
+
+    ranges = plan_6517_current_ranges(run_6517_pilot_sweep(k3, Vs, step_time=0.5))
+    assert {x: k3.query(x + '?').strip() for x in pilot_sweep_settings} == settings
+
+    k3.write(':INIT')
+    data = []
+    for i, Vapp in enumerate(Vs):
+        if i == 0 or ranges[i] != ranges[i - 1]:
+            k3.write(':SENS:CURR:RANG ' + str(ranges[i]))
+        k3.write(':SOUR:VOLT ' + str(Vapp))
+        data.append(k3.query_ascii_values(':FETCh?'))
+    k3.write(':SOUR:VOLT 0')
+    k3.write(':OUTP OFF')
+    rm.close()
+
+    data = np.array(data, dtype=float)
+    assert data.shape == (len(Vs), 3)  # READ, TST, VSO
+    assert np.all(np.diff(data[:, 1]) >= 0)
+
+
+if __name__ == '__main__':
+    test_pilot_then_loop_fetch()
+    print("OK")
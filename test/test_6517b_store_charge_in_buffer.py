@@ -1,72 +1,12 @@
 from os.path import join
 import os
-import time
-import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from pymeasure.instruments.keithley import Keithley6517B
 import pyvisa
 
-dict_ascii_lut = {
-    'VDC': 'Volts',
-    'ADC': 'Amps',
-    'OHM': 'Ohms',
-    'COUL': 'Coulombs',
-    'N': 'Normal',
-    'Z': 'ZeroCheckEnabled',
-    'O': 'Overflow',
-    'U': 'Underflow',
-    'R': 'Reference(Rel)',
-    'L': 'OutOfLimit',
-}
-
-dict_dtypes = {
-    'num': int,
-    'status': str,
-    'timestamp': float,
-    'voltage': float,
-    'measure': float,
-    'units': str,
-}
-
-def parse_ascii_readings(s):
-    c, u, st = [], [], []
-    for x in s:
-        curr, other = x.split('E')
-        exp, su = other[:3], other[3:]
-        curr, status, units = float(curr + 'E' + exp), su[0], su[1:]
-        c.append(curr)
-        u.append(dict_ascii_lut[units])
-        st.append(dict_ascii_lut[status])
-    return c, u, st
-
-
-def parse_ascii(d, e, as_type='pd.DataFrame'):
-    d = d.replace("\n", "").split(',')  # remove trailing newline character
-    e = e.split(',')  # split data elements
-    # - reshape
-    num_vals = len(d)
-    num_elem = len(e) - 2  # minus 2 because three data elements are buried within a single ','
-    num_meas = num_vals // num_elem
-    d = np.reshape(d, (num_meas, num_elem))
-    # - get list of individual data elements
-    readings = d[:, 0]
-    timestamps = d[:, 1]
-    reading_nums = d[:, 2]
-    voltages = d[:, 3]
-    # - parse
-    curr, units, status = parse_ascii_readings(readings)
-    timestamps = [float(x[:-4]) for x in timestamps]
-    reading_nums = [int(x[:-5]) for x in reading_nums]
-    voltages = [float(x[:-4]) for x in voltages]
-    # - reshape
-    d = np.vstack([reading_nums, status, timestamps, voltages, curr, units]).T
-
-    if as_type == 'pd.DataFrame':
-        d = pd.DataFrame(d, columns=['num', 'status', 'timestamp', 'voltage', 'measure', 'units'])
-        d = d.astype(dict_dtypes)
-
-    return d
+from utils.keithley_6517 import parse_ascii, setup_6517_buffer_full_srq, wait_for_6517_buffer_full
+from utils.timing import DeadlineScheduler
 
 # ----------------------------------------------------------------------------------------------------------------------
 # ----------------------------------------------------------------------------------------------------------------------
@@ -174,7 +114,9 @@ if __name__ == "__main__":
     SLEEP_ORDER = 'INIT+SOURCE 0V+START BUFFER, SOURCE {}V, SOURCE 0V'.format(SOURCE_VOLTAGE)
     SLEEP_AFTER_INIT = 0.25
     SLEEP_AFTER_SOURCE_V = 2.0
-    SLEEP_AFTER_SOURCE_0V = 2.0
+    # after sourcing 0V, wait until the buffer is full (SENSE_NUM_SAMPLES readings) instead of a fixed sleep
+    BUFFER_FULL_TIMEOUT = 10.0
+    USE_SRQ = False  # True: block on GPIB SRQ; False: serial poll the status byte
 
     # ---
     SAVE_ID = '{}_tid{}_{}V_{}NPLC_test-{}'.format(R_LABEL, TID, SOURCE_VOLTAGE, SENSE_NPLC, TEST_TYPE)
@@ -198,7 +140,7 @@ if __name__ == "__main__":
         'sleep_order': SLEEP_ORDER,
         'sleep_after_init': SLEEP_AFTER_INIT,
         'sleep_after_source_v': SLEEP_AFTER_SOURCE_V,
-        'sleep_after_source_0v': SLEEP_AFTER_SOURCE_0V,
+        'buffer_full_timeout': BUFFER_FULL_TIMEOUT,
     }
 
     # ------------------------------------------------------------------------------------------------------------------
@@ -268,6 +210,9 @@ if __name__ == "__main__":
     keithley.write(':TRIG:COUNT ' + str(SENSE_NUM_SAMPLES))
     keithley.write(':TRIG:DELAY 0')
     keithley.write(':TRACE:FEED:CONT NEXT')  # specify buffer control: fill and stop.
+    # request service when the buffer is full (status registers are polled through the underlying pyvisa resource)
+    keithley_visa = keithley.adapter.connection
+    setup_6517_buffer_full_srq(keithley_visa)
 
     # ------------------------------------------------------------------------------------------------------------------
     # EXECUTE MEASUREMENT
@@ -280,13 +225,16 @@ if __name__ == "__main__":
     print("Buffer points: {}".format(keithley.buffer_points))
     # print("resistance: {}".format(keithley.resistance))
     # -
-    time.sleep(SLEEP_AFTER_INIT)
-
-    keithley.write(':SOUR:VOLT ' + str(SOURCE_VOLTAGE))
-    time.sleep(SLEEP_AFTER_SOURCE_V)
-
-    keithley.write(':SOUR:VOLT 0')
-    time.sleep(SLEEP_AFTER_SOURCE_0V)
+    # source writes are timed against deadlines, so the pulse width does not include the write latency
+    scheduler = DeadlineScheduler(name='6517b')
+    scheduler.start()
+    scheduler.run_at(SLEEP_AFTER_INIT, keithley.write, ':SOUR:VOLT ' + str(SOURCE_VOLTAGE))
+    scheduler.run_at(SLEEP_AFTER_INIT + SLEEP_AFTER_SOURCE_V, keithley.write, ':SOUR:VOLT 0')
+    scheduler.print_jitter_summary()
+    DICT_SETTINGS['time_after_source_0v'] = wait_for_6517_buffer_full(
+        keithley_visa, timeout=BUFFER_FULL_TIMEOUT, use_srq=USE_SRQ,
+        callback=lambda status_byte, elapsed: elapsed,
+    )
 
     keithley.stop_buffer()  # Stop storing readings
     """ Aborts the buffering measurement, by stopping the measurement
@@ -1,123 +1,76 @@
 import os
 from os.path import join
 import numpy as np
-from scipy import signal
 import pandas as pd
 import matplotlib.pyplot as plt
 import pyvisa
 import time
 
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
-    appended_arr = np.concatenate((arr, reversed_arr))
-    return appended_arr
-
-def visualize_staircase_levels(sampled_time, sampled_levels, leading_edge, slew_rate=0.001):
-    # add time points to show V(t) in between current sampling times
-    if leading_edge is True:
-        t_steps = sampled_time[1:] - slew_rate
-        l_steps = sampled_levels[:-1]
-    else:
-        t_steps = sampled_time[:-1] + slew_rate
-        l_steps = sampled_levels[1:]
-    # concat
-    stair_time = np.concatenate((t_steps, sampled_time))
-    stair_levels = np.concatenate((l_steps, sampled_levels))
-    # sort by time
-    stair_time, stair_levels = list(zip(*sorted(zip(stair_time, stair_levels))))
-    return stair_time, stair_levels
-
-def repeat_n_cycles(arr, n, join_smooth=False):
-    if join_smooth:
-        arr_cycles = np.tile(arr[:-1], n)
-        arr_cycles = np.append(arr_cycles, arr[-1])
-    else:
-        arr_cycles = np.tile(arr, n)
-    return arr_cycles
+from utils.agilent_33210a import render_33210a_stimulus, ArbWaveformCache, setup_33210a_stimulus, \
+    start_33210a_stimulus, ideal_33210a_output
+from utils.command_queue import ScheduledCommandQueue
+from utils.scpi import BatchWriter, dict_max_message_length
+from utils.timing import DeadlineScheduler, RunDurationModel
+from utils.trace import SCPITracer
+from utils.waveforms import append_reverse, repeat_n_cycles, staircase_trace
+
+def awg_amplitude_schedule(settings):
+    """ AWG amplitude (Vpp) and dwell time (s) of each step of the external amplitude modulation. """
+    awg_voltages = repeat_n_cycles(arr=settings['awg_mod_ampl_values'], n=settings['awg_mod_ampl_cycles'],
+                                   join_smooth=True)
+    awg_dwell_times = repeat_n_cycles(arr=settings['awg_mod_dwell_values'], n=settings['awg_mod_ampl_cycles'],
+                                      join_smooth=True)
+    return awg_voltages, awg_dwell_times
 
 def replace_amplitude_if_out_of_range(arr, min_amplitude):
     arr = np.where(arr < min_amplitude, min_amplitude, arr)
     return arr
 
-def waveform_square(t, amplitude, frequency, offset=0):
-    return amplitude * signal.square(2 * np.pi * frequency * t) + offset
-
-def waveform_sine(t, amplitude, frequency, offset=0):
-    return amplitude * np.sin(2 * np.pi * frequency * t) + offset
-
-def waveform_sawtooth(t, amplitude, frequency, offset=0):
-    return amplitude * signal.sawtooth(2 * np.pi * frequency * t) + offset
-
-def waveform_triangle(t, amplitude, frequency, offset=0):
-    return amplitude * signal.sawtooth(2 * np.pi * frequency * t, width=0.5) + offset
-
-def waveform_empty(t, amplitude, frequency, offset=0):
-    return np.zeros_like(t)
-
-def agilent_waveform(t, settings):
-
-    if settings['awg_mod_state'] == 'ON':
-        if settings['awg_mod_wave'] == 'SQU':
-            mod_func = waveform_square
-        elif settings['awg_mod_wave'] == 'SIN':
-            mod_func = waveform_sine
-        else:
-            mod_func = waveform_empty
-        amplitude = mod_func(
-            t=t,
-            amplitude=settings['output_volt'],
-            frequency=settings['awg_mod_freq'],
-            offset=0,
-        )
-    else:
-        amplitude = settings['output_volt']
-
-    if settings['awg_wave'] == 'SQU':
-        wave_func = waveform_square
-    elif settings['awg_wave'] == 'SIN':
-        wave_func = waveform_sine
-    else:
-        wave_func = waveform_empty
-    signal = wave_func(
-        t=t,
-        amplitude=amplitude,
-        frequency=settings['awg_freq'],
+def ideal_output_reference(settings, df_in, t_f, bands=True):
+    """ Ideal TREK output (carrier x internal or external amplitude modulation), at display resolution. """
+    envelope = None
+    if settings['awg_mod_ampl_ext'] == 'ON':
+        # external amplitude modulation: the AWG amplitude steps that were actually written (relative to output_volt)
+        envelope = (df_in['dt'].to_numpy(),
+                    df_in['awg_volt'].to_numpy() * settings['amplifier_gain'] / settings['output_volt'])
+    return ideal_33210a_output(
+        t_end=t_f,
+        carrier=settings['awg_wave'],
+        carrier_freq=settings['awg_freq'],
+        amplitude=settings['output_volt'],
         offset=settings['output_dc_offset'],
+        duty_cycle=settings['awg_square_duty_cycle'],
+        mod_func=settings['awg_mod_wave'] if settings['awg_mod_state'] == 'ON' else None,
+        mod_freq=settings['awg_mod_freq'],
+        envelope=envelope,
+        bands=bands,
     )
-    return signal
 
 
-def plot_arbitrary_waveform_monitor_and_monitor(df_in, df_out, settings, show_plot=True):
+def plot_arbitrary_waveform_monitor_and_monitor(df_in, df_out, settings, show_plot=True, ideal_bands=True):
     # df_in.columns = ['awg_volt', 'dt']
     pxi, pyi = 'dt', 'awg_volt'
     # df_out.columns = ['READ', 'TST', 'READ_ZCOR', 'MEAS_ZCOR']
     px, py1, py2 = 'TST', 'READ_ZCOR', 'MEAS_ZCOR'
 
     # input amplitude
-    inp_t, inp_v = visualize_staircase_levels(
-        sampled_time=df_in[pxi], sampled_levels=df_in[pyi],
-        leading_edge=True, slew_rate=0.001,
-    )
+    inp_t, inp_v = staircase_trace(df_in[pxi], df_in[pyi], edge_time=0.001, edge='leading')
 
     # sampled waveform
     t_i, t_f = df_out[px].iloc[0], df_out[px].iloc[-1]
     num_samples = len(df_out)
     samples_per_second = np.round(num_samples / t_f, 2)
 
-    # ideal waveform
-    num_samples_ideal = int(np.round(t_f * settings['awg_freq'] * 50))
-    t_ideal = np.linspace(0, t_f, num_samples_ideal, endpoint=False)
-    signal_ideal = agilent_waveform(t=t_ideal, settings=settings)
+    # ideal waveform (min. and max. per pixel column if ideal_bands)
+    ideal = ideal_output_reference(settings, df_in, t_f, bands=ideal_bands)
 
     # plot
     fig, (ax0, ax1, ax2) = plt.subplots(nrows=3, figsize=(10, 10), sharex=True)
 
-    ax0.plot(t_ideal, signal_ideal, '-', color='gray', label='ideal')
+    if ideal_bands:
+        ax0.fill_between(ideal[0], ideal[1], ideal[2], step='mid', color='gray', lw=0, label='ideal')
+    else:
+        ax0.plot(ideal[0], ideal[1], '-', color='gray', label='ideal')
     ax0.set_ylabel(r'$V_{output, max} \: (V)$')
     ax0.grid(alpha=0.2)
     ax0.legend(title='carrier waveform', loc='upper left', fontsize='small')
@@ -209,7 +162,11 @@ def setup_keithley_6517_amplifier_monitor(keithley_inst, settings):
     # -
     integration_period = settings['keithley_nplc'] / 60
     fetch_delay = integration_period * ratio_fetch_to_integration
-    estimated_timeout = settings['keithley_num_samples'] * integration_period  # (seconds)
+    display = 'ON' if settings['keithley_nplc'] > 9.0 else 'OFF'
+    # timeout is predicted from previous runs (falls back to a multiple of the theoretical duration)
+    estimated_timeout = RunDurationModel().timeout('6517a', settings['keithley_num_samples'],
+                                                   nplc=settings['keithley_nplc'], display=display,
+                                                   mode='AMPLIFIER_MONITOR')  # (seconds)
     print("estimated timeout: {} seconds".format(estimated_timeout))
     if settings['keithley_monitor'] == 'CURR':
         monitor_units = '1V/40mA'
@@ -232,6 +189,7 @@ def setup_keithley_6517_amplifier_monitor(keithley_inst, settings):
         'keithley_monitor_to_measure': monitor_to_measure,
         'keithley_measure_units': measure_units,
         'keithley_timeout': estimated_timeout,
+        'keithley_display': display,
     }
     settings.update(keithley_settings)
     # -
@@ -270,10 +228,7 @@ def setup_keithley_6517_amplifier_monitor(keithley_inst, settings):
     keithley_inst.write(':SYST:ZCH ON')  # Enable (ON) or disable (OFF) zero check (default: OFF)
 
     # 4. Set up Sense functions
-    if settings['keithley_nplc'] > 9.0:
-        keithley_inst.write(':DISP:ENAB ON')  # Enable or disable the front-panel display
-    else:
-        keithley_inst.write(':DISP:ENAB OFF')  # Enable or disable the front-panel display
+    keithley_inst.write(':DISP:ENAB ' + display)  # Enable or disable the front-panel display
     # Sense functions
     keithley_inst.write(':SENS:FUNC "VOLT"')  # 'VOLTage[:DC]', 'CURRent[:DC]', 'RESistance', 'CHARge' (default='VOLT:DC')
     keithley_inst.write(':SENS:VOLT:DC:GUARd OFF')  # Disable guard
@@ -330,7 +285,20 @@ def setup_agilent_awg(agilent_inst, settings):
         agilent_inst.write('FUNC:SQU:DCYC ' + str(settings['awg_square_duty_cycle']))  # FUNCtion:SQUare:DCYCle {<percent>|MINimum|MAXimum}
 
     # external amplitude modulation
-    if settings['awg_mod_ampl_ext'] == 'ON':
+    stimulus = None
+    if settings['awg_mod_ampl_ext'] == 'ON' and settings['awg_mod_ampl_mode'] == 'ARB':
+        # the whole amplitude staircase is played by the AWG as an arbitrary waveform (hardware-timed dwell times)
+        awg_voltages, awg_dwell_times = awg_amplitude_schedule(settings)
+        stimulus = render_33210a_stimulus(levels=awg_voltages, dwell_times=awg_dwell_times,
+                                          carrier=settings['awg_wave'], carrier_freq=settings['awg_freq'],
+                                          duty_cycle=settings['awg_square_duty_cycle'])
+        awg_arb_name = ArbWaveformCache(agilent_inst).load(stimulus['dac'])
+        setup_33210a_stimulus(agilent_inst, stimulus, awg_arb_name)
+        settings.update({'awg_arb_name': awg_arb_name, 'awg_arb_mode': stimulus['mode'],
+                         'awg_arb_point_time': stimulus['point_time']})
+        print("AWG stimulus: {} ({} mode), {} s, step time resolution = {} ms".format(
+            awg_arb_name, stimulus['mode'], stimulus['duration'], np.round(stimulus['point_time'] * 1e3, 3)))
+    elif settings['awg_mod_ampl_ext'] == 'ON':
         agilent_inst.write('VOLT ' + str(np.max(settings['awg_mod_ampl_values'])))  # VOLTage {<amplitude>|MINimum|MAXimum}
         agilent_inst.write('VOLT:RANG:AUTO OFF')  # VOLTage:RANGe:AUTO {OFF|ON|ONCE}
         agilent_inst.write('VOLT ' + str(settings['awg_mod_ampl_values'][0]))  # VOLTage {<amplitude>|MINimum|MAXimum}
@@ -346,9 +314,10 @@ def setup_agilent_awg(agilent_inst, settings):
         agilent_inst.write('AM:INT:FUNC ' + AWG_MOD_WAVE)  # SIN, SQU, RAMP, NRAMp, TRI
         agilent_inst.write('AM:INT:FREQ ' + str(AWG_MOD_FREQ))  # 2 mHz to 20 kHz (default: 100 Hz)
         agilent_inst.write('AM:DEPT ' + str(AWG_MOD_DEPTH))  # 0% to 120%, where 0% = Amplitude / 2 and 100% = Amplitude
+    return stimulus
 
 
-def data_acquisition_handler(agilent_inst, keithley_inst, settings, trigger_inst=None):
+def data_acquisition_handler(agilent_inst, keithley_inst, settings, trigger_inst=None, stimulus=None):
     # 0. Trigger Andor camera via trigger instrument
     if trigger_inst is not None:
         trigger_inst.write('OUTP ON')
@@ -359,57 +328,48 @@ def data_acquisition_handler(agilent_inst, keithley_inst, settings, trigger_inst
     keithley_inst.write(':INIT')  # Trigger voltage readings.
     # 2. Start sourcing voltage from arbitrary waveform
     time.sleep(settings['delay_agilent_after_andor'])
-    agilent_inst.write('OUTP ON')  # OUTPut {OFF|ON}
-    # 3. Handle periodic data acquisition
+    if stimulus is None:
+        agilent_inst.write('OUTP ON')  # OUTPut {OFF|ON}
+    # 3. Handle periodic data acquisition (the Keithley is polled every keithley_fetch_delay s, against deadlines)
+    scheduler = DeadlineScheduler(name='6517a')
+    fetch_kwargs = {'args': (':FETCh?',), 'kwargs': {'container': np.array}, 'name': 'FETCh',
+                    'max_count': settings['keithley_num_samples']}
     # external amplitude modulation
-    counts = 0
-    if settings['awg_mod_ampl_ext'] == 'ON':
-        awg_voltages = repeat_n_cycles(
-            arr=settings['awg_mod_ampl_values'],
-            n=settings['awg_mod_ampl_cycles'],
-            join_smooth=True,
-        )
-
-        awg_dwell_times = repeat_n_cycles(
-            arr=settings['awg_mod_dwell_values'],
-            n=settings['awg_mod_ampl_cycles'],
-            join_smooth=True,
-        )
-
-        def _data_acquisition_handler_loop(time_last_meas, data_list, meas_counter):
-            if time.time() > time_last_meas + settings['keithley_fetch_delay'] and meas_counter < settings['keithley_num_samples']:
-                    data_list.append(keithley_inst.query_ascii_values(':FETCh?', container=np.array))
-                    time_last_meas = time.time()
-                    meas_counter += 1
-            return time_last_meas, data_list, meas_counter
-
-        data_input = []
-        data_output = []
-        counts = 0
-        time_init = time.time()
-        time_meas = time_init
-        # trigger_voltages = np.tile(np.array([0, 4]), reps=len(awg_voltages))
-        for v, t_dwell in zip(awg_voltages, awg_dwell_times):  # for v, tv in zip(awg_voltages, trigger_voltages):
-            # trigger_inst.write(':SOUR:VOLT ' + str(tv))  # Specify trigger source voltage
-
-            time_elapsed = time_meas - time_init
-            data_input.append([v, time_elapsed])
-            print("Time Elapsed: {} s, {} V".format(time_elapsed, v))
-
-            agilent_inst.write('VOLT ' + str(v))  # VOLTage
-            tic = time.time()
-
-            while time.time() < tic + t_dwell:  # settings['awg_mod_ampl_dwell']:
-                time_meas, data_output, counts = _data_acquisition_handler_loop(
-                    time_last_meas=time_meas, data_list=data_output, meas_counter=counts,
-                )
+    if stimulus is not None:
+        # hardware-timed: the AWG plays the whole staircase by itself, so only the Keithley is polled
+        awg_voltages, awg_dwell_times = awg_amplitude_schedule(settings)
+        scheduler.start()
+        start_33210a_stimulus(agilent_inst, stimulus)
+        time_start = scheduler.now()
+        data_output = scheduler.poll(keithley_inst.query_ascii_values, settings['keithley_fetch_delay'],
+                                     stimulus['duration'], **fetch_kwargs)
+        # input: amplitude and start time of each step (timed by the AWG clock, from the trigger)
+        data_input = [[v, time_start + t] for v, t in zip(awg_voltages, np.cumsum(awg_dwell_times) - awg_dwell_times)]
+    elif settings['awg_mod_ampl_ext'] == 'ON':
+        awg_voltages, awg_dwell_times = awg_amplitude_schedule(settings)
+
+        # AWG amplitude steps are written by a worker thread at their scheduled times, so the Keithley polling below
+        # keeps its cadence while the AWG is being written to (and vice versa)
+        awg_step_times = np.cumsum(awg_dwell_times) - awg_dwell_times  # start of each step
+        awg_queue = ScheduledCommandQueue(agilent_inst, name='AWG')
+
+        scheduler.start()
+        awg_queue.start(t0=scheduler.t0)
+        awg_queue.schedule_many(['VOLT ' + str(v) for v in awg_voltages], awg_step_times)  # VOLTage
+        data_output = scheduler.poll(keithley_inst.query_ascii_values, settings['keithley_fetch_delay'],
+                                     awg_step_times[-1] + awg_dwell_times[-1], **fetch_kwargs)
+        awg_queue.join(timeout=5)
+        awg_queue.print_log_summary()
+        # input: amplitude and the time (since the start) at which each VOLT write completed
+        df_awg = awg_queue.log()
+        data_input = [[v, t] for v, t in zip(awg_voltages, df_awg['stop'])]
     else:
         data_input = [[0.0, 0.0], [0.0, 0.0]]
-        data_output = []
-        for counts in range(settings['keithley_num_samples']):
-            datum = keithley_inst.query_ascii_values(':FETCh?', container=np.array)  # request data.
-            data_output.append(datum)
-            time.sleep(settings['keithley_fetch_delay'])
+        scheduler.start()
+        data_output = scheduler.poll(keithley_inst.query_ascii_values, settings['keithley_fetch_delay'], np.inf,
+                                     **fetch_kwargs)
+    scheduler.print_jitter_summary()
+    counts = len(data_output)
 
     # 4. Stop sourcing voltage
     agilent_inst.write('OUTP OFF')
@@ -452,6 +412,11 @@ if __name__ == "__main__":
     K1_GPIB, K1_BOARD_INDEX = 24, 0
     # Keithley 2410 used to trigger Andor camera
     K2_TRIGGER_GPIB, K2_TRIGGER_BOARD_INDEX = 25, 1
+    # record every write/query and report where the time went (e.g., VOLT writes vs. :FETCh?)
+    TRACE_SCPI = False  # True False
+    # external amplitude modulation: 'SOFTWARE' (write VOLT at each step) or 'ARB' (upload the staircase as an
+    # arbitrary waveform that the AWG plays by itself, i.e., dwell times are timed by the AWG clock)
+    AWG_MOD_AMPL_MODE = 'SOFTWARE'
 
     # ------------------------------------------------------------------------------------------------------------------
     # ------------------------------------------------------------------------------------------------------------------
@@ -662,6 +627,7 @@ if __name__ == "__main__":
             'awg_mod_depth': AWG_MOD_DEPTH,
             'awg_mod_source': AWG_MOD_SOURCE,
             'awg_mod_ampl_ext': AWG_MOD_AMPL_EXT,
+            'awg_mod_ampl_mode': AWG_MOD_AMPL_MODE,
             'awg_mod_ampl_shape': AWG_MOD_AMPL_SHAPE,
             'awg_mod_ampl_start': AWG_MOD_AMPL_START,
             'awg_mod_ampl_step': AWG_MOD_AMPL_STEP,
@@ -698,19 +664,36 @@ if __name__ == "__main__":
         raise ValueError("Invalid instrument number. Keithley 6517 trigger code not implemented.")
     else:
         K2 = None
+    if TRACE_SCPI:
+        TRACER = SCPITracer()
+        AWG, K1 = TRACER.trace(AWG, 'AWG'), TRACER.trace(K1, 'K1')
+        if K2 is not None:
+            K2 = TRACER.trace(K2, 'K2')
     # -
     # --- Program instruments
     setup_2410_trigger(keithley_inst=K2)
-    DICT_SETTINGS = setup_keithley_6517_amplifier_monitor(keithley_inst=K1, settings=DICT_SETTINGS)
-    setup_agilent_awg(agilent_inst=AWG, settings=DICT_SETTINGS)
+    with BatchWriter(K1, max_length=dict_max_message_length['6517a']) as K1_BATCH:
+        DICT_SETTINGS = setup_keithley_6517_amplifier_monitor(keithley_inst=K1_BATCH, settings=DICT_SETTINGS)
+    AWG_STIMULUS = setup_agilent_awg(agilent_inst=AWG, settings=DICT_SETTINGS)
     # -
     # --- Acquire data
+    TIME_START = time.perf_counter()
     DATA_INPUT, DATA_OUTPUT, DATA_ELEMENTS = data_acquisition_handler(
         agilent_inst=AWG,
         keithley_inst=K1,
         settings=DICT_SETTINGS,
         trigger_inst=K2,
+        stimulus=AWG_STIMULUS,
     )
+    if DICT_SETTINGS['awg_mod_ampl_ext'] != 'ON':
+        # (with amplitude modulation, the run duration is set by the dwell times instead of the Keithley)
+        RunDurationModel().record('6517a', len(DATA_OUTPUT), time.perf_counter() - TIME_START,
+                                  nplc=DICT_SETTINGS['keithley_nplc'], display=DICT_SETTINGS['keithley_display'],
+                                  mode='AMPLIFIER_MONITOR')
+    if TRACE_SCPI:
+        TRACER.print_summary()
+        TRACER.print_histograms()
+        TRACER.export_timeline(join(SAVE_DIR, '{}_scpi_trace.json'.format(SAVE_ID)))
     # -
     # - Post-process data and save
     post_process_data(
@@ -3,20 +3,9 @@ import pyvisa
 import numpy as np
 import matplotlib.pyplot as plt
 
-# --- FUNCTION FOR CONVERTING NUMPY ARRAY TO STRING LIST FOR KEITHLEY
-
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
-
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
+from utils.waveforms import append_reverse
 
-    appended_arr = np.concatenate((arr, reversed_arr))
-
-    return appended_arr
+# --- FUNCTION FOR CONVERTING NUMPY ARRAY TO STRING LIST FOR KEITHLEY
 
 def numpy_array_to_string(arr):
     # Convert the NumPy array elements to strings
@@ -9,19 +9,6 @@ import matplotlib.pyplot as plt
 
 # --- FUNCTION FOR CONVERTING NUMPY ARRAY TO STRING LIST FOR KEITHLEY
 
-def append_reverse(arr, single_point_max):
-    """
-    Append a NumPy array to itself in reverse order.
-    """
-    reversed_arr = arr[::-1]
-
-    if single_point_max is True:
-        reversed_arr = reversed_arr[1:]
-
-    appended_arr = np.concatenate((arr, reversed_arr))
-
-    return appended_arr
-
 def numpy_array_to_string(arr, sig_figs=4):
     # Convert the NumPy array elements to strings
     # str_arr = arr.astype(str)
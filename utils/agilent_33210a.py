@@ -0,0 +1,290 @@
+import hashlib
+import numpy as np
+
+
+# --- HARDWARE-TIMED AMPLITUDE STIMULI (ARBITRARY WAVEFORMS)
+
+# arbitrary waveform memory: points per waveform, DAC full scale (DATA:DAC) and user waveforms in nonvolatile memory
+max_arb_points = 8192
+dac_full_scale = 8191
+max_nonvolatile_arbs = 4
+
+# min. arbitrary waveform points per carrier cycle, for the carrier to be rendered into the waveform itself
+dict_min_points_per_cycle = {
+    'SQU': 4,
+    'SIN': 16,
+}
+
+# min. repetition frequency (Hz) of a USER waveform (FREQ) and of the internal modulating waveform (AM:INT:FREQ)
+min_arb_frequency = 0.001
+min_am_frequency = 0.002
+
+
+def render_staircase(levels, dwell_times, num_points):
+    """
+    Sample a staircase (levels[i] is held for dwell_times[i]) at num_points evenly spaced times.
+
+    NOTE: steps with a dwell time of 0 are skipped. Each step starts at the first point at or after its start time,
+    so step times are quantized to duration / num_points.
+
+    :return: sample times (s), levels at each sample time
+    """
+    levels, dwell_times = np.asarray(levels, dtype=float), np.asarray(dwell_times, dtype=float)
+    step_starts = np.cumsum(dwell_times) - dwell_times
+    times = np.arange(num_points) * dwell_times.sum() / num_points
+    return times, levels[np.clip(np.searchsorted(step_starts, times, side='right') - 1, 0, len(levels) - 1)]
+
+
+def render_carrier(func, phase, duty_cycle=50):
+    """ Normalized carrier (-1 to 1) at phase (0 to 1): 'SQU' (duty_cycle in %), 'SIN' or 'DC'. """
+    if func == 'SQU':
+        return np.where(phase < duty_cycle / 100, 1.0, -1.0)
+    elif func == 'SIN':
+        return np.sin(2 * np.pi * phase)
+    elif func == 'DC':
+        return np.ones_like(phase)
+    else:
+        raise ValueError("Carrier not understood. Options are: ['SQU', 'SIN', 'DC'].")
+
+
+def render_33210a_stimulus(levels, dwell_times, carrier, carrier_freq, duty_cycle=50, num_points=max_arb_points):
+    """
+    Render an amplitude staircase (e.g., the STD1/STD2/STD3/VAR3 tests) as one arbitrary waveform that the 33210A
+    plays by itself, so the dwell times are set by the AWG clock instead of host writes of VOLT.
+
+        * 'BURST': the carrier fits in the waveform memory (or carrier is 'DC'), so the waveform is the whole stimulus
+          (envelope x carrier), played once per trigger (FUNC USER, FREQ = 1 / duration, 1-cycle triggered burst).
+        * 'AM': the carrier is too fast for the waveform memory, so the waveform is only the envelope, which modulates
+          the carrier (AM:INT:FUNC USER, AM:INT:FREQ = 1 / duration, 100% depth). The envelope repeats every duration,
+          so the output must be turned off after one period.
+
+    :param levels: amplitude (Vpp) of each step
+    :param dwell_times: (s) dwell time of each step
+    :param carrier: 'SQU', 'SIN' or 'DC'
+    :param carrier_freq: (Hz)
+    :param duty_cycle: (%) square carrier only
+    :param num_points: number of waveform points
+    :return: dict: mode, dac (int16 DAC values), amplitude (Vpp, i.e., VOLT), duration (s), point_time (s)
+    """
+    levels, dwell_times = np.asarray(levels, dtype=float), np.asarray(dwell_times, dtype=float)
+    duration = dwell_times.sum()
+    amplitude = np.max(np.abs(levels))
+    times, envelope = render_staircase(levels / amplitude, dwell_times, num_points)
+    if carrier == 'DC' or num_points / (carrier_freq * duration) >= dict_min_points_per_cycle[carrier]:
+        if 1 / duration < min_arb_frequency:
+            raise ValueError("Stimulus ({} s) is longer than the longest waveform period ({} s).".format(
+                duration, 1 / min_arb_frequency))
+        mode = 'BURST'
+        values = envelope * render_carrier(carrier, np.mod(times * carrier_freq, 1.0), duty_cycle)
+        # the output idles at the first point before and after the burst
+        values[0] = 0.0
+    else:
+        if 1 / duration < min_am_frequency:
+            raise ValueError("Stimulus ({} s) is longer than the longest modulation period ({} s).".format(
+                duration, 1 / min_am_frequency))
+        mode = 'AM'
+        # at 100% depth, the output amplitude is amplitude * (1 + m) / 2, where m (-1 to 1) is the modulating waveform
+        values = 2 * np.abs(envelope) - 1
+    return {
+        'mode': mode,
+        'dac': np.round(np.clip(values, -1, 1) * dac_full_scale).astype(np.int16),
+        'amplitude': amplitude,
+        'duration': duration,
+        'point_time': duration / num_points,
+    }
+
+
+def arb_name(dac):
+    """ Name a waveform by the hash of its DAC values, e.g., 'ARB_3F2A9C1B' (max. 12 characters). """
+    return 'ARB_' + hashlib.sha1(np.asarray(dac, dtype='<i2').tobytes()).hexdigest()[:8].upper()
+
+
+class ArbWaveformCache:
+    """
+    Upload arbitrary waveforms to the 33210A's nonvolatile memory once and select them by name afterwards.
+
+    Each waveform is named by the hash of its DAC values (see arb_name), so a waveform that is already stored (e.g.,
+    from a previous run of the same test) is not uploaded again. New waveforms are uploaded as a binary block
+    (DATA:DAC, little-endian int16) and copied to nonvolatile memory; when memory is full, the other waveforms stored
+    by this class are deleted first.
+
+        cache = ArbWaveformCache(awg)
+        name = cache.load(stimulus['dac'])
+    """
+
+    def __init__(self, inst):
+        self.inst = inst
+        self.num_uploads = 0
+
+    def stored(self):
+        """ Names of the user waveforms in nonvolatile memory. """
+        response = self.inst.query('DATA:NVOL:CAT?').strip()
+        return [x.strip().strip('"') for x in response.split(',') if x.strip().strip('"')]
+
+    def load(self, dac):
+        name = arb_name(dac)
+        stored = self.stored()
+        if name in stored:
+            return name
+        self.inst.write('FORM:BORD SWAP')  # binary blocks are little-endian
+        self.inst.write_binary_values('DATA:DAC VOLATILE,', np.asarray(dac, dtype=np.int16), datatype='h',
+                                      is_big_endian=False)
+        self.num_uploads += 1
+        if len(stored) >= max_nonvolatile_arbs:
+            # a waveform can not be deleted while it is selected
+            self.inst.write('FUNC:USER VOLATILE')
+            for old_name in [x for x in stored if x.startswith('ARB_')][:len(stored) - max_nonvolatile_arbs + 1]:
+                self.inst.write('DATA:DEL ' + old_name)
+        self.inst.write('DATA:COPY {},VOLATILE'.format(name))
+        return name
+
+
+def setup_33210a_stimulus(agilent_inst, stimulus, name, carrier_freq=None):
+    """
+    Select a stored stimulus waveform (see render_33210a_stimulus and ArbWaveformCache) and wait for
+    start_33210a_stimulus. The carrier (FUNC, FREQ) must already be set up for 'AM' stimuli.
+    """
+    agilent_inst.write('FUNC:USER ' + name)  # Select the arbitrary waveform
+    if stimulus['mode'] == 'BURST':
+        agilent_inst.write('FUNC USER')  # FUNCtion {SINusoid|SQUare|RAMP|PULSe|NOISe|DC|USER}
+        agilent_inst.write('FREQ ' + str(1 / stimulus['duration']))  # one waveform period = the whole stimulus
+        agilent_inst.write('VOLT ' + str(stimulus['amplitude']))  # VOLTage {<amplitude>|MINimum|MAXimum}
+        agilent_inst.write('VOLT:OFFS 0')  # VOLTage:OFFSet {<offset>|MINimum|MAXimum}
+        agilent_inst.write('BURS:MODE TRIG')  # BURSt:MODE {TRIGgered|GATed}
+        agilent_inst.write('BURS:NCYC 1')  # BURSt:NCYCles {<num_cycles>|INFinity|MINimum|MAXimum}
+        agilent_inst.write('TRIG:SOUR BUS')  # TRIGger:SOURce {IMMediate|EXTernal|BUS}: start on *TRG
+        agilent_inst.write('BURS:STAT ON')  # BURSt:STATe {OFF|ON}
+    elif stimulus['mode'] == 'AM':
+        if carrier_freq is not None:
+            agilent_inst.write('FREQ ' + str(carrier_freq))  # FREQuency {<frequency>|MINimum|MAXimum}
+        agilent_inst.write('VOLT ' + str(stimulus['amplitude']))  # VOLTage {<amplitude>|MINimum|MAXimum}
+        agilent_inst.write('AM:STAT OFF')  # modulation starts with start_33210a_stimulus
+        agilent_inst.write('AM:SOUR INT')  # 'INTernal' or 'EXTernal'
+        agilent_inst.write('AM:INT:FUNC USER')  # SIN, SQU, RAMP, NRAMp, TRI, NOIS, USER
+        agilent_inst.write('AM:INT:FREQ ' + str(1 / stimulus['duration']))  # 2 mHz to 20 kHz
+        agilent_inst.write('AM:DEPT 100')  # 0% to 120%, where 0% = Amplitude / 2 and 100% = Amplitude
+    else:
+        raise ValueError("Stimulus mode not understood. Options are: ['BURST', 'AM'].")
+
+
+def start_33210a_stimulus(agilent_inst, stimulus):
+    """
+    Turn the output on and start the stimulus: trigger the burst, or enable AM (before the output is turned on, so the
+    unmodulated carrier never reaches the output).
+
+    NOTE: an 'AM' stimulus repeats every stimulus['duration'] s, so turn the output off after one period.
+    """
+    if stimulus['mode'] == 'BURST':
+        agilent_inst.write('OUTP ON')  # OUTPut {OFF|ON}: idles at the first waveform point (0 V) until triggered
+        agilent_inst.write('*TRG')  # Trigger the burst (TRIG:SOUR BUS)
+    else:
+        agilent_inst.write('AM:STAT ON')  # AM:STATe {OFF|ON}
+        agilent_inst.write('OUTP ON')  # OUTPut {OFF|ON}
+
+
+# --- IDEAL OUTPUT (FOR PLOTTING)
+
+# max number of ideal output references kept by ideal_33210a_output
+ideal_output_cache_size = 32
+ideal_output_cache = {}
+
+
+def carrier_range(func, freq, t0, t1, duty_cycle=50):
+    """
+    Min. and max. of a normalized carrier (see render_carrier) over each time interval [t0, t1], analytically (i.e.,
+    without sampling the carrier). Any other func (e.g., 'NONE') is 0.
+
+    :return: minimums, maximums
+    """
+    t0, t1 = np.asarray(t0, dtype=float), np.asarray(t1, dtype=float)
+    if func == 'DC':
+        return np.ones_like(t0), np.ones_like(t0)
+    elif func not in ['SQU', 'SIN']:
+        return np.zeros_like(t0), np.zeros_like(t0)
+    # phase (cycles) at the start of each interval, in [0, 1), and at the end of each interval, in [a, a + 1]
+    a = np.mod(t0 * freq, 1.0)
+    b = a + np.minimum((t1 - t0) * freq, 1.0)
+    if func == 'SQU':
+        d = duty_cycle / 100
+        high = (a < d) | (b >= 1)  # high for phases in [0, d) and [1, 1 + d)
+        low = (b >= d) & (a < 1) | (b >= 1 + d)  # low for phases in [d, 1) and [1 + d, 2)
+        return np.where(low, -1.0, 1.0), np.where(high, 1.0, -1.0)
+    else:
+        ends = np.sin(2 * np.pi * np.stack([a, b]))
+        peak = np.ceil(a - 0.25) + 0.25 <= b  # contains a phase of 0.25 (mod 1)
+        trough = np.ceil(a - 0.75) + 0.75 <= b  # contains a phase of 0.75 (mod 1)
+        return np.where(trough, -1.0, ends.min(axis=0)), np.where(peak, 1.0, ends.max(axis=0))
+
+
+def staircase_range(step_times, levels, t0, t1):
+    """
+    Min. and max. of a staircase (levels[i] from step_times[i] until the next step) over each interval [t0, t1).
+
+    NOTE: intervals must be contiguous and in chronological order (i.e., t0[k + 1] == t1[k]).
+    """
+    step_times, levels = np.asarray(step_times, dtype=float), np.asarray(levels, dtype=float)
+    i0 = np.clip(np.searchsorted(step_times, t0, side='right') - 1, 0, len(levels) - 1)
+    i1 = np.maximum(np.searchsorted(step_times, t1, side='left') - 1, i0)
+    # intervals are contiguous (t0[k + 1] == t1[k]), so the steps within interval k are levels[i0[k]:i1[k] + 1]
+    active = levels[:i1[-1] + 1]
+    return (np.minimum(np.minimum.reduceat(active, i0), levels[i1]),
+            np.maximum(np.maximum.reduceat(active, i0), levels[i1]))
+
+
+def _interval_product(lo1, hi1, lo2, hi2):
+    products = np.stack([lo1 * lo2, lo1 * hi2, hi1 * lo2, hi1 * hi2])
+    return products.min(axis=0), products.max(axis=0)
+
+
+def ideal_33210a_output(t_end, carrier, carrier_freq, amplitude, offset=0.0, duty_cycle=50, mod_func=None,
+                        mod_freq=0.0, envelope=None, num_columns=2000, bands=True):
+    """
+    Ideal output, at display resolution, for a reference overlay: amplitude x envelope x modulation x carrier + offset.
+
+    The output is evaluated on num_columns contiguous intervals (i.e., about one per pixel column) from 0 to t_end. If
+    bands, the min. and max. within each interval are computed analytically (see carrier_range and staircase_range),
+    so a fast carrier is drawn as a filled band instead of millions of points; otherwise, the output is evaluated at the
+    center of each interval. The cost does not depend on the carrier frequency, and results are cached by their
+    parameters (see ideal_output_cache_size).
+
+    :param t_end: (s)
+    :param carrier: 'SQU', 'SIN' or 'DC'
+    :param carrier_freq: (Hz)
+    :param amplitude: peak output (V), i.e., for an envelope (and modulation) of 1
+    :param offset: DC offset (V)
+    :param duty_cycle: (%) square carrier only
+    :param mod_func: internal amplitude modulation: None, 'SQU' or 'SIN' (from -1 to 1)
+    :param mod_freq: (Hz)
+    :param envelope: external amplitude modulation: None, or (step_times, levels), where levels are relative to amplitude
+    :param num_columns: number of intervals
+    :param bands: return the min. and max. within each interval (True), or the output at its center (False)
+    :return: bands: interval centers (s), minimums, maximums; otherwise: interval centers (s), output
+    """
+    parameters = (t_end, carrier, carrier_freq, amplitude, offset, duty_cycle, mod_func, mod_freq, num_columns, bands)
+    key = hashlib.sha1(repr(parameters).encode())
+    if envelope is not None:
+        key.update(np.asarray(envelope[0], dtype=float).tobytes() + np.asarray(envelope[1], dtype=float).tobytes())
+    key = key.hexdigest()
+    if key not in ideal_output_cache:
+        if len(ideal_output_cache) >= ideal_output_cache_size:
+            ideal_output_cache.pop(next(iter(ideal_output_cache)))
+        edges = np.linspace(0, t_end, num_columns + 1)
+        t0, t1 = (edges[:-1], edges[1:]) if bands else (0.5 * (edges[:-1] + edges[1:]),) * 2
+        # amplitude (envelope x modulation) range, then output range
+        if envelope is None:
+            env_lo = env_hi = np.ones(num_columns)
+        elif bands:
+            env_lo, env_hi = staircase_range(envelope[0], envelope[1], t0, t1)
+        else:
+            i = np.clip(np.searchsorted(envelope[0], t0, side='right') - 1, 0, len(envelope[1]) - 1)
+            env_lo = env_hi = np.asarray(envelope[1], dtype=float)[i]
+        if mod_func is not None:
+            env_lo, env_hi = _interval_product(env_lo, env_hi, *carrier_range(mod_func, mod_freq, t0, t1))
+        out_lo, out_hi = _interval_product(env_lo * amplitude, env_hi * amplitude,
+                                           *carrier_range(carrier, carrier_freq, t0, t1, duty_cycle))
+        result = (0.5 * (edges[:-1] + edges[1:]), out_lo + offset, out_hi + offset) if bands else \
+            (0.5 * (edges[:-1] + edges[1:]), out_lo + offset)
+        for arr in result:
+            arr.setflags(write=False)
+        ideal_output_cache[key] = result
+    return ideal_output_cache[key]
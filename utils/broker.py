@@ -0,0 +1,275 @@
+"""
+Instrument session broker: a long-lived local process that owns the GPIB/USB sessions, so scripts don't pay the
+open/reset/configure cost on every run.
+
+Start the broker once (e.g., in its own terminal):
+
+    python -m utils.broker
+    python -m utils.broker --shadow  # only send the settings that change between runs (see ShadowStateInstrument)
+    python -m utils.broker --skip-reset  # shadow, and also skip *RST once k3.verify() found no changed settings
+
+Then, in a script, replace rm.open_resource(...) with:
+
+    k3 = open_instrument(rm, 'GPIB0::27::INSTR', use_broker=True)
+
+The returned object has the same methods as a pyvisa resource (write, query, query_ascii_values, ...). If the broker
+is not running, the resource is opened directly.
+
+The transport is chosen by the resource name: 'SIM::<model>::INSTR' opens a simulated instrument (utils/simulated.py),
+'TCPIP0::<address>::<port>::SOCKET' (e.g., a 2450 on port 5025) opens a non-blocking raw socket (SocketInstrument,
+utils/lan.py) instead of a VISA session, and any other name is opened by pyvisa.
+
+NOTE: clients authenticate with the key in the PY_PENNATHUR_LAB_BROKER_KEY environment variable or, if it is not set,
+in default_authkey_file, which the broker creates (readable by the current user only) on its first start. Requests are
+pickled, so anyone with the key can run code as the broker's user: keep the key private.
+NOTE: every request is executed while holding that instrument's lock, so scripts that share an instrument never
+interleave commands. Use "with k3.transaction():" to hold the lock for a sequence of requests (e.g., :INIT + :FETCh?).
+NOTE: errors raised by the broker's session are re-raised by the client as the same built-in exception (e.g.,
+ValueError), or as BrokerError (e.g., pyvisa's VisaIOError, which is not sent between processes).
+"""
+import argparse
+import builtins
+import os
+import secrets
+import threading
+from contextlib import contextmanager
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+from utils.lan import is_socket_resource, open_socket_resource
+from utils.scpi import ShadowStateInstrument
+
+
+# local IPC address (localhost only)
+default_address = ('localhost', 18517)
+
+# key shared by the broker and its clients (see get_authkey)
+authkey_environment_variable = 'PY_PENNATHUR_LAB_BROKER_KEY'
+default_authkey_file = os.path.join(os.path.expanduser('~'), '.py-pennathur-lab_broker_key')
+
+# pyvisa resource methods that clients are allowed to call
+broker_methods = ['write', 'read', 'read_raw', 'query', 'query_ascii_values', 'query_binary_values', 'read_stb',
+                  'clear', 'assert_trigger', 'wait_for_srq',
+                  'query_pipelined']  # SocketInstrument only
+
+# methods of the shadow copy (only if the broker shadows settings)
+shadow_methods = ['invalidate', 'verify']
+
+# session attributes that clients are allowed to read and write
+broker_attributes = ['timeout', 'read_termination', 'write_termination', 'resource_name']
+
+
+def get_authkey(authkey_file=default_authkey_file, create=False):
+    """
+    Key from the PY_PENNATHUR_LAB_BROKER_KEY environment variable (hex) or from authkey_file.
+
+    :param create: if True and there is no key, generate one and write it to authkey_file (permissions 0600)
+    :return: key (bytes), or None if there is no key
+    """
+    if os.environ.get(authkey_environment_variable):
+        return bytes.fromhex(os.environ[authkey_environment_variable])
+    if not os.path.exists(authkey_file):
+        if not create:
+            return None
+        fd = os.open(authkey_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+    with open(authkey_file, 'r') as f:
+        return bytes.fromhex(f.read().strip())
+
+
+class BrokerError(Exception):
+    """ Error raised by the broker's session that is not a built-in exception (e.g., pyvisa's VisaIOError). """
+
+
+def rebuild_error(type_name, message):
+    """ Client-side exception for an error sent by the broker as (type name, message). """
+    error_type = getattr(builtins, type_name, None)
+    if isinstance(error_type, type) and issubclass(error_type, Exception):
+        return error_type(message)
+    return BrokerError('{}: {}'.format(type_name, message))
+
+
+# --- BROKER (server)
+
+class InstrumentBroker:
+    """
+    Owns one pyvisa session per resource (opened on first use and kept open) and serves requests from clients.
+
+    If shadow_state is True (or skip_reset, which needs a shadow copy), each session is a ShadowStateInstrument.
+    """
+
+    def __init__(self, address=default_address, authkey=None, shadow_state=False, skip_reset=False,
+                 resource_manager=None):
+        self.address = address
+        self.authkey = get_authkey(create=True) if authkey is None else authkey
+        self.shadow_state = shadow_state or skip_reset
+        self.skip_reset = skip_reset
+        self.rm = resource_manager
+        self.sessions = {}
+        self.locks = {}
+        self.sessions_lock = threading.Lock()
+
+    def get_session(self, resource_name):
+        with self.sessions_lock:
+            if resource_name not in self.sessions:
+                if is_socket_resource(resource_name):
+                    session = open_socket_resource(resource_name)
+                else:
+                    if self.rm is None:
+                        import pyvisa
+                        self.rm = pyvisa.ResourceManager()
+                    session = self.rm.open_resource(resource_name)
+                if self.shadow_state:
+                    # settings are shadowed so that back-to-back runs only send the settings that change
+                    session = ShadowStateInstrument(session, skip_reset=self.skip_reset)
+                self.sessions[resource_name] = session
+                self.locks[resource_name] = threading.RLock()
+            return self.sessions[resource_name], self.locks[resource_name]
+
+    def handle_request(self, request, held_locks):
+        method, resource_name, args, kwargs = request
+        if method == 'list':
+            return list(self.sessions.keys())
+        inst, lock = self.get_session(resource_name)
+        if method == 'acquire':
+            lock.acquire()
+            held_locks.append(lock)
+            return None
+        if method == 'release':
+            lock.release()
+            held_locks.remove(lock)
+            return None
+        with lock:
+            if method in ['getattr', 'setattr'] and args[0] not in broker_attributes:
+                raise ValueError("Attribute {} is not served by the broker.".format(args[0]))
+            if method == 'getattr':
+                return getattr(inst, args[0])
+            if method == 'setattr':
+                return setattr(inst, args[0], args[1])
+            if method in shadow_methods:
+                return getattr(inst, method)(*args, **kwargs) if isinstance(inst, ShadowStateInstrument) else None
+            if method not in broker_methods:
+                raise ValueError("Method {} is not served by the broker.".format(method))
+            return getattr(inst, method)(*args, **kwargs)
+
+    def serve_connection(self, conn):
+        held_locks = []
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    break
+                try:
+                    conn.send(('ok', self.handle_request(request, held_locks)))
+                except Exception as e:
+                    # send the type name and message: exceptions like pyvisa's VisaIOError can't be pickled
+                    conn.send(('error', (type(e).__name__, str(e))))
+        finally:
+            # never leave an instrument locked by a script that exited (or crashed) mid-transaction
+            for lock in held_locks:
+                lock.release()
+            conn.close()
+
+    def serve_forever(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print("Instrument broker listening on {}:{}".format(*self.address))
+            while True:
+                try:
+                    conn = listener.accept()
+                except AuthenticationError:
+                    print("Rejected a client with the wrong key.")
+                    continue
+                threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+
+# --- CLIENT
+
+class BrokerInstrument:
+    """
+    Stand-in for a pyvisa resource whose session is owned by the broker.
+
+    Methods in broker_methods are forwarded to the broker. Attributes in broker_attributes (e.g., timeout) are read
+    and written through the broker. close() only disconnects from the broker: the session stays open (and configured)
+    for the next run.
+    """
+
+    def __init__(self, resource_name, address=default_address, authkey=None):
+        authkey = get_authkey() if authkey is None else authkey
+        if authkey is None:
+            raise ConnectionRefusedError("No broker key: the broker has never been started.")
+        self.__dict__['resource_name'] = resource_name
+        self.__dict__['conn'] = Client(address, authkey=authkey)
+
+    def _request(self, method, *args, **kwargs):
+        self.conn.send((method, self.resource_name, args, kwargs))
+        status, result = self.conn.recv()
+        if status == 'error':
+            raise rebuild_error(*result)
+        return result
+
+    @contextmanager
+    def transaction(self):
+        """ Hold this instrument's lock (so no other script can use it) for a sequence of requests. """
+        self._request('acquire')
+        try:
+            yield self
+        finally:
+            self._request('release')
+
+    def invalidate(self):
+        """ Forget the broker's shadow copy of this instrument's settings (e.g., after a power cycle). """
+        self._request('invalidate')
+
+    def verify(self, keys=None, resync_mismatches=False):
+        """
+        Compare the broker's shadow copy against the instrument (see ShadowStateInstrument.verify). Returns None if the
+        broker doesn't shadow settings.
+        """
+        return self._request('verify', keys=keys, resync_mismatches=resync_mismatches)
+
+    def close(self):
+        self.conn.close()
+
+    def __getattr__(self, name):
+        if name in broker_methods:
+            return lambda *args, **kwargs: self._request(name, *args, **kwargs)
+        if name not in broker_attributes:
+            raise AttributeError("Attribute {} is not served by the broker.".format(name))
+        return self._request('getattr', name)
+
+    def __setattr__(self, name, value):
+        self._request('setattr', name, value)
+
+
+def open_instrument(rm, resource_name, use_broker=True, address=default_address, authkey=None):
+    """
+    Open an instrument through the broker if it is running, otherwise open it directly with the resource manager.
+
+    Resources named 'SIM::<model>::INSTR' are opened as simulated instruments (see utils/simulated.py), and
+    'TCPIP0::<address>::<port>::SOCKET' resources as raw sockets (see utils/lan.py), so rm may be None for either.
+    """
+    if resource_name.upper().startswith('SIM::'):
+        from utils.simulated import open_simulated_resource
+        return open_simulated_resource(resource_name)
+    if use_broker:
+        try:
+            return BrokerInstrument(resource_name, address=address, authkey=authkey)
+        except ConnectionRefusedError:
+            print("Instrument broker is not running. Opening {} directly.".format(resource_name))
+    if is_socket_resource(resource_name):
+        return open_socket_resource(resource_name)
+    return rm.open_resource(resource_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep instrument sessions open between script invocations.")
+    parser.add_argument('--port', type=int, default=default_address[1])
+    parser.add_argument('--shadow', action='store_true', help="only send the settings that change between runs")
+    parser.add_argument('--skip-reset', action='store_true',
+                        help="shadow, and skip *RST once verify() found no changed settings")
+    args = parser.parse_args()
+
+    InstrumentBroker(address=(default_address[0], args.port), shadow_state=args.shadow,
+                     skip_reset=args.skip_reset).serve_forever()
@@ -0,0 +1,115 @@
+import queue
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from utils.timing import default_spin_time, sleep_until
+
+
+# --- SCHEDULED WRITES ON A WORKER THREAD
+
+class ScheduledCommandQueue:
+    """
+    Write commands to one instrument at scheduled times, from a dedicated worker thread.
+
+    The thread that polls another instrument (e.g., :FETCh? on a Keithley) never waits on this instrument's writes
+    (e.g., a slow USB write of VOLT to the 33210A), and vice versa. The time at which each write actually started and
+    completed is logged (see log()). Typical use:
+
+        awg_queue = ScheduledCommandQueue(awg)
+        awg_queue.start()  # times are relative to start (or to t0)
+        awg_queue.schedule_many(['VOLT {}'.format(v) for v in voltages], np.cumsum(dwell_times) - dwell_times)
+        while ...:  # poll the other instrument at its own cadence
+            data.append(k1.query_ascii_values(':FETCh?'))
+        awg_queue.join()  # wait for the remaining writes (and raise any error from the worker)
+        df = awg_queue.log()
+
+    NOTE: commands are written in the order they are scheduled, so schedule them in chronological order. Nothing else
+    should talk to the instrument until join() returns.
+    """
+
+    def __init__(self, inst, name='inst', spin_time=default_spin_time):
+        self.inst = inst
+        self.name = name
+        self.spin_time = spin_time
+        self.commands = queue.Queue()
+        self.records = []
+        self.error = None
+        self.t0 = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._worker, name='{}_command_queue'.format(name), daemon=True)
+
+    def start(self, t0=None):
+        """ Start the worker; scheduled times are relative to t0 (time.perf_counter(); default: now). """
+        self.t0 = time.perf_counter() if t0 is None else t0
+        self.thread.start()
+
+    def schedule(self, command, at):
+        """ Write command at time at (s, relative to t0). Late commands are written immediately. """
+        self.commands.put((command, at))
+
+    def schedule_many(self, commands, times):
+        for command, at in zip(commands, times):
+            self.schedule(command, at)
+
+    def _worker(self):
+        while not self.stop_event.is_set():
+            try:
+                command, at = self.commands.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                # wait (interruptibly) until just before the command is due, then spin until it is due
+                if not self.stop_event.wait(max(0.0, self.t0 + at - time.perf_counter() - self.spin_time)):
+                    sleep_until(self.t0 + at, self.spin_time)
+                    start = time.perf_counter()
+                    self.inst.write(command)
+                    stop = time.perf_counter()
+                    self.records.append((command, at, start - self.t0, stop - self.t0))
+            except Exception as e:
+                self.error = e
+                self.stop_event.set()
+            finally:
+                self.commands.task_done()
+
+    def join(self, timeout=None):
+        """
+        Wait until every scheduled command has been written, then stop the worker.
+
+        :param timeout: (s) raise ValueError if the commands are not written within timeout
+        """
+        tic = time.perf_counter()
+        while self.commands.unfinished_tasks and self.error is None:
+            if timeout is not None and time.perf_counter() - tic > timeout:
+                self.stop()
+                raise ValueError("Scheduled commands to {} were not written within {} s.".format(self.name, timeout))
+            time.sleep(0.01)
+        self.stop()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        """ Stop the worker (commands that are not yet written are dropped). """
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def log(self):
+        """ Scheduled time, start and completion (s, relative to t0) and lateness of every command written. """
+        df = pd.DataFrame(self.records, columns=['command', 'scheduled', 'start', 'stop'])
+        df['lateness'] = df['stop'] - df['scheduled']
+        return df
+
+    def print_log_summary(self):
+        df = self.log()
+        if len(df) == 0:
+            return
+        print("--- {}: {} scheduled writes, lateness (completed - scheduled): median = {} ms, max = {} ms".format(
+            self.name, len(df), np.round(df['lateness'].median() * 1e3, 2), np.round(df['lateness'].max() * 1e3, 2)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,89 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+
+# --- CONCURRENT I/O ON SEVERAL INSTRUMENTS
+
+class InstrumentGroup:
+    """
+    Issue the same kind of request to several instruments at once and wait for all of them.
+
+    Each instrument is served by its own thread, so instruments on different GPIB boards (or interfaces) are talked to
+    concurrently and a synchronized run costs the slowest instrument's I/O instead of the sum. Every request is timed
+    (see timings()). Typical use:
+
+        group = InstrumentGroup({'k1': k1, 'k2': k2})
+        group.write_in_order([('k2', ':INIT'), ('k1', ':INIT')])  # arm order matters: k1 triggers k2
+        data = group.query_ascii_values(':FETCh?', container=np.array)  # {'k1': array, 'k2': array}
+
+    NOTE: instruments on the same GPIB board still share the bus, so their requests are serialized by the driver.
+    """
+
+    def __init__(self, instruments):
+        self.instruments = dict(instruments)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.instruments))
+        self.records = []
+        self.t0 = time.perf_counter()
+
+    def _timed(self, name, method, command, func):
+        start = time.perf_counter()
+        result = func()
+        stop = time.perf_counter()
+        self.records.append((name, method, command, start - self.t0, stop - self.t0, stop - start))
+        return result
+
+    def run(self, calls):
+        """
+        Run one function per instrument concurrently and wait for all of them.
+
+        :param calls: {name: function(inst)}
+        :return: {name: return value}
+        """
+        futures = {name: self.executor.submit(self._timed, name, getattr(func, '__name__', 'call'), None,
+                                              lambda inst=self.instruments[name], func=func: func(inst))
+                   for name, func in calls.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def _request(self, method, command, names, *args, **kwargs):
+        names = list(self.instruments.keys()) if names is None else names
+        if isinstance(command, dict):
+            commands = command
+        else:
+            commands = {name: command for name in names}
+        futures = {name: self.executor.submit(self._timed, name, method, commands[name],
+                                              lambda inst=self.instruments[name], c=commands[name]:
+                                              getattr(inst, method)(c, *args, **kwargs))
+                   for name in commands.keys()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def write(self, command, names=None):
+        """ Write a command (or {name: command}) to every instrument (or to names) concurrently. """
+        return self._request('write', command, names)
+
+    def query(self, command, names=None, **kwargs):
+        return self._request('query', command, names, **kwargs)
+
+    def query_ascii_values(self, command, names=None, **kwargs):
+        return self._request('query_ascii_values', command, names, **kwargs)
+
+    def query_binary_values(self, command, names=None, **kwargs):
+        return self._request('query_binary_values', command, names, **kwargs)
+
+    def write_in_order(self, commands):
+        """ Write [(name, command), ...] one after another (e.g., arm the instrument that waits for a trigger first). """
+        for name, command in commands:
+            self._timed(name, 'write', command, lambda: self.instruments[name].write(command))
+
+    def timings(self):
+        """ Start, stop and duration (s, since the group was created) of every request. """
+        return pd.DataFrame(self.records, columns=['instrument', 'method', 'command', 'start', 'stop', 'duration'])
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,236 @@
+import time
+import numpy as np
+
+from utils.scpi import join_commands, dict_max_message_length
+
+
+# --- LIST SWEEPS
+
+# max number of sweep points (:TRIG:COUN and :SOUR:LIST:VOLT:POIN are both limited to 2500)
+max_list_points = 2500
+
+# number of list values per message (a single :SOUR:LIST:VOLT with more than ~120 values overflows the input buffer)
+list_points_per_message = 100
+
+
+def format_list_values(arr, sig_figs=4):
+    """ Convert a numpy array to a comma-separated list of values, keeping only significant digits. """
+    return ','.join(np.around(arr, sig_figs).astype(str))
+
+
+def list_upload_commands(voltage_levels, points_per_message=list_points_per_message):
+    """
+    Commands that upload a voltage list of any length: the first points_per_message values are sent with
+    :SOUR:LIST:VOLT (which replaces the list) and the rest are appended with :SOUR:LIST:VOLT:APP.
+    """
+    voltage_levels = np.asarray(voltage_levels)
+    commands = []
+    for i in range(0, len(voltage_levels), points_per_message):
+        header = ':SOUR:LIST:VOLT ' if i == 0 else ':SOUR:LIST:VOLT:APP '
+        commands.append(header + format_list_values(voltage_levels[i:i + points_per_message]))
+    commands.append(':TRIG:COUN ' + str(len(voltage_levels)))  # Trigger count = # sweep points.
+    return commands
+
+
+def split_list_sweep(voltage_levels, max_points=max_list_points):
+    """ Split a voltage list into the fewest sweeps of (nearly) equal length that are each <= max_points. """
+    num_sweeps = int(np.ceil(len(voltage_levels) / max_points))
+    return np.array_split(np.asarray(voltage_levels), num_sweeps)
+
+
+def stitch_time(chunks, idxT, init_times):
+    """
+    Stitch the TIME column of consecutive sweeps into one continuous record.
+
+    The 2410 timestamp keeps counting between sweeps, so chunks are only shifted if TIME restarts (e.g., after
+    :SYST:TIME:RES or a relative timestamp format). In that case, the host time between each :INIT is used (but never
+    less than one sampling period after the previous chunk).
+
+    :param chunks: list of arrays with shape (num_points, num_elements)
+    :param idxT: index of the TIME column
+    :param init_times: host time (perf_counter) at which each chunk was triggered
+    :return: array with shape (sum(num_points), num_elements)
+    """
+    for i in range(1, len(chunks)):
+        if chunks[i][0, idxT] <= chunks[i - 1][-1, idxT]:
+            sampling_period = np.median(np.diff(chunks[i - 1][:, idxT])) if len(chunks[i - 1]) > 1 else 0
+            start = max(chunks[0][0, idxT] + (init_times[i] - init_times[0]), chunks[i - 1][-1, idxT] + sampling_period)
+            chunks[i][:, idxT] += start - chunks[i][0, idxT]
+    return np.vstack(chunks)
+
+
+def upload_list_sweep(keithley_inst, voltage_levels, max_points=max_list_points,
+                      points_per_message=list_points_per_message, max_length=dict_max_message_length['2410']):
+    """
+    Upload the list and trigger count of the first sweep of run_list_sweep, without :INIT. Then, run_list_sweep(...,
+    uploaded=True) starts the sweep with a single :INIT, e.g., right after a camera trigger is armed.
+    """
+    chunk = split_list_sweep(voltage_levels, max_points=max_points)[0]
+    for message in join_commands(list_upload_commands(chunk, points_per_message), max_length):
+        keithley_inst.write(message)
+
+
+def run_list_sweep(keithley_inst, voltage_levels, num_elements, idxT, max_points=max_list_points,
+                   points_per_message=list_points_per_message, max_length=dict_max_message_length['2410'],
+                   uploaded=False):
+    """
+    Run a voltage list sweep of any length and return the readings from every sweep as one record.
+
+    The source must already be set up for list sweeps (:SOUR:VOLT:MODE LIST) and the output turned on. Lists that
+    fit in the instrument are uploaded in pieces (:SOUR:LIST:VOLT:APP) and run as a single sweep. Longer lists are
+    run as several sweeps: as soon as one sweep is fetched, the next list, trigger count and :INIT are sent in as few
+    messages as possible (the list can't be changed while a sweep runs). The dead time between sweeps is the upload of
+    the next list (len(chunk) / points_per_message messages, e.g., 25 for 2500 points, each a bus write of up to
+    max_length characters that the instrument parses) plus the :INIT, i.e., it grows with the chunk size.
+
+    :param keithley_inst: pyvisa resource
+    :param voltage_levels: list of voltages (any length)
+    :param num_elements: number of elements per reading (:FORM:ELEM:SENS)
+    :param idxT: index of the TIME element
+    :param uploaded: if True, the first sweep was already uploaded (see upload_list_sweep) and is only triggered
+    :return: array with shape (len(voltage_levels), num_elements)
+    """
+    chunks, init_times = [], []
+    for i, chunk in enumerate(split_list_sweep(voltage_levels, max_points=max_points)):
+        commands = [] if uploaded and i == 0 else list_upload_commands(chunk, points_per_message)
+        for message in join_commands(commands + [':INIT'], max_length):
+            keithley_inst.write(message)
+        init_times.append(time.perf_counter())
+        data = keithley_inst.query_ascii_values(':FETCh?', container=np.array)  # request data.
+        chunks.append(np.reshape(data, (len(chunk), num_elements)))
+    return stitch_time(chunks, idxT, init_times)
+
+
+# --- SETTLE-TIME PLANNING
+
+# planned source delays (s) and NPLCs are rounded up to these values, so a sweep has few distinct settings
+settle_delays = np.array([0.0, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0])
+settle_nplcs = np.array([0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10])
+
+
+def fit_settling(times, currents, step_voltage, tail_fraction=0.25):
+    """
+    Fit I(t) = I_leak + I_0 * exp(-t / tau) to the current after a voltage step (e.g., run_2410_settle_pulse).
+
+    I_leak and the reading noise are taken from the last tail_fraction of the record, then tau and I_0 from a
+    log-linear fit of the transient until it first falls below 3x the noise. If fewer than 2 readings are above the
+    noise, the DUT settled before the first reading (tau = 0).
+
+    :param times: (s) time of each reading since the step
+    :param currents: (A)
+    :param step_voltage: (V)
+    :return: dict: tau (s), series_resistance (Ohm, i.e., step_voltage / I_0), leakage_resistance (Ohm), noise (A)
+    """
+    times, currents = np.asarray(times, dtype=float), np.asarray(currents, dtype=float)
+    tail = times >= times[0] + (1 - tail_fraction) * (times[-1] - times[0])
+    leakage, noise = np.median(currents[tail]), np.std(currents[tail])
+    transient = (currents - leakage) * np.sign(step_voltage)
+    # fit the readings before the transient first falls into the noise (later readings above it are just noise)
+    above = transient > 3 * noise
+    fit = np.arange(len(times)) < (np.argmin(above) if not np.all(above) else len(times))
+    if np.sum(fit & ~tail) < 2:
+        tau, i0 = 0.0, 0.0
+    else:
+        fit &= ~tail
+        slope, intercept = np.polyfit(times[fit], np.log(transient[fit]), 1)
+        if slope >= 0:
+            raise ValueError("Current did not decay during the pulse. Increase the pulse duration.")
+        tau, i0 = -1 / slope, np.exp(intercept)
+    return {
+        'tau': tau,
+        'series_resistance': abs(step_voltage) / i0 if i0 > 0 else np.inf,
+        'leakage_resistance': abs(step_voltage / leakage) if leakage != 0 else np.inf,
+        'noise': noise,
+    }
+
+
+def run_2410_settle_pulse(keithley_inst, step_voltage, num_points=500, nplc=0.01):
+    """
+    Characterize how the DUT settles: step from 0 V to step_voltage and read the current as fast as possible (list
+    sweep, no source delay), then fit it (see fit_settling). The source delay, NPLC, trigger count and elements are
+    restored, and the DUT is left to discharge at 0 V before returning.
+
+    The source must already be set up for list sweeps (:SOUR:VOLT:MODE LIST), with :SOUR:VOLT 0 and the output on.
+    The current range is not changed, so the fitted noise is the noise on the range the sweep will use.
+
+    :param step_voltage: (V) e.g., the largest step of the sweep
+    :param num_points: readings (the pulse lasts about num_points x (nplc / 60 + reading overhead))
+    :param nplc: integration rate of the pulse readings (the fitted noise is for this NPLC)
+    :return: dict (see fit_settling), plus nplc
+    """
+    settings = {x: keithley_inst.query(x + '?').strip() for x in [':SOUR:DEL', ':SENS:CURR:NPLC', ':TRIG:COUN',
+                                                                   ':FORM:ELEM:SENS']}
+    keithley_inst.write(':FORM:ELEM:SENS CURR,TIME')  # Current, Timestamp
+    keithley_inst.write(':SOUR:DEL 0')  # No source delay: the first reading is one integration after the step
+    keithley_inst.write(':SENS:CURR:NPLC ' + str(nplc))  # Specify integration rate (in line cycles)
+    data = run_list_sweep(keithley_inst, np.full(num_points, float(step_voltage)), num_elements=2, idxT=1)
+    for header, value in settings.items():
+        keithley_inst.write(header + ' ' + value)
+    settling = fit_settling(data[:, 1] - data[0, 1] + nplc / 60, data[:, 0], step_voltage)
+    settling['nplc'] = nplc
+    time.sleep(min(5 * settling['tau'], data[-1, 1] - data[0, 1]))  # discharge
+    return settling
+
+
+def plan_settle_times(voltages, settling, accuracy=0.01, min_current=None, max_delay=settle_delays[-1]):
+    """
+    Shortest source delay and NPLC at each step of a voltage schedule for a reading within a tolerance of the settled
+    current, where tolerance = max(accuracy x |V / leakage_resistance|, min_current):
+
+        * delay: the charging current left over from this and the previous steps (dV / series_resistance, decaying
+          with tau) has decayed below the tolerance.
+        * NPLC: the reading noise (noise at the pulse NPLC, averaging down as 1 / sqrt(NPLC)) is below the tolerance.
+
+    Both are rounded up to settle_delays and settle_nplcs.
+
+    :param voltages: voltage schedule
+    :param settling: see fit_settling or run_2410_settle_pulse
+    :param accuracy: relative to the settled (leakage) current
+    :param min_current: (A) smallest tolerance; default: the noise at the pulse NPLC
+    :param max_delay: (s) e.g., the source delay that would have been used for every step
+    :return: delays (s), nplcs
+    """
+    voltages = np.asarray(voltages, dtype=float)
+    if min_current is None:
+        min_current = settling['noise']
+    tolerance = np.maximum(accuracy * np.abs(voltages / settling['leakage_resistance']), min_current)
+    required_nplcs = settling.get('nplc', 0.01) * (settling['noise'] / tolerance) ** 2
+    nplcs = settle_nplcs[np.clip(np.searchsorted(settle_nplcs, required_nplcs * (1 - 1e-9)), 0, len(settle_nplcs) - 1)]
+    delays = np.zeros_like(voltages)
+    residual = 0.0  # charging current at the start of each step
+    for i, dv in enumerate(np.diff(voltages, prepend=0.0)):
+        residual += dv / settling['series_resistance']
+        if settling['tau'] > 0 and abs(residual) > tolerance[i]:
+            delays[i] = settling['tau'] * np.log(abs(residual) / tolerance[i])
+        delays[i] = settle_delays[min(np.searchsorted(settle_delays, delays[i] * (1 - 1e-9)), len(settle_delays) - 1)]
+        delays[i] = min(delays[i], max_delay)
+        if settling['tau'] > 0:
+            residual *= np.exp(-(delays[i] + nplcs[i] / 60) / settling['tau'])
+    return delays, nplcs
+
+
+def split_settle_segments(delays, nplcs):
+    """
+    Split a settle-time schedule into runs of the same source delay and NPLC.
+
+    :return: list of segments: (delay, nplc, start index, num_points)
+    """
+    delays, nplcs = np.asarray(delays, dtype=float), np.asarray(nplcs, dtype=float)
+    starts = np.flatnonzero(np.concatenate([[True], (delays[1:] != delays[:-1]) | (nplcs[1:] != nplcs[:-1])]))
+    stops = np.append(starts[1:], len(delays))
+    return [(delays[i], nplcs[i], i, j - i) for i, j in zip(starts, stops)]
+
+
+def run_settled_list_sweep(keithley_inst, voltage_levels, delays, nplcs, num_elements, idxT):
+    """
+    Run a voltage list sweep with a source delay and NPLC per step (see plan_settle_times): each run of steps with the
+    same settings is a list sweep (see run_list_sweep) with its own :SOUR:DEL and :SENS:CURR:NPLC.
+
+    :return: array with shape (len(voltage_levels), num_elements)
+    """
+    chunks, init_times = [], []
+    for delay, nplc, start, num_points in split_settle_segments(delays, nplcs):
+        keithley_inst.write(':SOUR:DEL {};:SENS:CURR:NPLC {}'.format(delay, nplc))
+        init_times.append(time.perf_counter())
+        chunks.append(run_list_sweep(keithley_inst, voltage_levels[start:start + num_points], num_elements, idxT))
+    return stitch_time(chunks, idxT, init_times)
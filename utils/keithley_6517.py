@@ -0,0 +1,645 @@
+import json
+import os
+import re
+import string
+import time
+import numpy as np
+import pandas as pd
+
+from utils.scpi import dict_status_byte_bits, wait_for_status, wait_for_operation_complete
+
+
+# --- ASCII BUFFER DUMPS
+
+dict_ascii_lut = {
+    'VDC': 'Volts',
+    'ADC': 'Amps',
+    'OHM': 'Ohms',
+    'COUL': 'Coulombs',
+    'N': 'Normal',
+    'Z': 'ZeroCheckEnabled',
+    'O': 'Overflow',
+    'U': 'Underflow',
+    'R': 'Reference(Rel)',
+    'L': 'OutOfLimit',
+}
+
+dict_dtypes = {
+    'num': int,
+    'status': 'category',
+    'timestamp': float,
+    'voltage': float,
+    'measure': float,
+    'units': 'category',
+}
+
+# order of the comma-separated fields for each reading in the :TRAC:DATA? response (STAT and UNIT are appended to READ)
+dict_ascii_fields = {
+    'READ': 'measure',
+    'TST': 'timestamp',
+    'RNUM': 'num',
+    'VSO': 'voltage',
+}
+
+# delete every suffix character (e.g., 'NADC', 'secs', 'RDNG#', 'Vsrc') but keep the exponent 'E'
+_ascii_suffix_table = str.maketrans('', '', string.ascii_letters.replace('E', '') + '#')
+# the status character and units that follow the exponent of each READing (e.g., '+1.234567E-12NADC')
+_re_ascii_status_units = re.compile(r'E[-+]\d{2}([A-Z])([A-Z]+)')
+
+
+def parse_ascii(d, e, as_type='pd.DataFrame'):
+    """
+    Parse a full :TRAC:DATA? ASCii response (e.g., ':FORM:ELEM READ,STAT,RNUM,UNIT,TST,VSO') into typed columns.
+
+    All suffixes are stripped from the whole response at once and the remaining numbers are converted in a single
+    numpy call, so a full-size buffer parses in milliseconds. Status and units are returned as categoricals.
+
+    :param d: raw response string from :TRAC:DATA?
+    :param e: data elements, as returned by :FORM:ELEM?
+    :param as_type: 'pd.DataFrame' or 'dict' (of numpy/categorical columns)
+    :return:
+    """
+    d = d.strip()  # remove trailing newline character
+    e = [x.strip() for x in e.strip().split(',')]  # split data elements
+    fields = [x for x in dict_ascii_fields.keys() if x in e]
+    if len(fields) != len([x for x in e if x not in ['STAT', 'UNIT']]):
+        raise ValueError("Only the data elements {} (+ STAT, UNIT) can be parsed.".format(list(dict_ascii_fields)))
+    # - numeric values
+    values = np.array(d.translate(_ascii_suffix_table).split(','), dtype=float)
+    values = np.reshape(values, (-1, len(fields)))
+    # - reshape
+    columns = {}
+    for i, field in enumerate(fields):
+        columns[dict_ascii_fields[field]] = values[:, i]
+    if 'num' in columns.keys():
+        columns['num'] = columns['num'].astype(int)
+    # - status and units (categories are mapped once, instead of once per reading)
+    status_units = _re_ascii_status_units.findall(d)
+    if len(status_units) == len(values):
+        status, units = zip(*status_units)
+        columns['status'] = pd.Categorical(status).rename_categories(lambda x: dict_ascii_lut.get(x, x))
+        columns['units'] = pd.Categorical(units).rename_categories(lambda x: dict_ascii_lut.get(x, x))
+    columns = {k: columns[k] for k in dict_dtypes.keys() if k in columns.keys()}
+
+    if as_type == 'pd.DataFrame':
+        return pd.DataFrame(columns)
+    return columns
+
+
+# --- DATA FORMATS
+
+# :FORM:DATA <name>: single-precision (SREal = REAL,32) and double-precision (DREal = REAL,64) IEEE 754 floats
+dict_binary_datatypes = {
+    'SREal': 'f',
+    'DREal': 'd',
+}
+
+dict_binary_itemsize = {
+    'SREal': 4,
+    'DREal': 8,
+}
+
+# :FORM:BORD <name>: NORMal = most significant byte first, SWAPped = least significant byte first
+dict_byte_order_is_big_endian = {
+    'NORMal': True,
+    'SWAPped': False,
+}
+
+
+def setup_6517_data_format(keithley_inst, data_format='ASCii', byte_order='SWAPped'):
+    """
+    Select the data format used to transfer readings from :FETCh?, :READ?, :SENS:DATA? and :TRAC:DATA?
+
+    NOTE: binary readings are sent as an IEEE-488.2 block (#0 followed by the raw bytes). Every data element in
+    :FORM:ELEM is sent as one float (e.g., READ,TST,VSO = 3 floats per reading). Units and status are not sent.
+
+    :param keithley_inst: pyvisa resource
+    :param data_format: 'ASCii', 'SREal' (4 bytes/value) or 'DREal' (8 bytes/value)
+    :param byte_order: 'SWAPped' (little-endian, native to a PC so no byte-swapping on the host) or 'NORMal'
+    :return:
+    """
+    if data_format == 'ASCii':
+        keithley_inst.write(':FORM:DATA ASCii')  # Select data format: ASCii, REAL, SREal, DREal
+    elif data_format in dict_binary_datatypes.keys():
+        keithley_inst.write(':FORM:DATA ' + data_format)  # Select data format: ASCii, REAL, SREal, DREal
+        keithley_inst.write(':FORM:BORD ' + byte_order)  # Select byte order: NORMal or SWAPped
+    else:
+        raise ValueError("Data format not understood. Options are: ['ASCii', 'SREal', 'DREal'].")
+
+
+def query_6517_values(keithley_inst, command, data_format='ASCii', byte_order='SWAPped'):
+    """
+    Query readings and return them as a 1D numpy array, regardless of the data format.
+
+    :param keithley_inst: pyvisa resource
+    :param command: ':FETCh?', ':READ?', ':SENS:DATA?', ':TRAC:DATA?'
+    :param data_format: must match the format set by setup_6517_data_format()
+    :param byte_order: must match the byte order set by setup_6517_data_format()
+    :return:
+    """
+    if data_format == 'ASCii':
+        return keithley_inst.query_ascii_values(command, container=np.array)
+    elif data_format in dict_binary_datatypes.keys():
+        return keithley_inst.query_binary_values(
+            command,
+            datatype=dict_binary_datatypes[data_format],
+            is_big_endian=dict_byte_order_is_big_endian[byte_order],
+            container=np.array,
+        )
+    else:
+        raise ValueError("Data format not understood. Options are: ['ASCii', 'SREal', 'DREal'].")
+
+
+def fetch_6517(keithley_inst, data_format='ASCii', byte_order='SWAPped'):
+    """ Drop-in replacement for keithley_inst.query_ascii_values(':FETCh?') """
+    return query_6517_values(keithley_inst, ':FETCh?', data_format=data_format, byte_order=byte_order)
+
+
+def read_6517_buffer(keithley_inst, num_elements, data_format='ASCii', byte_order='SWAPped'):
+    """
+    Dump the whole reading buffer (:TRAC:DATA?) in one transfer and reshape to (num_readings, num_elements).
+
+    NOTE: only use this for buffers that were read with a numeric :FORM:ELEM (e.g., READ,TST,VSO). If STAT, RNUM or
+    UNIT are included in ASCii format, then the response is text and must be parsed (see parse_ascii).
+
+    :param keithley_inst: pyvisa resource
+    :param num_elements: number of data elements in :FORM:ELEM
+    :param data_format: must match the format set by setup_6517_data_format()
+    :param byte_order: must match the byte order set by setup_6517_data_format()
+    :return:
+    """
+    data = query_6517_values(keithley_inst, ':TRAC:DATA?', data_format=data_format, byte_order=byte_order)
+    return np.reshape(data, (-1, num_elements))
+
+
+def estimate_6517_transfer_size(num_values, data_format):
+    """
+    Estimate the number of bytes sent over the bus for a binary transfer: '#0' header + values + line feed.
+    """
+    return 2 + num_values * dict_binary_itemsize[data_format] + 1
+
+
+# --- BUFFERED SWEEPS
+
+# NOTE: READ, STAT, RNUM, and UNIT are always enabled for the buffer and are included in the response for :ELEM?
+buffer_elements = 'READ,STAT,RNUM,UNIT,TST,VSO'
+
+# max buffer readings (i.e., size): including additional elem[TIMESTAMP, VSOURCE] is 8566
+max_buffer_points = 8566
+
+
+def setup_6517_buffer_control(keithley_inst, num_points):
+    """
+    Store num_points readings (with timestamp and source voltage) in the buffer, then stop (fill-and-stop).
+    """
+    # --- Data elements in :FORM and :TRAC must match
+    keithley_inst.write(':FORM:DATA ASCii')  # Select data format: ASCii, REAL, SREal, DREal
+    keithley_inst.write(':FORM:ELEM ' + buffer_elements)  # data elements: VSOurce, READing, RNUMber, UNITs, TSTamp, STATus
+    keithley_inst.write(':TRAC:ELEM TST,VSO')  # data elements: TSTamp, VSOurce, CHANnel, ETEMperature, HUMidity, NONE
+    keithley_inst.write(':TRAC:TST:FORM ABS')  # ABSolute: reference each timestamp to the first buffer reading
+    # ---
+    keithley_inst.write(':TRAC:CLE')  # Clear buffer
+    keithley_inst.write(':TRAC:POIN ' + str(num_points))  # Specify the size of the buffer (sets :TRAC:FEED:CONT NEV)
+    keithley_inst.write(':TRAC:FEED:CONT NEXT')  # Buffer control: Fill-and-stop (options: NEVer, ALWays, PRETrigger)
+    # NOTE: see the "Coupled Commands" on page 331 of manual because many of these^
+    # commands turn each other on or off so it's important to get the order correct.
+
+
+def wait_for_6517_buffer(keithley_inst, num_points, poll_interval=0.1, timeout=None):
+    """
+    Poll the number of readings stored in the buffer (:TRAC:POIN:ACT?) until it reaches num_points.
+    """
+    tic = time.perf_counter()
+    while int(float(keithley_inst.query(':TRAC:POIN:ACT?'))) < num_points:
+        if timeout is not None and time.perf_counter() - tic > timeout:
+            raise ValueError("Buffer did not fill within {} s.".format(timeout))
+        time.sleep(poll_interval)
+
+
+# measurement event register: BFL (bit B9) is set when the trace buffer is full (pg. 303 of 6517b programming manual)
+buffer_full_bit = 512
+
+
+def setup_6517_buffer_full_srq(keithley_inst):
+    """
+    Summarize "buffer full" in the MSB bit of the status byte and request service when it is set.
+
+    NOTE: the STATus subsystem is not affected by *RST, so call this after *RST and before :INIT (or :TSEQ:ARM).
+    """
+    keithley_inst.write(':STAT:PRES')  # Return status registers to default state
+    keithley_inst.write('*CLS')  # Clear event registers and error queue
+    keithley_inst.write(':STAT:MEAS:ENAB ' + str(buffer_full_bit))  # Summarize Buffer Full in the status byte (MSB)
+    keithley_inst.write('*SRE ' + str(dict_status_byte_bits['MSB']))  # Request service when MSB is set
+
+
+def wait_for_6517_buffer_full(keithley_inst, timeout=60, use_srq=False, callback=None, **kwargs):
+    """
+    Block until the buffer is full (see setup_6517_buffer_full_srq), then clear the measurement event register.
+
+    :param keithley_inst: pyvisa resource
+    :param timeout: (s) raise ValueError if the buffer is not full within timeout
+    :param use_srq: if True, block on SRQ (GPIB); otherwise, serial poll the status byte with backoff
+    :param callback: function called as callback(status_byte, elapsed_time) once the buffer is full
+    :param kwargs: passed to wait_for_status (e.g., poll_interval, max_poll_interval)
+    :return: status byte, or the return value of callback
+    """
+    status = wait_for_status(keithley_inst, dict_status_byte_bits['MSB'], timeout=timeout, use_srq=use_srq,
+                             callback=callback, **kwargs)
+    keithley_inst.query(':STAT:MEAS:EVEN?')  # Reading the event register clears it (and MSB)
+    return status
+
+
+def drain_6517_buffer(keithley_inst, num_points, data_elements=buffer_elements, poll_interval=1.0, timeout=None,
+                      consumer_queue=None, range_command=':TRAC:DATA:SEL? {},{}'):
+    """
+    Read the buffer while it is filling: poll :TRAC:POIN:ACT? and fetch only the readings stored since the last poll.
+
+    Readings are written into columns preallocated for num_points, so host memory does not grow during long
+    acquisitions. Each newly read chunk is also put on consumer_queue as (start index, dict of columns), so the
+    acquisition can be monitored (or saved) while it runs; None is put on the queue when the buffer is full.
+
+    :param keithley_inst: pyvisa resource
+    :param num_points: number of readings to wait for (i.e., :TRAC:POIN)
+    :param data_elements: data elements, as returned by :FORM:ELEM? (must be ASCii)
+    :param poll_interval: (s) time between :TRAC:POIN:ACT? polls
+    :param timeout: (s) raise ValueError if the buffer is not full within timeout
+    :param consumer_queue: queue.Queue (optional)
+    :param range_command: query that returns a range of readings from the buffer, formatted with (start, count)
+    :return: pd.DataFrame
+    """
+    columns = {}
+    num_read = 0
+    tic = time.perf_counter()
+    while num_read < num_points:
+        num_stored = min(int(float(keithley_inst.query(':TRAC:POIN:ACT?'))), num_points)
+        if num_stored > num_read:
+            chunk = parse_ascii(d=keithley_inst.query(range_command.format(num_read, num_stored - num_read)),
+                                e=data_elements, as_type='dict')
+            for k, v in chunk.items():
+                if k not in columns:
+                    # status and units are stored as objects and converted back to categories when the drain is done
+                    dtype = dict_dtypes[k] if dict_dtypes[k] != 'category' else object
+                    columns[k] = np.zeros(num_points, dtype=dtype) if dtype is int else np.full(num_points, np.nan,
+                                                                                               dtype=dtype)
+                columns[k][num_read:num_stored] = np.asarray(v)
+            if consumer_queue is not None:
+                consumer_queue.put((num_read, chunk))
+            num_read = num_stored
+        elif timeout is not None and time.perf_counter() - tic > timeout:
+            raise ValueError("Buffer did not fill within {} s ({}/{} readings).".format(timeout, num_read, num_points))
+        else:
+            time.sleep(poll_interval)
+    if consumer_queue is not None:
+        consumer_queue.put(None)
+    df = pd.DataFrame(columns)
+    for k in ['status', 'units']:
+        if k in df.columns:
+            df[k] = df[k].astype('category')
+    return df
+
+
+def read_6517_buffer_readings(keithley_inst):
+    """
+    Dump the buffer in one transfer and return an array of (READ, TST, VSO) columns, i.e., the same columns
+    as :FETCh? with :FORM:ELEM READ,TST,VSO.
+    """
+    df = parse_ascii(d=keithley_inst.query(':TRAC:DATA?'), e=buffer_elements, as_type='dict')
+    return np.column_stack([df['measure'], df['timestamp'], df['voltage']])
+
+
+def split_6517_sweep_segments(voltages):
+    """
+    Split a voltage schedule into segments with a constant step, e.g., [0, 1, 2, 3, 2, 1, 0, 0, 0] ->
+    [(0, 3, 1, 4), (2, 0, -1, 3), (0, 0, 0, 2)]
+
+    :param voltages: voltage schedule
+    :return: list of segments: (start, stop, step, num_points)
+    """
+    voltages = np.asarray(voltages, dtype=float)
+    segments = []
+    i, n = 0, len(voltages)
+    while i < n:
+        j = i
+        step = voltages[i + 1] - voltages[i] if i + 1 < n else 0.0
+        while j + 1 < n and np.isclose(voltages[j + 1] - voltages[j], step):
+            j += 1
+        segments.append((voltages[i], voltages[j], step, j - i + 1))
+        i = j + 1
+    return segments
+
+
+def setup_6517_tseq_segment(keithley_inst, segment, step_time):
+    """
+    Program one constant-step segment as a test sequence: staircase sweep (STSW) or constant voltage (CLE).
+    See page 210 in manual for :TSEQ programming commands.
+    """
+    start, stop, step, num_points = segment
+    if step == 0:
+        keithley_inst.write(':TSEQ:TYPE CLE')  # Select the desired test sequence
+        keithley_inst.write(':TSEQ:CLE:SVOL ' + str(start))  # -1000 to 1000 V
+        keithley_inst.write(':TSEQ:CLE:SPO ' + str(num_points))  # 1 to Max Buffer Size
+        keithley_inst.write(':TSEQ:CLE:SPIN ' + str(step_time))  # 0 to 99999.9 s (interval between meas. points)
+    else:
+        keithley_inst.write(':TSEQ:TYPE STSW')  # Select the desired test sequence
+        keithley_inst.write(':TSEQ:STSW:STARt ' + str(start))  # -1000 to 1000 V
+        keithley_inst.write(':TSEQ:STSW:STOP ' + str(stop))  # -1000 to 1000 V
+        keithley_inst.write(':TSEQ:STSW:STEP ' + str(step))  # -1000 to 1000 V
+        keithley_inst.write(':TSEQ:STSW:STIMe ' + str(step_time))  # 0 to 9999.9 s (soak time, bias time)
+    keithley_inst.write(':TSEQ:TSO IMM')  # IMM: the test will start as soon as TSEQ:ARM is sent
+
+
+def run_6517_tseq_sweep(keithley_inst, voltages, step_time, poll_interval=0.1, ranges=None):
+    """
+    Run a voltage schedule as a series of on-instrument test sequences, one per constant-step segment (e.g., a ramp
+    up and down is 2 staircase sweeps). Each segment is timed by the instrument and read back in one transfer.
+
+    NOTE: the buffer timestamps restart at each segment, so segments are stitched using the host time at which each
+    segment was armed.
+    NOTE: if ranges (current range at each step) is given, segments are also split where the range changes, and the
+    range is written before arming the segment.
+    """
+    if ranges is None:
+        segments = [(None, segment) for segment in split_6517_sweep_segments(voltages)]
+    else:
+        segments = [(current_range, segment) for current_range, start, num_points in split_6517_range_segments(ranges)
+                    for segment in split_6517_sweep_segments(voltages[start:start + num_points])]
+    data, time_start, range_prev = [], None, None
+    for current_range, segment in segments:
+        num_points = segment[3]
+        if current_range is not None and current_range != range_prev:
+            keithley_inst.write(':SENS:CURR:RANG ' + str(current_range))  # Select current range (disables autorange)
+            range_prev = current_range
+        keithley_inst.write(':TRIG:COUN ' + str(num_points))  # Set measure count (1 to 99999 or INF)
+        setup_6517_buffer_control(keithley_inst, num_points)
+        setup_6517_tseq_segment(keithley_inst, segment, step_time)
+        tic = time.perf_counter()
+        if time_start is None:
+            time_start = tic
+        keithley_inst.write(':TSEQ:ARM')  # Arm the selected test sequence
+        time.sleep(num_points * step_time)
+        wait_for_6517_buffer(keithley_inst, num_points, poll_interval=poll_interval)
+        segment_data = read_6517_buffer_readings(keithley_inst)
+        segment_data[:, 1] += tic - time_start
+        data.append(segment_data)
+    return np.vstack(data)
+
+
+def run_6517_timer_sweep(keithley_inst, voltages, step_time, sampling_interval, poll_interval=0.1, ranges=None):
+    """
+    Sample into the buffer at a fixed interval (trigger TIMer) while the host only writes :SOUR:VOLT at each step.
+
+    Readings are never fetched during the sweep, so the sampling rate is set by NPLC and the trigger timer instead of
+    host round trips. Each reading stores the source voltage (VSO) at the time it was made.
+
+    NOTE: if ranges (current range at each step) is given, :SENS:CURR:RANG is written only at the steps where the range
+    changes, in the same message as :SOUR:VOLT.
+    """
+    num_points = int(np.ceil(len(voltages) * step_time / sampling_interval))
+    if num_points > max_buffer_points:
+        raise ValueError("Number of readings ({}) exceeds the buffer size ({}). "
+                         "Increase sampling_interval.".format(num_points, max_buffer_points))
+    keithley_inst.write(':TRIG:SOUR TIM')  # Select control source (HOLD, IMMediate, TIMer, MANual, BUS, TLINk, EXTernal)
+    keithley_inst.write(':TRIG:TIM ' + str(sampling_interval))  # Timer interval: 0.001 to 999999.999 s
+    keithley_inst.write(':TRIG:COUN ' + str(num_points))  # Set measure count (1 to 99999 or INF)
+    setup_6517_buffer_control(keithley_inst, num_points)
+    if ranges is not None:
+        keithley_inst.write(':SENS:CURR:RANG ' + str(ranges[0]))  # Select current range (disables autorange)
+    # run
+    keithley_inst.write(':SOUR:VOLT ' + str(voltages[0]))  # Set voltage level
+    keithley_inst.write(':INIT')  # Move from IDLE state to ARM Layer 1
+    tic = time.perf_counter()
+    for i, v in enumerate(voltages[1:]):
+        time.sleep(max(0.0, tic + (i + 1) * step_time - time.perf_counter()))
+        if ranges is not None and ranges[i + 1] != ranges[i]:
+            keithley_inst.write(':SENS:CURR:RANG {};:SOUR:VOLT {}'.format(ranges[i + 1], v))
+        else:
+            keithley_inst.write(':SOUR:VOLT ' + str(v))  # Set voltage level
+    wait_for_6517_buffer(keithley_inst, num_points, poll_interval=poll_interval)
+    return read_6517_buffer_readings(keithley_inst)
+
+
+def run_6517_buffered_sweep(keithley_inst, voltages, step_time, sampling_interval=None, mode='TIMER', ranges=None):
+    """
+    Run a voltage schedule using the 6517 trigger model and reading buffer instead of a :SOUR:VOLT + :FETCh? loop.
+
+    The source and sense functions must already be set up and the output turned on.
+
+    NOTE: the 6517b voltage source has no list mode, and a test sequence (:TSEQ) only runs one linear staircase
+    (STSW) or constant level (CLE). So an arbitrary schedule (e.g., ramp up and down, repeated cycles) cannot be
+    handed to the instrument as a whole: with 'TIMER', readings are timed by the instrument but the host writes each
+    step; with 'TSEQ', each constant-step segment is timed by the instrument but the host arms the next segment once
+    the previous one is done (so segments are separated by one bus round trip and a buffer read). Readings are never
+    fetched per step in either mode.
+
+    :param keithley_inst: pyvisa resource
+    :param voltages: voltage schedule
+    :param step_time: dwell time (s) at each voltage
+    :param sampling_interval: (mode='TIMER' only) time (s) between readings; default: one reading per step
+    :param mode: 'TIMER' (any schedule, host-timed steps) or 'TSEQ' (instrument-timed constant-step segments)
+    :param ranges: current range at each step (see plan_6517_current_ranges); default: keep the current range setting
+    :return: array of (READ, TST, VSO) columns
+    """
+    if mode == 'TIMER':
+        if sampling_interval is None:
+            sampling_interval = step_time
+        return run_6517_timer_sweep(keithley_inst, voltages, step_time, sampling_interval, ranges=ranges)
+    elif mode == 'TSEQ':
+        return run_6517_tseq_sweep(keithley_inst, voltages, step_time, ranges=ranges)
+    else:
+        raise ValueError("Sweep mode not understood. Options are: ['TIMER', 'TSEQ'].")
+
+
+# --- CURRENT RANGE PLANNING
+
+# current ranges (A) of the 6517b ammeter (:SENS:CURR:RANG); readings are valid up to 105% of the range
+current_ranges = np.array([20e-12, 200e-12, 2e-9, 20e-9, 200e-9, 2e-6, 20e-6, 200e-6, 2e-3, 20e-3])
+
+
+def plan_6517_current_ranges(currents, headroom=1.25, min_points=1):
+    """
+    Pick the most sensitive current range at each step that still fits the expected current with headroom, so a
+    sweep can use fixed ranges (no autorange time per reading) without saturating where the current is large.
+
+    :param currents: expected current at each step (e.g., run_6517_pilot_sweep or estimate_6517_currents); NaN or
+        overflow (9.9e37) -> largest range
+    :param headroom: each range must be >= headroom x |expected current|
+    :param min_points: runs of fewer than min_points steps on a more sensitive range than a neighbouring run are
+        raised to that run's range (i.e., fewer range changes)
+    :return: array of ranges
+    """
+    currents = np.abs(np.asarray(currents, dtype=float)) * headroom
+    index = np.searchsorted(current_ranges, np.nan_to_num(currents, nan=np.inf), side='left')
+    ranges = current_ranges[np.clip(index, 0, len(current_ranges) - 1)]
+    changed = min_points > 1
+    while changed:
+        changed = False
+        segments = split_6517_range_segments(ranges)
+        for i, (current_range, start, num_points) in enumerate(segments):
+            neighbours = [segments[j][0] for j in [i - 1, i + 1]
+                          if 0 <= j < len(segments) and segments[j][0] > current_range]
+            if num_points < min_points and neighbours:
+                ranges[start:start + num_points] = min(neighbours)
+                changed = True
+                break
+    return ranges
+
+
+def split_6517_range_segments(ranges):
+    """
+    Split a range schedule into runs of the same range, e.g., [2e-9, 2e-9, 20e-9, 2e-9] ->
+    [(2e-9, 0, 2), (20e-9, 2, 1), (2e-9, 3, 1)]
+
+    :return: list of segments: (range, start index, num_points)
+    """
+    ranges = np.asarray(ranges, dtype=float)
+    starts = np.flatnonzero(np.concatenate([[True], ranges[1:] != ranges[:-1]]))
+    stops = np.append(starts[1:], len(ranges))
+    return [(ranges[i], i, j - i) for i, j in zip(starts, stops)]
+
+
+def estimate_6517_currents(voltages, previous_voltages, previous_currents):
+    """
+    Expected current at each voltage from previous runs of the same device: the largest |current| measured at each
+    voltage, interpolated between measured voltages.
+
+    :param voltages: voltage schedule to plan
+    :param previous_voltages: source voltages (VSO) of previous runs (concatenate several runs)
+    :param previous_currents: currents (READ) of previous runs
+    :return: array of expected |current| at each voltage
+    """
+    dfg = pd.DataFrame({'voltage': np.ravel(previous_voltages), 'current': np.abs(np.ravel(previous_currents))}
+                       ).groupby('voltage')['current'].max()
+    return np.interp(np.asarray(voltages, dtype=float), dfg.index.to_numpy(), dfg.to_numpy())
+
+
+# settings changed by run_6517_timer_sweep (and the pilot sweep), in the order they are restored
+# NOTE: :TRIG:COUN and :TRAC:POIN reset buffer control (:TRAC:FEED:CONT), and :SENS:CURR:RANG disables autorange
+pilot_sweep_settings = [
+    ':FORM:DATA',
+    ':FORM:ELEM',
+    ':TRAC:ELEM',
+    ':TRAC:TST:FORM',
+    ':TRIG:SOUR',
+    ':TRIG:TIM',
+    ':TRIG:COUN',
+    ':TRAC:POIN',
+    ':TRAC:FEED:CONT',
+    ':SENS:CURR:NPLC',
+    ':SENS:CURR:RANG',
+    ':SENS:CURR:RANG:AUTO',
+    ':SOUR:VOLT',
+]
+
+
+def run_6517_pilot_sweep(keithley_inst, voltages, step_time, nplc=0.1, sampling_interval=None):
+    """
+    Fast autoranged pass over a voltage schedule (low NPLC, readings into the buffer as in run_6517_timer_sweep) to
+    find the current at each step before the real sweep. Every setting it changes (see pilot_sweep_settings) is
+    restored, so a :SOUR:VOLT + :FETCh? loop can follow it without being set up again.
+
+    NOTE: the pilot captures the charging current after each step, so use the same (or a shorter) step_time as the
+    real sweep.
+
+    :return: largest |current| measured at each voltage of the schedule (see estimate_6517_currents)
+    """
+    if sampling_interval is None:
+        sampling_interval = step_time / 4
+    settings = {x: keithley_inst.query(x + '?').strip() for x in pilot_sweep_settings}
+    keithley_inst.write(':SENS:CURR:NPLC ' + str(nplc))  # Set integration rate in line cycles (0.01 to 10)
+    keithley_inst.write(':SENS:CURR:RANG:AUTO ON')  # Enable autorange
+    data = run_6517_timer_sweep(keithley_inst, voltages, step_time, sampling_interval)
+    for header, value in settings.items():
+        keithley_inst.write(header + ' ' + value)
+    # readings are matched to steps by their source voltage (VSO), not their timestamps, which are not synchronized
+    # with the host-timed steps
+    return estimate_6517_currents(voltages, data[:, 2], data[:, 0])
+
+
+# --- ZERO CORRECTION
+
+# zero corrections (when, on which range, at what temperature) are kept here between script invocations
+default_zero_correct_file = os.path.join(os.path.expanduser('~'), 'py-pennathur-lab_zero_correct.json')
+
+
+class ZeroCorrectCache:
+    """
+    Acquire a zero correction (:SYST:ZCOR:ACQ) only when the last one is stale, instead of before every run.
+
+    Each acquisition is recorded (per instrument: time, current range and, optionally, temperature) in state_file.
+    ensure() reuses the recorded correction (i.e., only enables zero correct) if it was acquired on the same range,
+    less than max_age ago, and within max_temperature_change of the current temperature; otherwise, it acquires a new one.
+
+        zero_correct = ZeroCorrectCache()
+        zero_correct.ensure(k3, current_range=20e-9, temperature=23.1)  # temperature is optional
+        k3.write(':SYST:ZCH OFF')  # zero check is left on: turn it off immediately before measuring
+
+    NOTE: the correction value is kept by the instrument until it is power cycled, and is not cleared by *RST (which only
+    disables zero correct). After a power cycle (or a change of function), call invalidate().
+    """
+
+    def __init__(self, state_file=default_zero_correct_file, max_age=3600, max_temperature_change=1.0):
+        self.state_file = state_file
+        self.max_age = max_age
+        self.max_temperature_change = max_temperature_change
+        self.records = {}
+        self.num_acquired = 0
+        self.num_reused = 0
+        self.load_state()
+
+    def is_valid(self, resource_name, current_range, temperature=None):
+        record = self.records.get(resource_name)
+        if record is None or float(record['range']) != float(current_range):
+            return False
+        if time.time() - record['time'] > self.max_age:
+            return False
+        if temperature is not None and record['temperature'] is not None:
+            return abs(temperature - record['temperature']) <= self.max_temperature_change
+        return True
+
+    def acquire(self, keithley_inst, current_range, temperature=None):
+        """ Acquire a zero correction on current_range (see page 79-81 of 6517b manual) and record it. """
+        keithley_inst.write(':SYST:ZCH ON')  # Enable (ON) or disable (OFF) zero check (default: OFF)
+        keithley_inst.write(':SENS:FUNC "CURR"')  # 'VOLTage[:DC]', 'CURRent[:DC]', 'RESistance', 'CHARge'
+        keithley_inst.write(':SENS:CURR:RANG ' + str(current_range))  # Select current range (disables autorange)
+        wait_for_operation_complete(keithley_inst, timeout=5)
+        keithley_inst.write(':SYST:ZCOR:ACQ')  # Acquire zero correction value
+        wait_for_operation_complete(keithley_inst, timeout=5)
+        keithley_inst.write(':SYST:ZCOR ON')  # Enable (ON) or disable (OFF) zero correct (default: OFF)
+        self.records[keithley_inst.resource_name] = {'time': time.time(), 'range': float(current_range),
+                                                     'temperature': temperature}
+        self.num_acquired += 1
+        self.save_state()
+
+    def ensure(self, keithley_inst, current_range, temperature=None):
+        """
+        Enable zero correct on current_range, acquiring a new correction only if the recorded one is stale.
+
+        :return: True if a new zero correction was acquired
+        """
+        if not self.is_valid(keithley_inst.resource_name, current_range, temperature):
+            self.acquire(keithley_inst, current_range, temperature)
+            return True
+        keithley_inst.write(':SYST:ZCH ON')  # Enable (ON) or disable (OFF) zero check (default: OFF)
+        keithley_inst.write(':SENS:CURR:RANG ' + str(current_range))  # Select current range (disables autorange)
+        keithley_inst.write(':SYST:ZCOR ON')  # Enable (ON) or disable (OFF) zero correct (default: OFF)
+        self.num_reused += 1
+        return False
+
+    def invalidate(self, resource_name=None):
+        """ Forget the zero correction of one instrument (default: all), so that the next ensure() acquires one. """
+        if resource_name is None:
+            self.records.clear()
+        else:
+            self.records.pop(resource_name, None)
+        self.save_state()
+
+    def load_state(self):
+        if self.state_file is not None and os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as f:
+                self.records.update(json.load(f))
+
+    def save_state(self):
+        if self.state_file is None:
+            return
+        with open(self.state_file, 'w') as f:
+            json.dump(self.records, f, indent=2)
@@ -0,0 +1,221 @@
+import socket
+import selectors
+import time
+import numpy as np
+
+
+# --- RAW SOCKET TRANSPORT
+
+# numpy dtypes for pyvisa's struct-style datatypes (see query_binary_values)
+dict_block_datatypes = {
+    'f': 'f4',
+    'd': 'f8',
+    'h': 'i2',
+    'i': 'i4',
+    'b': 'i1',
+    'B': 'u1',
+}
+
+
+def is_socket_resource(resource_name):
+    """ True for VISA raw socket resource names, e.g., 'TCPIP0::192.168.1.25::5025::SOCKET'. """
+    parts = resource_name.upper().split('::')
+    return len(parts) == 4 and parts[0].startswith('TCPIP') and parts[3] == 'SOCKET'
+
+
+def open_socket_resource(resource_name, **kwargs):
+    """ Open a VISA raw socket resource name (see is_socket_resource) as a SocketInstrument. """
+    _, address, port, _ = resource_name.split('::')
+    return SocketInstrument(address, int(port), **kwargs)
+
+
+class SocketInstrument:
+    """
+    Stand-in for a pyvisa TCPIP SOCKET resource (e.g., a 2450 on port 5025), using a non-blocking raw socket.
+
+    Supports the same calls the scripts make on pyvisa resources (write, read, read_raw, query, query_ascii_values,
+    query_binary_values, timeout, close), so it can be passed wherever a resource is expected. In addition:
+        * IEEE-488.2 definite-length blocks (#<n><length><data>) are read straight into a preallocated buffer, so large
+          buffer dumps are not split into fixed-size recv() calls or copied chunk by chunk.
+        * query_pipelined() sends several queries in one message and then reads the responses in order, so the
+          instrument never waits on a host round trip between queries.
+
+    NOTE: every wait is bounded by timeout (ms, like pyvisa) and raises TimeoutError.
+    """
+
+    def __init__(self, address, port=5025, timeout=10000, write_termination='\n', read_termination='\n',
+                 chunk_size=65536):
+        self.resource_name = 'TCPIP::{}::{}::SOCKET'.format(address, port)
+        self.timeout = timeout
+        self.write_termination = write_termination
+        self.read_termination = read_termination
+        self.sock = socket.create_connection((address, port), timeout=timeout / 1000)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.write_selector = selectors.DefaultSelector()
+        self.write_selector.register(self.sock, selectors.EVENT_WRITE)
+        self.chunk = bytearray(chunk_size)
+        self.pending = bytearray()
+
+    # - low-level I/O
+
+    def _deadline(self):
+        return time.perf_counter() + self.timeout / 1000
+
+    def _wait_readable(self, deadline):
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0 or not self.selector.select(timeout=remaining):
+            raise TimeoutError("No response from {} within {} ms.".format(self.resource_name, self.timeout))
+
+    def _wait_writable(self, deadline):
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0 or not self.write_selector.select(timeout=remaining):
+            raise TimeoutError("{} did not accept data within {} ms.".format(self.resource_name, self.timeout))
+
+    def _send_all(self, message, deadline):
+        """ Send all of message, waiting while the send buffer is full (e.g., a long list or a script upload). """
+        view = memoryview(message)
+        while len(view):
+            try:
+                n = self.sock.send(view)
+            except BlockingIOError:
+                self._wait_writable(deadline)
+                continue
+            view = view[n:]
+
+    def _recv_into(self, view, deadline):
+        """ Receive exactly len(view) bytes into view (after using any bytes already received). """
+        num_pending = min(len(self.pending), len(view))
+        view[:num_pending] = self.pending[:num_pending]
+        del self.pending[:num_pending]
+        num_received = num_pending
+        while num_received < len(view):
+            try:
+                n = self.sock.recv_into(view[num_received:])
+            except BlockingIOError:
+                self._wait_readable(deadline)
+                continue
+            if n == 0:
+                raise ConnectionError("{} closed the connection.".format(self.resource_name))
+            num_received += n
+
+    def _fill(self, deadline):
+        """ Receive whatever is available (at least one byte) into pending. """
+        while True:
+            try:
+                n = self.sock.recv_into(self.chunk)
+            except BlockingIOError:
+                self._wait_readable(deadline)
+                continue
+            if n == 0:
+                raise ConnectionError("{} closed the connection.".format(self.resource_name))
+            self.pending += self.chunk[:n]
+            return
+
+    def _read_exactly(self, num_bytes, deadline):
+        buffer = bytearray(num_bytes)
+        self._recv_into(memoryview(buffer), deadline)
+        return buffer
+
+    def _read_until_termination(self, deadline):
+        termination = self.read_termination.encode()
+        while True:
+            index = self.pending.find(termination)
+            if index >= 0:
+                message = bytes(self.pending[:index])
+                del self.pending[:index + len(termination)]
+                return message
+            self._fill(deadline)
+
+    def _read_block(self, deadline, out=None):
+        """
+        Read an IEEE-488.2 block: #<n><length><data> (definite length) or #0<data><LF> (indefinite length).
+
+        :param out: preallocated writable buffer (e.g., a bytearray or a numpy array's .data) to read the data into
+        :return: memoryview of the data
+        """
+        # find the start of the block header
+        while b'#' not in self.pending:
+            self._fill(deadline)
+        del self.pending[:self.pending.index(b'#')]
+        while len(self.pending) < 2:
+            self._fill(deadline)
+        num_digits = int(chr(self.pending[1]))
+        if num_digits == 0:
+            del self.pending[:2]
+            # NOTE: data must not contain the termination character (indefinite-length blocks end at LF)
+            data = self._read_until_termination(deadline)
+            if out is None:
+                return memoryview(bytearray(data))
+            view = memoryview(out).cast('B')
+            view[:len(data)] = data
+            return view[:len(data)]
+        while len(self.pending) < 2 + num_digits:
+            self._fill(deadline)
+        length = int(self.pending[2:2 + num_digits].decode())
+        del self.pending[:2 + num_digits]
+        if out is None:
+            out = bytearray(length)
+        view = memoryview(out).cast('B')[:length]
+        self._recv_into(view, deadline)
+        # discard the termination character that follows the block
+        self._read_until_termination(deadline)
+        return view
+
+    # - pyvisa-like API
+
+    def write(self, command):
+        self._send_all((command + self.write_termination).encode(), self._deadline())
+
+    def write_raw(self, message):
+        self._send_all(message, self._deadline())
+
+    def read_raw(self):
+        return self._read_until_termination(self._deadline())
+
+    def read(self):
+        return self.read_raw().decode()
+
+    def query(self, command):
+        self.write(command)
+        return self.read()
+
+    def query_ascii_values(self, command, converter='f', separator=',', container=list):
+        response = self.query(command).strip()
+        if not response:
+            return container([])
+        values = np.array(response.split(separator), dtype=float if converter in ['f', 'e', 'g'] else converter)
+        return values if container is np.array else container(values)
+
+    def query_binary_values(self, command, datatype='f', is_big_endian=False, container=list, out=None):
+        """
+        Query an IEEE-488.2 binary block and convert it to values.
+
+        :param out: preallocated numpy array to read the values into (its dtype must match datatype and byte order)
+        """
+        self.write(command)
+        dtype = np.dtype(dict_block_datatypes[datatype]).newbyteorder('>' if is_big_endian else '<')
+        if out is not None:
+            view = self._read_block(self._deadline(), out=out)
+            values = out[:len(view) // out.itemsize]
+        else:
+            values = np.frombuffer(self._read_block(self._deadline()), dtype=dtype)
+        return values if container is np.array else container(values)
+
+    def query_pipelined(self, commands):
+        """
+        Send several queries in one message, then read one response per query (in order).
+
+        NOTE: the responses must be plain (termination-delimited) responses, not binary blocks.
+        """
+        self.write_raw(''.join(command + self.write_termination for command in commands).encode())
+        deadline = self._deadline()
+        return [self._read_until_termination(deadline).decode() for _ in commands]
+
+    def close(self):
+        for selector in [self.selector, self.write_selector]:
+            selector.unregister(self.sock)
+            selector.close()
+        self.sock.close()
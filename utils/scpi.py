@@ -0,0 +1,459 @@
+import os
+import re
+import json
+import time
+
+
+# --- COMMAND BATCHING
+
+# conservative message lengths (in characters) that fit in each instrument's input buffer
+dict_max_message_length = {
+    '6517a': 512,
+    '6517b': 512,
+    '2410': 1024,
+    '33210a': 512,
+}
+
+
+def join_commands(commands, max_length=512):
+    """
+    Join SCPI commands into as few semicolon-separated messages as possible, each no longer than max_length.
+
+    NOTE: each command is sent from the root of the command tree (i.e., starts with ':' or '*'). Otherwise, a command
+    that follows a ';' would be interpreted relative to the path of the previous command.
+
+    :param commands: list of SCPI commands (writes only, no queries)
+    :param max_length: maximum number of characters per message
+    :return: list of messages
+    """
+    messages, message = [], ''
+    for command in commands:
+        command = command.strip()
+        if not command.startswith((':', '*')):
+            command = ':' + command
+        if message and len(message) + 1 + len(command) <= max_length:
+            message = message + ';' + command
+        else:
+            if message:
+                messages.append(message)
+            message = command
+    if message:
+        messages.append(message)
+    return messages
+
+
+def check_scpi_errors(inst, max_errors=20):
+    """
+    Read the error queue until it is empty and raise if the instrument reported any errors.
+    """
+    errors = []
+    for i in range(max_errors):
+        error = inst.query(':SYST:ERR?').strip()
+        if int(error.split(',')[0]) == 0:
+            break
+        errors.append(error)
+    if errors:
+        raise ValueError("Instrument reported errors: {}".format(errors))
+
+
+def write_batch(inst, commands, max_length=512, check_errors=False):
+    """
+    Write a list of configuration commands in as few bus transactions as possible.
+
+    :param inst: pyvisa resource
+    :param commands: list of SCPI commands (writes only, no queries)
+    :param max_length: maximum number of characters per message (see dict_max_message_length)
+    :param check_errors: if True, query :SYST:ERR? after each message and raise on any error
+    :return:
+    """
+    for message in join_commands(commands, max_length=max_length):
+        inst.write(message)
+        if check_errors:
+            check_scpi_errors(inst)
+
+
+# resource methods that BatchWriter calls only after sending the queued writes (reads, queries, triggers and close)
+batch_flushed_methods = ['read', 'read_raw', 'read_bytes', 'read_stb', 'query', 'query_ascii_values',
+                         'query_binary_values', 'query_pipelined', 'write_raw', 'assert_trigger', 'wait_for_srq',
+                         'clear', 'close']
+
+
+class BatchWriter:
+    """
+    Stand-in for a pyvisa resource that queues writes and sends them with write_batch().
+
+    Queued writes are flushed before any method in batch_flushed_methods (e.g., a query or read, so responses reflect
+    every command written before it, or close) and on exit. Everything else (e.g., timeout) is passed through to the
+    resource. Typical use:
+
+        with BatchWriter(k1, max_length=dict_max_message_length['6517b']) as k1_batch:
+            setup_6517a_trigger_model(k1_batch, num_points)
+    """
+
+    def __init__(self, inst, max_length=512, check_errors=False):
+        self.__dict__['inst'] = inst
+        self.__dict__['max_length'] = max_length
+        self.__dict__['check_errors'] = check_errors
+        self.__dict__['commands'] = []
+
+    def write(self, command):
+        self.commands.append(command)
+
+    def flush(self):
+        if self.commands:
+            write_batch(self.inst, self.commands, max_length=self.max_length, check_errors=self.check_errors)
+            self.commands.clear()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.inst, name)
+        if name not in batch_flushed_methods:
+            return attribute
+
+        def flushed(*args, **kwargs):
+            self.flush()
+            return attribute(*args, **kwargs)
+        return flushed
+
+    def __setattr__(self, name, value):
+        setattr(self.inst, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+# --- STATUS BYTE / SERVICE REQUESTS
+
+# IEEE-488.2 status byte bits (see "Status Structure" in the 6517b programming manual)
+dict_status_byte_bits = {
+    'MSB': 1,  # Measurement Summary Bit (e.g., buffer full)
+    'EAV': 4,  # Error Available
+    'QSB': 8,  # Questionable Summary Bit
+    'MAV': 16,  # Message Available
+    'ESB': 32,  # Event Summary Bit (e.g., operation complete)
+    'RQS': 64,  # Request for Service (serial poll) / Master Summary Status (*STB?)
+    'OSB': 128,  # Operation Summary Bit
+}
+
+# standard event status register bits
+dict_standard_event_bits = {
+    'OPC': 1,  # Operation Complete
+    'QYE': 4,  # Query Error
+    'DDE': 8,  # Device-Dependent Error
+    'EXE': 16,  # Execution Error
+    'CME': 32,  # Command Error
+}
+
+
+def read_status_byte(inst):
+    """ Serial poll the status byte (does not go through the instrument's command parser, so it works while busy). """
+    if hasattr(inst, 'read_stb'):
+        return int(inst.read_stb())
+    return int(float(inst.query('*STB?')))
+
+
+def wait_for_status(inst, mask, timeout=10, use_srq=False, poll_interval=0.005, max_poll_interval=0.25, backoff=1.5,
+                    callback=None):
+    """
+    Block until any bit in mask is set in the status byte, then return the status byte (or callback's return value).
+
+    If use_srq is True, wait for the instrument to assert SRQ (GPIB only; the bits in mask must also be enabled in
+    *SRE). Otherwise, serial poll the status byte, starting at poll_interval and backing off by a factor of backoff
+    up to max_poll_interval, so short operations return quickly and long ones don't flood the bus.
+
+    :param inst: pyvisa resource
+    :param mask: status byte bits to wait for (see dict_status_byte_bits)
+    :param timeout: (s) raise ValueError if the bits are not set within timeout
+    :param use_srq: if True, block on SRQ instead of polling
+    :param callback: function called as callback(status_byte, elapsed_time) once the bits are set
+    :return: status byte, or the return value of callback
+    """
+    tic = time.perf_counter()
+    if use_srq:
+        from pyvisa.errors import VisaIOError
+        try:
+            inst.wait_for_srq(timeout=int(timeout * 1000))
+        except VisaIOError as e:
+            raise ValueError("No service request within {} s.".format(timeout)) from e
+        status_byte = read_status_byte(inst)
+    else:
+        while True:
+            status_byte = read_status_byte(inst)
+            if status_byte & mask:
+                break
+            if time.perf_counter() - tic > timeout:
+                raise ValueError("Status byte bits {} were not set within {} s (status byte: {}).".format(
+                    mask, timeout, status_byte))
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * backoff, max_poll_interval)
+    if callback is not None:
+        return callback(status_byte, time.perf_counter() - tic)
+    return status_byte
+
+
+def wait_for_operation_complete(inst, timeout=10, use_srq=False, callback=None):
+    """
+    Block until every pending command has finished (*OPC sets the OPC bit of the standard event register, which is
+    summarized in the ESB bit of the status byte). Unlike *OPC?, the bus is not held while waiting.
+    """
+    inst.write('*CLS')  # Clear event registers and error queue
+    inst.write('*ESE ' + str(dict_standard_event_bits['OPC']))  # Summarize OPC in the ESB bit of the status byte
+    inst.write('*SRE ' + str(dict_status_byte_bits['ESB']))  # Request service when ESB is set
+    inst.write('*OPC')  # Set the OPC bit when all pending commands have finished
+    status_byte = wait_for_status(inst, dict_status_byte_bits['ESB'], timeout=timeout, use_srq=use_srq,
+                                  callback=callback)
+    inst.query('*ESR?')  # Reading the standard event register clears it (and ESB)
+    return status_byte
+
+
+# --- SHADOW STATE
+
+# shadow copies of instrument settings are kept here between script invocations
+default_state_file = os.path.join(os.path.expanduser('~'), 'py-pennathur-lab_instrument_state.json')
+
+# commands that reset (part of) the instrument configuration, so the shadow copy of those settings is no longer valid:
+# {header pattern: [prefixes of the headers to forget]} (patterns are matched against the short form of the header)
+# NOTE: see "Coupled Commands" on page 331 of 6517a manual or pg 493 of 6517b programming manual
+dict_coupled_commands = {
+    r'\*RST': [''],
+    r'\*RCL': [''],
+    'SYST:PRES': [''],
+    'TRAC:CLE': ['TRAC:FEED:CONT'],
+    'TRAC:POIN': ['TRAC:FEED:CONT', 'TRAC:POIN:AUTO'],
+    'TRIG:COUN': ['TRAC:POIN'],
+    'SENS:FUNC': ['SENS:'],
+    # selecting a range disables autorange, and enabling autorange changes the range
+    r'(([A-Z]+:)?[A-Z]+:RANG)': [r'\1:AUTO'],
+    r'(([A-Z]+:)?[A-Z]+:RANG):AUTO': [r'\1'],
+}
+
+# commands that run the trigger model or a sweep (e.g., :INIT, :TSEQ:ARM, :READ?): the instrument steps its source
+# and autoranges on its own, so the shadow copy of the source levels and ranges (volatile_settings) is forgotten
+sweep_commands = re.compile(r'INIT|TSEQ:ARM|READ|MEAS(:[A-Z]+)*|\*TRG|TRIG')
+volatile_settings = re.compile(r'(SOUR:)?(VOLT|CURR)|.*:RANG(:AUTO)?')
+
+# writes that make the output safe (e.g., :OUTP OFF or :SOUR:VOLT 0) are always sent
+safety_settings = re.compile(r'OUTP|SOUR:(VOLT|CURR)')
+
+# keywords that may be omitted from a header (e.g., :SOUR:VOLT:LEV:IMM:AMPL is :SOUR:VOLT)
+_optional_keywords = ['LEV', 'IMM', 'AMPL', 'DC', 'LAY1']
+
+
+def short_keyword(keyword):
+    """
+    Short form of a SCPI keyword: the first four letters, or three if the fourth is a vowel (e.g., 'VOLTage' -> 'VOLT',
+    'DELay' -> 'DEL', 'LAYer2' -> 'LAY2'). Keywords of four letters or fewer are their own short form.
+    """
+    keyword = keyword.strip().upper()
+    match = re.match(r'([A-Z]+)(\d*)$', keyword)
+    if match is None or len(match.group(1)) <= 4:
+        return keyword
+    letters, suffix = match.groups()
+    return (letters[:3] if letters[3] in 'AEIOU' else letters[:4]) + suffix
+
+
+def normalize_header(header):
+    """ Normalize a header to its short form without optional keywords, e.g., ':SOURce:VOLTage:LEVel?' -> 'SOUR:VOLT' """
+    header = header.strip().upper().lstrip(':').rstrip('?')
+    if header.startswith('*'):
+        return header
+    keywords = [short_keyword(k) for k in header.split(':')]
+    return ':'.join(k for k in keywords if k not in _optional_keywords)
+
+
+def header_command(header):
+    """ Command for a normalized header: common commands (e.g., '*SRE') have no leading ':'. """
+    return header if header.startswith('*') else ':' + header
+
+
+def split_command(command):
+    """
+    Split a SCPI command into a header and its parameters, e.g., ':SENS:CURR:NPLC 1' -> ('SENS:CURR:NPLC', '1')
+    """
+    command = command.strip()
+    if ' ' in command:
+        header, value = command.split(' ', 1)
+    else:
+        header, value = command, None
+    return header.upper().lstrip(':'), value
+
+
+def same_value(a, b):
+    """ Compare two setting values, numerically if possible (e.g., '1' == '1.0' == '+1.000000E+00'). """
+    try:
+        return float(a) == float(b)
+    except (TypeError, ValueError):
+        a, b = str(a).strip().strip('"').upper(), str(b).strip().strip('"').upper()
+        return a == b or (a.isalpha() and b.isalpha() and short_keyword(a) == short_keyword(b))
+
+
+def is_safety_command(header, value):
+    """ True if the write turns the output off or sets the source to zero (see safety_settings). """
+    if value is None or not safety_settings.fullmatch(header):
+        return False
+    return same_value(value, 0) or same_value(value, 'OFF')
+
+
+class ShadowStateInstrument:
+    """
+    Stand-in for a pyvisa resource that keeps a shadow copy of every setting written to the instrument and only sends
+    the settings that change.
+
+    Commands without parameters (e.g., :INIT, :TRAC:CLE, :SYST:ZCOR:ACQ) are always sent. Commands with parameters are
+    stored by the short form of their header (:SENSe:CURRent:NPLC and :SENS:CURR:NPLC are the same setting) and
+    skipped if the instrument already has that value. Some writes are always sent: semicolon-joined messages (e.g.,
+    from write_batch) and writes that make the output safe (see safety_settings). Settings that the instrument changes
+    on its own (coupled commands, and source levels and ranges during sweeps) are forgotten, so they are sent again.
+
+    If skip_reset is True, *RST is skipped too, so back-to-back runs only pay for the settings that differ (e.g.,
+    :SOUR:VOLT or :TRIG:COUN), but only after verify() found no mismatches. The shadow copy can be saved to state_file
+    so it survives between script invocations.
+
+    NOTE: the shadow copy is only valid if nobody else changes the instrument (e.g., front panel, power cycle). Use
+    verify() to compare the shadow copy against the instrument, or resync() to re-send every setting.
+    NOTE: a skipped *RST keeps every setting of the earlier runs, including those this run never writes, so only use
+    skip_reset for runs of the same script.
+    """
+
+    def __init__(self, inst, state_file=None, skip_reset=False):
+        self.__dict__['inst'] = inst
+        self.__dict__['state_file'] = state_file
+        self.__dict__['skip_reset'] = skip_reset
+        self.__dict__['shadow'] = {}
+        self.__dict__['verified'] = False
+        self.__dict__['num_sent'] = 0
+        self.__dict__['num_skipped'] = 0
+        if state_file is not None:
+            self.load_state()
+
+    def write(self, command):
+        if ';' in command:
+            self.inst.write(command)
+            self.num_sent += 1
+            self.update_shadow(command)
+            return
+        header, value = split_command(command)
+        header = normalize_header(header)
+        if header == '*RST' and self.skip_reset and self.verified and self.shadow:
+            self.num_skipped += 1
+            return
+        if value is not None and header in self.shadow and same_value(self.shadow[header], value) \
+                and not is_safety_command(header, value):
+            self.num_skipped += 1
+            return
+        self.inst.write(command)
+        self.num_sent += 1
+        self.update_shadow(command)
+
+    def update_shadow(self, message):
+        """ Update the shadow copy after a message (one or more ';'-joined commands) was sent. """
+        for i, command in enumerate(x for x in message.split(';') if x.strip()):
+            if i > 0 and not command.strip().startswith((':', '*')):
+                # relative to the path of the previous command: the header is not known
+                self.invalidate()
+                continue
+            header, value = split_command(command)
+            is_query = header.endswith('?')
+            header = normalize_header(header)
+            if sweep_commands.fullmatch(header):
+                self.forget([k for k in self.shadow.keys() if volatile_settings.fullmatch(k)])
+            if is_query:
+                continue
+            for pattern, coupled_headers in dict_coupled_commands.items():
+                match = re.fullmatch(pattern, header)
+                if match is not None:
+                    prefixes = tuple(match.expand(x) for x in coupled_headers)
+                    self.forget([k for k in self.shadow.keys() if k.startswith(prefixes)])
+            if value is not None:
+                self.shadow[header] = value.strip()
+
+    def forget(self, headers):
+        """ Forget the shadow copy of some settings: the instrument state is no longer known, so *RST is not skipped. """
+        for header in headers:
+            del self.shadow[header]
+            self.verified = False
+
+    def query(self, command, *args, **kwargs):
+        self.update_shadow(command)
+        return self.inst.query(command, *args, **kwargs)
+
+    def query_ascii_values(self, command, *args, **kwargs):
+        self.update_shadow(command)
+        return self.inst.query_ascii_values(command, *args, **kwargs)
+
+    def query_binary_values(self, command, *args, **kwargs):
+        self.update_shadow(command)
+        return self.inst.query_binary_values(command, *args, **kwargs)
+
+    def resync(self):
+        """ Re-send every setting in the shadow copy (e.g., after the front panel was used). """
+        for header, value in self.shadow.items():
+            self.inst.write('{} {}'.format(header_command(header), value))
+            self.num_sent += 1
+
+    def verify(self, keys=None, resync_mismatches=False):
+        """
+        Query settings from the instrument and compare them against the shadow copy.
+
+        :param keys: list of headers to verify (default: all settings in the shadow copy)
+        :param resync_mismatches: if True, re-send the settings that do not match
+        :return: dict of mismatches: {header: (shadow value, instrument value)}. Headers that are not in the shadow copy
+            are reported with a shadow value of None (and are not re-sent).
+        """
+        verify_all = keys is None
+        if verify_all:
+            keys = list(self.shadow.keys())
+        mismatches = {}
+        for header in keys:
+            header = normalize_header(header)
+            actual = self.inst.query('{}?'.format(header_command(header))).strip()
+            expected = self.shadow.get(header)
+            if expected is None:
+                mismatches[header] = (None, actual)
+            elif not same_value(expected, actual):
+                mismatches[header] = (expected, actual)
+                if resync_mismatches:
+                    self.inst.write('{} {}'.format(header_command(header), expected))
+                    self.num_sent += 1
+        if verify_all:
+            self.verified = not mismatches or resync_mismatches
+        return mismatches
+
+    def invalidate(self):
+        """ Forget the shadow copy so that every setting is sent again. """
+        self.shadow.clear()
+        self.verified = False
+
+    def load_state(self):
+        if self.state_file is not None and os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as f:
+                states = json.load(f)
+            # normalize headers (state files saved by older versions were keyed by the headers as written)
+            self.shadow.update({normalize_header(k): v for k, v in states.get(self.inst.resource_name, {}).items()})
+
+    def save_state(self):
+        if self.state_file is None:
+            return
+        states = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as f:
+                states = json.load(f)
+        states[self.inst.resource_name] = self.shadow
+        with open(self.state_file, 'w') as f:
+            json.dump(states, f, indent=2)
+
+    def close(self):
+        self.save_state()
+        self.inst.close()
+
+    def __getattr__(self, name):
+        return getattr(self.inst, name)
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__:
+            self.__dict__[name] = value
+        else:
+            setattr(self.inst, name, value)
@@ -0,0 +1,1071 @@
+"""
+Simulated instruments (Keithley 6517b, Keithley 2410, Agilent 33210A) for running the acquisition scripts offline.
+
+Each simulated instrument accepts the SCPI subset used in this repo (trigger model, :TRAC buffer, :FORM:ELEM,
+:FORM:DATA, :SOUR:LIST, :TSEQ, FUNC/FREQ/VOLT/AM, status registers) and holds the host for as long as the real
+instrument would: every message costs a bus latency plus its transfer time, and readings are only available once
+their integration time (NPLC), trigger/source delays and per-reading overhead have elapsed. Readings are generated
+from a device model (see RCDevice), so currents respond to voltage steps like a real (capacitive) device.
+
+Select the simulated instruments with the resource manager:
+
+    rm = get_resource_manager('@lab-sim')  # instead of pyvisa.ResourceManager()
+    k1 = rm.open_resource('GPIB0::27::INSTR')  # model from the GPIB address (see dict_simulated_gpib_addresses)
+
+or per resource (the rest of the instruments are real), with open_instrument() in utils/broker.py:
+
+    k1 = open_instrument(rm, 'SIM::6517b::INSTR')
+
+NOTE: trigger link (TLINk), external and bus triggers are treated as immediate triggers.
+"""
+import re
+import time
+import numpy as np
+
+from utils.scpi import split_command, short_keyword, normalize_header, dict_status_byte_bits, dict_standard_event_bits
+from utils.keithley_6517 import buffer_full_bit, max_buffer_points, dict_ascii_fields
+from utils.agilent_33210a import max_arb_points, max_nonvolatile_arbs
+from utils.lan import dict_block_datatypes
+
+
+# name of the backend that selects the simulated instruments (see get_resource_manager)
+simulated_backend = '@lab-sim'
+
+# simulated model by GPIB primary address (on any board), as the instruments are addressed in the lab
+dict_simulated_gpib_addresses = {
+    23: '6517b',
+    24: '6517b',
+    27: '6517b',
+    25: '2410',
+    10: '33210a',
+}
+
+# simulated model by USB product id
+dict_simulated_usb_products = {
+    '0x1507': '33210a',
+}
+
+dict_simulated_idn = {
+    '6517b': 'KEITHLEY INSTRUMENTS INC.,MODEL 6517B,0000000,A13/700x (simulated)',
+    '2410': 'KEITHLEY INSTRUMENTS INC.,MODEL 2410,0000000,C33 (simulated)',
+    '33210a': 'Agilent Technologies,33210A,MY00000000,1.04-1.04-22-2 (simulated)',
+}
+
+# timing of each model (s):
+#   bus_latency: per message (handshake + command parsing)
+#   bytes_per_second: transfer rate of messages and responses
+#   reading_overhead: per reading, in addition to the integration time (A/D conversion, math, buffer storage)
+#   autorange_overhead: per reading, when the sense function autoranges
+#   display_overhead: per reading, when the front-panel display is enabled
+#   autozero_overhead: per reading, as a fraction of the integration time, when autozero (:SYST:AZER) is enabled
+#   noise: standard deviation of the readings at 1 NPLC, as a fraction of the measurement range
+dict_simulated_timing = {
+    '6517b': {'bus_latency': 0.002, 'bytes_per_second': 100e3, 'reading_overhead': 0.003, 'autorange_overhead': 0.02,
+              'display_overhead': 0.004, 'zero_correct_time': 0.5, 'noise': 1e-5},
+    '2410': {'bus_latency': 0.001, 'bytes_per_second': 250e3, 'reading_overhead': 0.002, 'autorange_overhead': 0.005,
+             'display_overhead': 0.002, 'autozero_overhead': 1.0, 'noise': 1e-5},
+    # amplitude_settle: time for an amplitude change to reach the output (output attenuator relays)
+    # ascii_point_time / binary_point_time: time to parse one arbitrary waveform point (DATA vs DATA:DAC block)
+    '33210a': {'bus_latency': 0.001, 'bytes_per_second': 250e3, 'amplitude_settle': 0.03, 'ascii_point_time': 1e-4,
+               'binary_point_time': 2e-6},
+}
+
+line_frequency = 60
+
+# max number of readings in one acquisition (e.g., :TRIG:COUN INF)
+max_acquisition_points = 100000
+
+
+# --- SCPI PARSING
+
+dict_keyword_values = {
+    'ON': 1.0,
+    'OFF': 0.0,
+    'INF': np.inf,
+}
+
+
+def to_float(value):
+    """ Convert a parameter to a number (e.g., '1e-3', 'ON', 'INFinity', '"5"'). """
+    value = short_keyword(str(value).strip().strip('"\''))
+    if value in dict_keyword_values:
+        return dict_keyword_values[value]
+    return float(value)
+
+
+def parse_block(raw):
+    """ Data of an IEEE-488.2 block: #<n><length><data> or #0<data><termination>. """
+    start = raw.index(b'#')
+    num_digits = int(raw[start + 1:start + 2])
+    if num_digits == 0:
+        return raw[start + 2:-1]
+    length = int(raw[start + 2:start + 2 + num_digits])
+    return raw[start + 2 + num_digits:start + 2 + num_digits + length]
+
+
+def visa_timeout_error(resource_name, timeout):
+    """ The error pyvisa raises on a timeout (TimeoutError if pyvisa is not installed). """
+    try:
+        from pyvisa import constants, errors
+    except ImportError:
+        return TimeoutError("{} did not respond within {} ms.".format(resource_name, timeout))
+    return errors.VisaIOError(constants.StatusCode.error_timeout)
+
+
+# --- DEVICE UNDER TEST
+
+class RCDevice:
+    """
+    Device under test: a leakage resistance in parallel with a capacitance that charges through a series resistance.
+
+    Each voltage step dV at time t_k adds a charging current dV / series_resistance * exp(-(t - t_k) / tau), where
+    tau = series_resistance * capacitance, on top of the leakage current V / resistance.
+    """
+
+    def __init__(self, resistance=1e12, capacitance=1e-10, series_resistance=1e8):
+        self.resistance = resistance
+        self.capacitance = capacitance
+        self.series_resistance = series_resistance
+        self.tau = series_resistance * capacitance
+
+    def current(self, step_times, step_voltages, times):
+        """
+        :param step_times: times at which the applied voltage changed (sorted)
+        :param step_voltages: applied voltage after each change
+        :param times: times at which to evaluate the current (a step at the same time as a reading comes after it)
+        :return: current at each time
+        """
+        step_times = np.asarray(step_times, dtype=float)
+        step_voltages = np.asarray(step_voltages, dtype=float)
+        times = np.asarray(times, dtype=float)
+        index = np.searchsorted(step_times, times, side='left') - 1
+        current = np.where(index >= 0, step_voltages[np.clip(index, 0, None)], 0.0) / self.resistance
+        for step_time, dv in zip(step_times, np.diff(step_voltages, prepend=0.0)):
+            if dv == 0:
+                continue
+            dt = times - step_time
+            charging = (dt > 0) & (dt < 30 * self.tau)  # steps older than 30 tau no longer contribute
+            current[charging] += dv / self.series_resistance * np.exp(-dt[charging] / self.tau)
+        return current
+
+
+# --- SIMULATED INSTRUMENTS
+
+class SimulatedInstrument:
+    """
+    Stand-in for a pyvisa resource: parses SCPI messages, keeps the settings, and models the bus and reading timing.
+
+    Commands without a handler (see command_table) are stored as settings and returned by the matching query. Unknown
+    queries add -113 to the error queue and never respond (i.e., the read times out, like the real instrument).
+    Instrument time (see now) is host time divided by time_scale (e.g., time_scale=0.1 runs 10x faster).
+    """
+    model = None
+    # settings after *RST: {normalized header: value}
+    dict_defaults = {}
+
+    def __init__(self, resource_name, time_scale=1.0, seed=None, t0=None, **timing):
+        self.resource_name = resource_name
+        self.timeout = 2000  # (ms) pyvisa default
+        self.write_termination = '\n'
+        self.read_termination = '\n'
+        self.time_scale = time_scale
+        self.timing = dict(dict_simulated_timing[self.model], **timing)
+        self.rng = np.random.default_rng(seed)
+        self.t0 = time.perf_counter() if t0 is None else t0
+        self.responses = []  # (time at which the response is ready, response)
+        self.errors = []
+        self.num_messages = 0
+        self.num_bytes = 0
+        self.ese, self.sre, self.esr = 0, 0, 0
+        self.meas_enable, self.meas_event = 0, 0
+        self.opc_time = None
+        self.commands = self.command_table()
+        self.reset()
+
+    # - clock and bus
+
+    def now(self):
+        """ Instrument time (s): host time since the resource manager was created, divided by time_scale. """
+        return (time.perf_counter() - self.t0) / self.time_scale
+
+    def sleep_until(self, t):
+        remaining = (t - self.now()) * self.time_scale
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def transfer(self, num_bytes):
+        """ Hold the host for one bus transaction of num_bytes. """
+        self.num_messages += 1
+        self.num_bytes += num_bytes
+        self.sleep_until(self.now() + self.timing['bus_latency'] + num_bytes / self.timing['bytes_per_second'])
+
+    # - settings
+
+    def reset(self):
+        self.settings = dict(self.dict_defaults)
+        self.busy_until = self.now()
+
+    def is_on(self, header):
+        return to_float(self.settings.get(header, 'OFF')) != 0
+
+    def keyword(self, header):
+        """ Short form of a keyword setting (e.g., :TRIG:SOUR TIMer -> 'TIM'). """
+        return short_keyword(str(self.settings[header]).strip('"\' ').split(':')[0].split(',')[0])
+
+    def write_setting(self, header, value):
+        if value is not None:
+            self.settings[header] = value.strip()
+
+    def query_setting(self, header):
+        if header not in self.settings:
+            self.errors.append('-113,"Undefined header"')
+            return None
+        return str(self.settings[header])
+
+    # - status
+
+    def command_table(self):
+        """ Handlers by normalized header (queries end with '?'): handler(value) -> response or (response, ready time) """
+        return {
+            '*RST': lambda value: self.reset(),
+            '*CLS': lambda value: self.clear_status(),
+            '*ESE': lambda value: setattr(self, 'ese', int(to_float(value))),
+            '*ESE?': lambda value: str(self.ese),
+            '*SRE': lambda value: setattr(self, 'sre', int(to_float(value))),
+            '*SRE?': lambda value: str(self.sre),
+            '*ESR?': lambda value: self.query_event_register('esr'),
+            '*STB?': lambda value: str(self.status_byte()),
+            '*OPC': lambda value: setattr(self, 'opc_time', self.busy_until),
+            '*OPC?': lambda value: ('1', self.busy_until),
+            '*WAI': lambda value: None,
+            '*IDN?': lambda value: dict_simulated_idn[self.model],
+            'SYST:ERR?': lambda value: self.errors.pop(0) if self.errors else '0,"No error"',
+            'SYST:PRES': lambda value: self.reset(),
+            'STAT:PRES': lambda value: setattr(self, 'meas_enable', 0),
+            'STAT:MEAS:ENAB': lambda value: setattr(self, 'meas_enable', int(to_float(value))),
+            'STAT:MEAS:ENAB?': lambda value: str(self.meas_enable),
+            'STAT:MEAS:EVEN?': lambda value: self.query_event_register('meas_event'),
+        }
+
+    def clear_status(self):
+        self.esr, self.meas_event, self.opc_time = 0, 0, None
+        self.errors.clear()
+
+    def query_event_register(self, name):
+        """ Reading an event register clears it. """
+        self.update_events()
+        value = getattr(self, name)
+        setattr(self, name, 0)
+        return str(value)
+
+    def update_events(self):
+        if self.opc_time is not None and self.now() >= self.opc_time:
+            self.esr |= dict_standard_event_bits['OPC']
+            self.opc_time = None
+
+    def status_byte(self):
+        self.update_events()
+        status_byte = 0
+        if self.meas_event & self.meas_enable:
+            status_byte |= dict_status_byte_bits['MSB']
+        if self.errors:
+            status_byte |= dict_status_byte_bits['EAV']
+        if self.responses:
+            status_byte |= dict_status_byte_bits['MAV']
+        if self.esr & self.ese:
+            status_byte |= dict_status_byte_bits['ESB']
+        if status_byte & self.sre:
+            status_byte |= dict_status_byte_bits['RQS']
+        return status_byte
+
+    # - messages
+
+    def handle_message(self, message):
+        responses, ready = [], self.now()
+        for command in message.split(';'):
+            if not command.strip():
+                continue
+            header, value = split_command(command)
+            is_query = header.endswith('?')
+            header = normalize_header(header)
+            handler = self.commands.get(header + '?' if is_query else header)
+            if handler is not None:
+                result = handler(value)
+            elif is_query:
+                result = self.query_setting(header)
+            else:
+                result = self.write_setting(header, value)
+            if is_query and result is not None:
+                response, ready_at = result if isinstance(result, tuple) else (result, self.now())
+                responses.append(response if isinstance(response, bytes) else response.encode())
+                ready = max(ready, ready_at)
+        if responses:
+            self.responses.append((ready, b';'.join(responses)))
+
+    def handle_block(self, header, data):
+        """ Handle a command with a binary block parameter (e.g., DATA:DAC VOLATILE,#<block>). """
+        self.errors.append('-151,"Invalid block data"')
+
+    # - pyvisa API
+
+    def write(self, message):
+        self.transfer(len(message) + len(self.write_termination))
+        self.handle_message(message)
+        return len(message) + len(self.write_termination)
+
+    def write_raw(self, message):
+        self.transfer(len(message))
+        if b'#' in message:
+            header = message[:message.index(b'#')].decode().rstrip(', ')
+            self.handle_block(header, parse_block(message))
+        else:
+            self.handle_message(message.decode().rstrip(self.write_termination))
+        return len(message)
+
+    def write_binary_values(self, message, values, datatype='f', is_big_endian=False, header_fmt='ieee'):
+        dtype = np.dtype(dict_block_datatypes[datatype]).newbyteorder('>' if is_big_endian else '<')
+        data = np.asarray(values).astype(dtype).tobytes()
+        length = str(len(data))
+        block = '#{}{}'.format(len(length), length).encode() + data
+        return self.write_raw(message.encode() + block + self.write_termination.encode())
+
+    def read_raw(self, size=None):
+        if not self.responses or (self.responses[0][0] - self.now()) * self.time_scale > self.timeout / 1000:
+            # the response is never sent (query error) or is not ready within timeout: block for timeout and raise
+            time.sleep(self.timeout / 1000)
+            raise visa_timeout_error(self.resource_name, self.timeout)
+        ready, response = self.responses.pop(0)
+        self.sleep_until(ready)
+        response += self.read_termination.encode()
+        self.transfer(len(response))
+        return response
+
+    def read(self):
+        response = self.read_raw().decode()
+        return response[:-len(self.read_termination)] if response.endswith(self.read_termination) else response
+
+    def query(self, message, delay=None):
+        self.write(message)
+        return self.read()
+
+    def query_ascii_values(self, message, converter='f', separator=',', container=list, delay=None):
+        response = self.query(message).strip()
+        values = np.array(response.split(separator), dtype=float) if response else np.array([])
+        return values if container is np.array else container(values)
+
+    def query_binary_values(self, message, datatype='f', is_big_endian=False, container=list, header_fmt='ieee',
+                            expect_termination=True, data_points=None, chunk_size=None):
+        self.write(message)
+        dtype = np.dtype(dict_block_datatypes[datatype]).newbyteorder('>' if is_big_endian else '<')
+        values = np.frombuffer(parse_block(self.read_raw()), dtype=dtype)
+        return values if container is np.array else container(values)
+
+    def read_stb(self):
+        self.transfer(0)  # serial poll
+        return self.status_byte()
+
+    def wait_for_srq(self, timeout=25000):
+        deadline = time.perf_counter() + timeout / 1000
+        while not self.status_byte() & dict_status_byte_bits['RQS']:
+            if time.perf_counter() > deadline:
+                raise visa_timeout_error(self.resource_name, timeout)
+            time.sleep(0.001)
+
+    def clear(self):
+        self.transfer(0)  # device clear
+        self.responses.clear()
+
+    def close(self):
+        pass
+
+
+class SimulatedMeter(SimulatedInstrument):
+    """
+    Common trigger model of the simulated 6517b and 2410: :INIT starts an acquisition whose reading times are fixed
+    when it starts, and each reading is generated (from the source history and the device model) when it is read.
+    """
+
+    # units of the reading, by sense function
+    dict_units = {'CURR': 'ADC', 'VOLT': 'VDC', 'CHAR': 'COUL', 'RES': 'OHM'}
+
+    def __init__(self, resource_name, dut=None, input_voltage=None, **kwargs):
+        self.dut = RCDevice() if dut is None else dut
+        # function of time that returns the voltage applied to the meter input (see SimulatedResourceManager.connect)
+        self.input_voltage = input_voltage
+        super().__init__(resource_name, **kwargs)
+
+    def reset(self):
+        super().reset()
+        self.source_log = [(self.now(), 0.0)]  # (time, output voltage): 0 V while the output is off
+        # (time, sense function, fixed range or None when autoranging): range changes apply to later readings only
+        self.range_log = [(self.now(), func, self.fixed_range(func)) for func in self.dict_units]
+        self.acquisition = None
+        self.tst_zero = self.now()
+
+    def command_table(self):
+        commands = super().command_table()
+        commands.update({
+            'SOUR:VOLT': lambda value: self.write_source('SOUR:VOLT', value),
+            'OUTP': lambda value: self.write_source('OUTP', value),
+            'INIT': lambda value: self.start_acquisition(),
+            'ABOR': lambda value: self.abort(),
+            'SYST:TST:REL:RES': lambda value: setattr(self, 'tst_zero', self.now()),
+            'SYST:TIME:RES': lambda value: setattr(self, 'tst_zero', self.now()),
+        })
+        return commands
+
+    def write_setting(self, header, value):
+        super().write_setting(header, value)
+        if re.match(r'SENS:[A-Z]+:RANG$', header):
+            self.settings[header + ':AUTO'] = 'OFF'  # selecting a range disables autorange
+        if re.match(r'SENS:[A-Z]+:RANG(:AUTO)?$', header):
+            func = header.split(':')[1]
+            self.range_log.append((self.now(), func, self.fixed_range(func)))
+
+    def fixed_range(self, func):
+        if self.is_on('SENS:{}:RANG:AUTO'.format(func)) or 'SENS:{}:RANG'.format(func) not in self.settings:
+            return None
+        return to_float(self.settings['SENS:{}:RANG'.format(func)])
+
+    def ranges_at(self, func, times, values):
+        """ Range of each reading: the fixed range at its time, or the decade above the reading when autoranging. """
+        log = sorted([(t, r) for t, f, r in self.range_log if f == func], key=lambda x: x[0])
+        index = np.clip(np.searchsorted([t for t, r in log], times, side='right') - 1, 0, None)
+        fixed = np.array([np.nan if r is None else r for t, r in log])[index]
+        return np.where(np.isnan(fixed), 10 ** np.ceil(np.log10(np.maximum(np.abs(values), 1e-12))), fixed)
+
+    # - source
+
+    def write_source(self, header, value):
+        self.write_setting(header, value)
+        self.source_log.append((self.now(), to_float(self.settings['SOUR:VOLT']) if self.is_on('OUTP') else 0.0))
+
+    def source_steps(self):
+        """ Times and output voltages of every source change, sorted by time. """
+        step_times, step_voltages = zip(*sorted(self.source_log, key=lambda x: x[0]))
+        return np.array(step_times), np.array(step_voltages)
+
+    def voltage_at(self, times):
+        step_times, step_voltages = self.source_steps()
+        return step_voltages[np.clip(np.searchsorted(step_times, times, side='left') - 1, 0, None)]
+
+    # - trigger model
+
+    def sense_function(self):
+        return self.keyword('SENS:FUNC')
+
+    def measure_time(self):
+        """ Time (s) per reading: integration time + overhead. """
+        func = self.sense_function()
+        integration_time = to_float(self.settings.get('SENS:{}:NPLC'.format(func), 1)) / line_frequency
+        measure_time = integration_time + self.timing['reading_overhead']
+        if self.is_on('SYST:AZER'):
+            measure_time += self.timing.get('autozero_overhead', 0) * integration_time
+        if self.is_on('SENS:{}:RANG:AUTO'.format(func)):
+            measure_time += self.timing['autorange_overhead']
+        if self.is_on('DISP:ENAB'):
+            measure_time += self.timing['display_overhead']
+        return measure_time
+
+    def trigger_count(self):
+        count = to_float(self.settings['TRIG:COUN']) * to_float(self.settings.get('ARM:COUN', 1))
+        return int(min(count, max_acquisition_points))
+
+    def start_acquisition(self, voltages=None, settle=None, period=None):
+        """
+        Start an acquisition now. Each reading takes a cycle: the source steps (if voltages is given), the instrument
+        waits settle (trigger/source delays + integration time), then stores the reading.
+
+        :param voltages: source voltage of each reading (e.g., list sweep); default: output voltage at each reading
+        :param settle: (s) time from the start of each cycle to its reading
+        :param period: (s) time between cycles (e.g., trigger timer)
+        """
+        count = self.trigger_count() if voltages is None else len(voltages)
+        if settle is None:
+            settle = self.measure_time() + to_float(self.settings.get('TRIG:DEL', 0))
+        if period is None:
+            period = settle
+            if self.keyword('TRIG:SOUR') == 'TIM':
+                period = max(settle, to_float(self.settings['TRIG:TIM']))
+        start = self.now()
+        cycle_times = start + np.arange(count) * period
+        if voltages is not None:
+            voltages = np.asarray(voltages, dtype=float)
+            if self.is_on('OUTP'):
+                self.source_log.extend(zip(cycle_times, voltages))
+                self.source_log.append((cycle_times[-1] + settle, to_float(self.settings['SOUR:VOLT'])))
+        # a reading is never after the next cycle's source step (cycle_times + settle can round past it)
+        reading_times = np.append(np.minimum(cycle_times[:-1] + settle, cycle_times[1:]), cycle_times[-1] + settle)
+        self.acquisition = {'times': reading_times, 'voltages': voltages}
+        self.busy_until = max(self.busy_until, cycle_times[-1] + settle)
+        return self.acquisition
+
+    def abort(self):
+        if self.acquisition is not None:
+            num_completed = self.num_completed()
+            self.acquisition['times'] = self.acquisition['times'][:num_completed]
+            if self.acquisition['voltages'] is not None:
+                self.acquisition['voltages'] = self.acquisition['voltages'][:num_completed]
+        self.busy_until = self.now()
+
+    def num_completed(self):
+        if self.acquisition is None:
+            return 0
+        return int(np.searchsorted(self.acquisition['times'], self.now(), side='right'))
+
+    def readings(self, index):
+        """
+        Reading time, source voltage, value and status character of the readings at index (of the acquisition).
+        """
+        times = self.acquisition['times'][index]
+        voltages = self.voltage_at(times) if self.acquisition['voltages'] is None else self.acquisition['voltages'][index]
+        func = self.sense_function()
+        if self.is_on('SYST:ZCH'):
+            values = np.zeros_like(times)
+        elif func == 'CURR':
+            values = self.dut.current(*self.source_steps(), times)
+        elif func == 'VOLT' and self.input_voltage is not None:
+            values = self.input_voltage(times)
+        else:
+            values = np.zeros_like(times)
+        # noise is a fraction of the range
+        ranges = self.ranges_at(func, times, values)
+        # noise averages down with the integration time
+        noise = self.timing['noise'] / np.sqrt(max(to_float(self.settings.get('SENS:{}:NPLC'.format(func), 1)), 0.01))
+        values = values + self.rng.normal(0, noise, len(values)) * ranges
+        status = np.where(np.abs(values) > 1.05 * ranges, 'O', 'Z' if self.is_on('SYST:ZCH') else 'N')
+        values = np.where(status == 'O', 9.9e37, values)
+        return times, voltages, values, status
+
+    # - data formats
+
+    def format_values(self, columns):
+        """ Format (num_readings, num_elements) values as comma-separated ASCii or a binary block (:FORM:DATA). """
+        data_format = self.keyword('FORM:DATA')
+        if data_format == 'ASC':
+            return ','.join('{:+.6E}'.format(x) for x in np.ravel(columns))
+        itemsize = 8 if data_format == 'DRE' or str(self.settings['FORM:DATA']).endswith('64') else 4
+        byte_order = '<' if self.keyword('FORM:BORD') == 'SWAP' else '>'
+        return b'#0' + np.ascontiguousarray(columns, dtype=np.dtype('f{}'.format(itemsize)).newbyteorder(byte_order)
+                                            ).tobytes()
+
+
+class Simulated6517b(SimulatedMeter):
+    """
+    Keithley 6517b electrometer: voltage source, trigger model (IMMediate or TIMer), reading buffer (:TRAC) and test
+    sequences (:TSEQ STSW and CLE).
+    """
+    model = '6517b'
+    dict_defaults = {
+        'SENS:FUNC': 'VOLT',
+        'SENS:VOLT:NPLC': '1',
+        'SENS:VOLT:RANG:AUTO': 'ON',
+        'SENS:CURR:NPLC': '1',
+        'SENS:CURR:RANG': '20e-3',
+        'SENS:CURR:RANG:AUTO': 'ON',
+        'SENS:CHAR:NPLC': '1',
+        'SENS:CHAR:RANG:AUTO': 'ON',
+        'SOUR:VOLT': '0',
+        'SOUR:VOLT:RANG': '100',
+        'SOUR:VOLT:MCON': 'OFF',
+        'OUTP': 'OFF',
+        'SYST:ZCH': 'ON',
+        'SYST:ZCOR': 'OFF',
+        'DISP:ENAB': 'ON',
+        'FORM:DATA': 'ASC',
+        'FORM:BORD': 'SWAP',
+        'FORM:ELEM': 'READ,TST,RNUM,UNIT,STAT',
+        'INIT:CONT': 'OFF',
+        'ARM:COUN': '1',
+        'TRIG:COUN': '1',
+        'TRIG:SOUR': 'IMM',
+        'TRIG:DEL': '0',
+        'TRIG:TIM': '0.1',
+        'TRAC:POIN': '100',
+        'TRAC:FEED:CONT': 'NEV',
+        'TRAC:ELEM': 'NONE',
+        'TRAC:TST:FORM': 'ABS',
+        'TSEQ:TYPE': 'STSW',
+        'TSEQ:TSO': 'IMM',
+        'TSEQ:STSW:STAR': '1',
+        'TSEQ:STSW:STOP': '10',
+        'TSEQ:STSW:STEP': '1',
+        'TSEQ:STSW:STIM': '1',
+        'TSEQ:CLE:SVOL': '1',
+        'TSEQ:CLE:SPO': '10',
+        'TSEQ:CLE:SPIN': '1',
+    }
+
+    def reset(self):
+        super().reset()
+        self.buffer = None
+        self.num_fresh = 0
+
+    def command_table(self):
+        commands = super().command_table()
+        commands.update({
+            'FETC?': lambda value: self.fetch(),
+            'SENS:DATA?': lambda value: self.fetch(),
+            'DATA:FRES?': lambda value: self.fetch(fresh=True),
+            'SENS:DATA:FRES?': lambda value: self.fetch(fresh=True),
+            'READ?': lambda value: (self.start_acquisition(), self.fetch())[1],
+            'TSEQ:ARM': lambda value: self.arm_test_sequence(),
+            'SYST:ZCOR:ACQ': lambda value: setattr(self, 'busy_until', max(self.busy_until, self.now()) +
+                                                   self.timing['zero_correct_time']),
+            'TRAC:CLE': lambda value: self.clear_buffer(),
+            'TRAC:POIN': lambda value: (self.write_setting('TRAC:POIN', value),
+                                        self.write_setting('TRAC:FEED:CONT', 'NEV')),
+            'TRAC:POIN:ACT?': lambda value: str(self.num_buffered()),
+            'TRAC:DATA?': lambda value: self.query_buffer(0, self.num_buffered()),
+            'TRAC:DATA:SEL?': lambda value: self.query_buffer(*[int(to_float(x)) for x in value.split(',')]),
+        })
+        return commands
+
+    # - buffer
+
+    def start_acquisition(self, voltages=None, settle=None, period=None):
+        acquisition = super().start_acquisition(voltages=voltages, settle=settle, period=period)
+        if self.keyword('TRAC:FEED:CONT') == 'NEXT':
+            points = int(min(to_float(self.settings['TRAC:POIN']), max_buffer_points))
+            self.buffer = {'acquisition': acquisition, 'points': points, 'full': False}
+        self.num_fresh = 0
+        return acquisition
+
+    def clear_buffer(self):
+        self.buffer = None
+        self.write_setting('TRAC:FEED:CONT', 'NEV')
+
+    def num_buffered(self):
+        if self.buffer is None or self.buffer['acquisition'] is not self.acquisition:
+            return 0
+        return min(self.num_completed(), self.buffer['points'])
+
+    def update_events(self):
+        super().update_events()
+        if self.buffer is not None and not self.buffer['full'] and self.num_buffered() == self.buffer['points']:
+            self.buffer['full'] = True
+            self.meas_event |= buffer_full_bit
+
+    def query_buffer(self, start, count):
+        count = max(0, min(count, self.num_buffered() - start))
+        if count == 0:
+            return ''
+        return self.format_readings(np.arange(start, start + count), buffered=True)
+
+    # - readings
+
+    def fetch(self, fresh=False):
+        """ Latest reading (wait for the first reading of the acquisition, or for a reading not yet read if fresh) """
+        if self.acquisition is None or len(self.acquisition['times']) == 0:
+            self.errors.append('-230,"Data corrupt or stale"')
+            return None
+        index = max(self.num_completed(), self.num_fresh + 1 if fresh else 1) - 1
+        index = min(index, len(self.acquisition['times']) - 1)
+        self.num_fresh = index + 1
+        return self.format_readings(np.array([index])), self.acquisition['times'][index]
+
+    def format_readings(self, index, buffered=False):
+        """ Readings at index, with the data elements in :FORM:ELEM (in the order they are sent) """
+        elements = [short_keyword(x) for x in self.settings['FORM:ELEM'].split(',')]
+        times, voltages, values, status = self.readings(index)
+        timestamps = times - self.tst_zero
+        if buffered:
+            # buffer timestamps are referenced to the first reading in the buffer (ABSolute) or the previous (DELTa)
+            first = self.acquisition['times'][0]
+            timestamps = times - first if self.keyword('TRAC:TST:FORM') == 'ABS' else np.diff(times, prepend=first)
+        columns = {'READ': values, 'TST': timestamps, 'RNUM': index.astype(float), 'VSO': voltages}
+        fields = [x for x in dict_ascii_fields.keys() if x in elements]
+        if self.keyword('FORM:DATA') != 'ASC':
+            return self.format_values(np.column_stack([columns[x] for x in fields]))
+        units = 'UNIT' in elements
+        formatted = {
+            'READ': ['{:+.6E}{}{}'.format(x, s if 'STAT' in elements else '',
+                                           self.dict_units.get(self.sense_function(), '') if units else '')
+                     for x, s in zip(values, status)],
+            'TST': ['{:+013.6f}{}'.format(x, 'secs' if units else '') for x in timestamps],
+            'RNUM': ['{:+06d}{}'.format(x, 'RDNG#' if units else '') for x in index],
+            'VSO': ['{:+08.3f}{}'.format(x, 'Vsrc' if units else '') for x in voltages],
+        }
+        return ','.join(','.join(row) for row in zip(*[formatted[x] for x in fields]))
+
+    # - test sequences
+
+    def arm_test_sequence(self):
+        """ Run the selected test sequence (STSW: staircase sweep, CLE: constant voltage) into the buffer. """
+        kind = self.keyword('TSEQ:TYPE')
+        measure_time = self.measure_time()
+        if kind == 'STSW':
+            start, stop, step = [to_float(self.settings['TSEQ:STSW:' + x]) for x in ['STAR', 'STOP', 'STEP']]
+            num_points = int(round((stop - start) / step)) + 1 if step != 0 else 1
+            step_time = to_float(self.settings['TSEQ:STSW:STIM'])
+            voltages = start + step * np.arange(num_points)
+            settle, period = step_time + measure_time, step_time + measure_time
+        elif kind == 'CLE':
+            voltages = np.full(int(to_float(self.settings['TSEQ:CLE:SPO'])), to_float(self.settings['TSEQ:CLE:SVOL']))
+            settle, period = measure_time, max(measure_time, to_float(self.settings['TSEQ:CLE:SPIN']))
+        else:
+            self.errors.append('-221,"Settings conflict"')
+            return
+        self.start_acquisition(voltages=voltages, settle=settle, period=period)
+
+
+class Simulated2410(SimulatedMeter):
+    """
+    Keithley 2410 SourceMeter: fixed, list (:SOUR:LIST:VOLT) and linear sweep source modes, and :FORM:ELEM:SENS.
+    """
+    model = '2410'
+    dict_defaults = {
+        'SOUR:FUNC': 'VOLT',
+        'SOUR:VOLT': '0',
+        'SOUR:VOLT:MODE': 'FIX',
+        'SOUR:VOLT:RANG': '20',
+        'SOUR:VOLT:STAR': '0',
+        'SOUR:VOLT:STOP': '0',
+        'SOUR:VOLT:STEP': '0',
+        'SOUR:DEL': '0.001',
+        'SENS:FUNC': '"CURR"',
+        'SENS:CURR:NPLC': '1',
+        'SENS:CURR:RANG': '1.05e-4',
+        'SENS:CURR:RANG:AUTO': 'ON',
+        'SENS:CURR:PROT': '1.05e-4',
+        'OUTP': 'OFF',
+        'DISP:ENAB': 'ON',
+        'SYST:AZER': 'ON',
+        'FORM:DATA': 'ASC',
+        'FORM:BORD': 'NORM',
+        'FORM:ELEM:SENS': 'VOLT,CURR,RES,TIME,STAT',
+        'ARM:COUN': '1',
+        'ARM:SOUR': 'IMM',
+        'TRIG:COUN': '1',
+        'TRIG:SOUR': 'IMM',
+        'TRIG:DEL': '0',
+    }
+
+    # order of the elements in each reading (:FORM:ELEM:SENS only selects which are sent)
+    sense_elements = ['VOLT', 'CURR', 'RES', 'TIME', 'STAT']
+
+    # max number of list points and trigger count
+    max_points = 2500
+
+    def reset(self):
+        super().reset()
+        self.source_list = np.array([0.0])
+
+    def command_table(self):
+        commands = super().command_table()
+        commands.update({
+            'FETC?': lambda value: self.fetch(),
+            'READ?': lambda value: (self.start_acquisition(), self.fetch())[1],
+            'FORM:ELEM': lambda value: self.write_setting('FORM:ELEM:SENS', value),
+            'FORM:ELEM?': lambda value: self.settings['FORM:ELEM:SENS'],
+            'SOUR:LIST:VOLT': lambda value: self.write_list(value, append=False),
+            'SOUR:LIST:VOLT:APP': lambda value: self.write_list(value, append=True),
+            'SOUR:LIST:VOLT?': lambda value: ','.join('{:+.6E}'.format(x) for x in self.source_list),
+            'SOUR:LIST:VOLT:POIN?': lambda value: str(len(self.source_list)),
+            'TRIG:COUN': lambda value: self.write_trigger_count(value),
+        })
+        return commands
+
+    def write_list(self, value, append):
+        values = np.array(value.split(','), dtype=float)
+        source_list = np.concatenate([self.source_list, values]) if append else values
+        if len(source_list) > self.max_points:
+            self.errors.append('-223,"Too much data"')
+            return
+        self.source_list = source_list
+
+    def write_trigger_count(self, value):
+        if to_float(value) * to_float(self.settings['ARM:COUN']) > self.max_points:
+            self.errors.append('-222,"Data out of range"')
+            return
+        self.write_setting('TRIG:COUN', value)
+
+    def sense_function(self):
+        return 'CURR'
+
+    def start_acquisition(self, voltages=None, settle=None, period=None):
+        if voltages is None:
+            mode = self.keyword('SOUR:VOLT:MODE')
+            count = self.trigger_count()
+            if mode == 'LIST':
+                voltages = np.resize(self.source_list, count)
+            elif mode == 'SWE':
+                start, stop = to_float(self.settings['SOUR:VOLT:STAR']), to_float(self.settings['SOUR:VOLT:STOP'])
+                step = to_float(self.settings['SOUR:VOLT:STEP'])
+                num_points = int(round((stop - start) / step)) + 1 if step != 0 else count
+                voltages = np.resize(np.linspace(start, stop, num_points), count)
+            else:
+                voltages = np.full(count, to_float(self.settings['SOUR:VOLT']))
+        if settle is None:
+            settle = to_float(self.settings['SOUR:DEL']) + self.measure_time() + to_float(self.settings['TRIG:DEL'])
+        return super().start_acquisition(voltages=voltages, settle=settle, period=period)
+
+    def fetch(self):
+        """ Every reading of the acquisition (available once the acquisition is complete). """
+        if self.acquisition is None or len(self.acquisition['times']) == 0:
+            self.errors.append('-230,"Data corrupt or stale"')
+            return None
+        index = np.arange(len(self.acquisition['times']))
+        times, voltages, values, status = self.readings(index)
+        compliance = to_float(self.settings['SENS:CURR:PROT'])
+        columns = {
+            'VOLT': voltages,
+            'CURR': np.clip(values, -compliance, compliance),
+            'RES': np.full_like(values, 9.91e37),
+            'TIME': times - self.tst_zero,
+            'STAT': np.where(np.abs(values) >= compliance, 8.0, 0.0),  # bit 3: in compliance
+        }
+        elements = [short_keyword(x) for x in self.settings['FORM:ELEM:SENS'].split(',')]
+        fields = [x for x in self.sense_elements if x in elements]
+        return self.format_values(np.column_stack([columns[x] for x in fields])), self.acquisition['times'][-1]
+
+
+class Simulated33210a(SimulatedInstrument):
+    """
+    Agilent 33210A function/arbitrary waveform generator: SIN, SQU, RAMP, PULS, DC and USER waveforms, internal AM,
+    triggered bursts (BURS:STAT ON, *TRG), and arbitrary waveforms (DATA VOLATILE, DATA:DAC VOLATILE, DATA:COPY,
+    DATA:DEL). output_voltage(times) is the voltage at a high-impedance input (e.g., the 6517b), so the programmed
+    amplitude is doubled when OUTP:LOAD is 50 ohms.
+
+    NOTE: the internal modulating waveform starts at phase 0 when AM:STAT ON is received.
+    """
+    model = '33210a'
+    dict_defaults = {
+        'FUNC': 'SIN',
+        'FREQ': '1000',
+        'VOLT': '0.1',
+        'VOLT:OFFS': '0',
+        'VOLT:UNIT': 'VPP',
+        'VOLT:RANG:AUTO': 'ON',
+        'FUNC:SQU:DCYC': '50',
+        'FUNC:RAMP:SYMM': '100',
+        'FUNC:USER': 'EXP_RISE',
+        'OUTP': 'OFF',
+        'OUTP:LOAD': '50',
+        'OUTP:SYNC': 'ON',
+        'AM:STAT': 'OFF',
+        'AM:SOUR': 'INT',
+        'AM:INT:FUNC': 'SIN',
+        'AM:INT:FREQ': '100',
+        'AM:DEPT': '100',
+        'BURS:STAT': 'OFF',
+        'BURS:MODE': 'TRIG',
+        'BURS:NCYC': '1',
+        'TRIG:SOUR': 'IMM',
+        'FORM:BORD': 'NORM',
+    }
+
+    # built-in arbitrary waveforms (listed by DATA:CAT?, cannot be deleted)
+    builtin_arbs = ['EXP_RISE', 'EXP_FALL', 'NEG_RAMP', 'SINC', 'CARDIAC']
+
+    def reset(self):
+        super().reset()
+        self.amplitude_log = [(self.now(), to_float(self.settings['VOLT']))]
+        self.output_log = [(self.now(), 0.0)]
+        # user waveforms in nonvolatile memory are kept (*RST only clears volatile memory)
+        self.arbs = {'VOLATILE': np.zeros(1), **{k: v for k, v in getattr(self, 'arbs', {}).items() if k != 'VOLATILE'}}
+        self.am_start = self.now()
+        self.trigger_time = None
+
+    def command_table(self):
+        commands = super().command_table()
+        commands.update({
+            'VOLT': lambda value: self.write_amplitude(value),
+            'OUTP': lambda value: (self.write_setting('OUTP', value),
+                                   self.output_log.append((self.now(), to_float(value)))),
+            'DATA': lambda value: self.write_arb(value.split(',')[1:], scale=1.0),
+            'DATA:DAC': lambda value: self.write_arb(value.split(',')[1:], scale=8191.0),
+            'DATA:COPY': lambda value: self.copy_arb(value),
+            'DATA:DEL': lambda value: self.delete_arb(value),
+            'DATA:CAT?': lambda value: ','.join('"{}"'.format(x) for x in ['VOLATILE'] + self.builtin_arbs +
+                                                self.nonvolatile_arbs()),
+            'DATA:NVOL:CAT?': lambda value: ','.join('"{}"'.format(x) for x in self.nonvolatile_arbs()),
+            'DATA:NVOL:FREE?': lambda value: str(max_nonvolatile_arbs - len(self.nonvolatile_arbs())),
+            'AM:STAT': lambda value: (self.write_setting('AM:STAT', value), setattr(self, 'am_start', self.now())),
+            '*TRG': lambda value: self.trigger(bus=True),
+            'TRIG': lambda value: self.trigger(),
+        })
+        return commands
+
+    def write_amplitude(self, value):
+        self.write_setting('VOLT', value)
+        # the new amplitude reaches the output once the output attenuator has settled
+        settle = self.timing['amplitude_settle'] if self.is_on('VOLT:RANG:AUTO') else 0.0
+        self.busy_until = max(self.busy_until, self.now()) + settle
+        self.amplitude_log.append((self.busy_until, to_float(value)))
+
+    def write_arb(self, values, scale, point_time=None):
+        values = np.asarray(values, dtype=float) / scale
+        if len(values) > max_arb_points:
+            self.errors.append('-223,"Too much data"')
+            return
+        if point_time is None:
+            point_time = self.timing['ascii_point_time']
+        self.busy_until = max(self.busy_until, self.now()) + len(values) * point_time
+        self.arbs['VOLATILE'] = values
+
+    def handle_block(self, header, data):
+        if normalize_header(header.split(' ')[0]) != 'DATA:DAC':
+            return super().handle_block(header, data)
+        dtype = np.dtype('i2').newbyteorder('<' if self.keyword('FORM:BORD') == 'SWAP' else '>')
+        self.write_arb(np.frombuffer(data, dtype=dtype), scale=8191.0, point_time=self.timing['binary_point_time'])
+
+    def copy_arb(self, value):
+        name = value.split(',')[0].strip().strip('"').upper()
+        if name not in self.arbs and len(self.nonvolatile_arbs()) >= max_nonvolatile_arbs:
+            self.errors.append('-781,"Not enough memory to store new arb waveform"')
+            return
+        self.arbs[name] = self.arbs['VOLATILE'].copy()
+
+    def delete_arb(self, value):
+        name = value.strip().strip('"').upper()
+        if name not in self.nonvolatile_arbs() or name == self.keyword('FUNC:USER'):
+            self.errors.append('-221,"Settings conflict"')  # built-in, or the selected waveform
+            return
+        del self.arbs[name]
+
+    def nonvolatile_arbs(self):
+        return [x for x in self.arbs.keys() if x != 'VOLATILE']
+
+    def trigger(self, bus=False):
+        """ Start a burst (BURS:MODE TRIG): TRIG always, *TRG only when TRIG:SOUR is BUS. """
+        if bus and self.keyword('TRIG:SOUR') != 'BUS':
+            self.errors.append('-211,"Trigger ignored"')
+            return
+        self.trigger_time = self.now()
+
+    # - output
+
+    def waveform(self, func, phase):
+        """ Normalized waveform (-1 to 1) at phase (0 to 1). """
+        if func == 'SIN':
+            return np.sin(2 * np.pi * phase)
+        if func in ['SQU', 'PULS']:
+            return np.where(phase < to_float(self.settings['FUNC:SQU:DCYC']) / 100, 1.0, -1.0)
+        if func in ['RAMP', 'TRI', 'NRAM']:
+            symmetry = {'TRI': 0.5, 'NRAM': 1e-9}.get(func, np.clip(to_float(self.settings['FUNC:RAMP:SYMM']) / 100,
+                                                                    1e-9, 1 - 1e-9))
+            return np.where(phase < symmetry, -1 + 2 * phase / symmetry, 1 - 2 * (phase - symmetry) / (1 - symmetry))
+        if func == 'USER':
+            arb = self.arbs.get(self.keyword('FUNC:USER'), self.arbs['VOLATILE'])
+            return arb[np.minimum((phase * len(arb)).astype(int), len(arb) - 1)]
+        if func == 'NOIS':
+            return np.clip(self.rng.normal(0, 1 / 3, len(phase)), -1, 1)
+        return np.zeros_like(phase)
+
+    def output_voltage(self, times):
+        """ Voltage at a high-impedance input connected to the output, at each time. """
+        times = np.asarray(times, dtype=float)
+        log_index = lambda log: np.clip(np.searchsorted([t for t, _ in log], times, side='right') - 1, 0, None)
+        amplitude = np.array([v for _, v in self.amplitude_log])[log_index(self.amplitude_log)]
+        output = np.array([v for _, v in self.output_log])[log_index(self.output_log)]
+        func = self.keyword('FUNC')
+        cycles = times * to_float(self.settings['FREQ'])
+        if self.is_on('BURS:STAT'):
+            # triggered burst: NCYC cycles from the trigger, otherwise the waveform idles at its start (phase 0)
+            if self.trigger_time is None:
+                cycles = np.zeros_like(times)
+            else:
+                cycles = (times - self.trigger_time) * to_float(self.settings['FREQ'])
+                cycles = np.where((cycles >= 0) & (cycles < to_float(self.settings['BURS:NCYC'])), cycles, 0.0)
+        shape = self.waveform(func, np.mod(cycles, 1.0))
+        if self.is_on('AM:STAT'):
+            # 0% depth = amplitude / 2, 100% depth = amplitude at the peaks of the modulating waveform
+            modulation = self.waveform(self.keyword('AM:INT:FUNC'),
+                                       np.mod((times - self.am_start) * to_float(self.settings['AM:INT:FREQ']), 1.0))
+            amplitude = amplitude * (1 + to_float(self.settings['AM:DEPT']) / 100 * modulation) / 2
+        load = to_float(self.settings['OUTP:LOAD'])
+        load_factor = 1.0 if np.isinf(load) else (load + 50) / load  # 50 ohm output impedance
+        voltage = to_float(self.settings['VOLT:OFFS']) + (0.0 if func == 'DC' else 1.0) * amplitude / 2 * shape
+        return output * load_factor * voltage
+
+
+dict_simulated_models = {
+    '6517b': Simulated6517b,
+    '2410': Simulated2410,
+    '33210a': Simulated33210a,
+}
+
+
+# --- RESOURCE MANAGER
+
+def simulated_model(resource_name):
+    """
+    Model simulated for a resource: 'SIM::<model>::INSTR', a GPIB address in dict_simulated_gpib_addresses, or a USB
+    product id in dict_simulated_usb_products.
+    """
+    parts = resource_name.split('::')
+    if parts[0].upper() == 'SIM' and parts[1].lower() in dict_simulated_models:
+        return parts[1].lower()
+    if parts[0].upper().startswith('GPIB') and int(parts[1]) in dict_simulated_gpib_addresses:
+        return dict_simulated_gpib_addresses[int(parts[1])]
+    if parts[0].upper().startswith('USB') and parts[2].lower() in dict_simulated_usb_products:
+        return dict_simulated_usb_products[parts[2].lower()]
+    raise ValueError("No simulated instrument for {}. Use 'SIM::<model>::INSTR', where model is one of {}.".format(
+        resource_name, list(dict_simulated_models.keys())))
+
+
+class SimulatedResourceManager:
+    """
+    Stand-in for pyvisa.ResourceManager that opens simulated instruments. Instruments opened by the same resource
+    manager share one clock, so one can measure another (see connect).
+
+    :param time_scale: host seconds per instrument second (e.g., 0.1 runs 10x faster than the real instruments).
+        NOTE: only use time_scale != 1 for scripts that do not time steps on the host (e.g., with time.sleep).
+    :param seed: seed for the reading noise
+    :param timing: overrides for dict_simulated_timing (e.g., bus_latency=0.0005)
+    """
+
+    def __init__(self, time_scale=1.0, seed=None, **timing):
+        self.time_scale = time_scale
+        self.seed = seed
+        self.timing = timing
+        self.t0 = time.perf_counter()
+        self.instruments = {}
+
+    def list_resources(self, query='?*::INSTR'):
+        return tuple(self.instruments.keys()) + tuple('SIM::{}::INSTR'.format(x) for x in dict_simulated_models.keys())
+
+    def open_resource(self, resource_name, dut=None, **kwargs):
+        """
+        :param dut: device model for the meters (default: RCDevice())
+        :param kwargs: resource attributes (e.g., timeout, read_termination)
+        """
+        model = simulated_model(resource_name)
+        timing = {k: v for k, v in self.timing.items() if k in dict_simulated_timing[model]}
+        if model in ['6517b', '2410']:
+            timing['dut'] = dut
+        inst = dict_simulated_models[model](resource_name, time_scale=self.time_scale, seed=self.seed, t0=self.t0,
+                                            **timing)
+        for name, value in kwargs.items():
+            setattr(inst, name, value)
+        self.instruments[resource_name] = inst
+        return inst
+
+    def connect(self, meter, source):
+        """ Connect the output of a simulated source (e.g., the 33210A) to the input of a simulated meter (e.g., VOLT). """
+        meter.input_voltage = source.output_voltage
+
+    def close(self):
+        self.instruments.clear()
+
+
+_simulated_resource_manager = None
+
+
+def open_simulated_resource(resource_name, **kwargs):
+    """ Open a simulated instrument with a shared resource manager (e.g., 'SIM::6517b::INSTR' next to real ones). """
+    global _simulated_resource_manager
+    if _simulated_resource_manager is None:
+        _simulated_resource_manager = SimulatedResourceManager()
+    return _simulated_resource_manager.open_resource(resource_name, **kwargs)
+
+
+def get_resource_manager(backend='', **kwargs):
+    """
+    pyvisa.ResourceManager(backend), or a SimulatedResourceManager(**kwargs) if backend is '@lab-sim'.
+    """
+    if backend == simulated_backend:
+        return SimulatedResourceManager(**kwargs)
+    import pyvisa
+    return pyvisa.ResourceManager(backend)
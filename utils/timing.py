@@ -0,0 +1,307 @@
+import os
+import time
+from statistics import NormalDist
+import numpy as np
+import pandas as pd
+
+
+# --- SAMPLING STATISTICS
+
+def summarize_sampling(timestamps):
+    """
+    Achieved sampling period, sampling rate and timestamp jitter from an array of timestamps.
+
+    :param timestamps: timestamps (s) of consecutive readings
+    :return: dict
+    """
+    dt = np.diff(np.asarray(timestamps, dtype=float))
+    sampling_period = np.mean(dt)
+    return {
+        'num_samples': len(dt) + 1,
+        'sampling_period': sampling_period,
+        'sampling_rate': 1 / sampling_period,
+        'jitter_std': np.std(dt),
+        'jitter_max': np.max(np.abs(dt - sampling_period)),
+    }
+
+
+def print_sampling_summary(summary, label='Actual'):
+    print("--- {}:".format(label))
+    print("Sampling period: {} ms".format(np.round(summary['sampling_period'] * 1e3, 2)))
+    print("Sampling frequency: {} Hz".format(np.round(summary['sampling_rate'], 1)))
+    print("Timestamp jitter: {} ms (std), {} ms (max)".format(np.round(summary['jitter_std'] * 1e3, 2),
+                                                              np.round(summary['jitter_max'] * 1e3, 2)))
+
+
+# --- DEADLINE SCHEDULING
+
+# time.sleep() can overshoot by ~1 ms (or ~16 ms with the default Windows timer), so the last spin_time (s) before a
+# deadline is busy-waited instead
+default_spin_time = 2e-3
+
+
+def sleep_until(deadline, spin_time=default_spin_time):
+    """
+    Wait until time.perf_counter() reaches deadline: sleep until spin_time before the deadline, then spin.
+
+    :return: lateness (s)
+    """
+    remaining = deadline - time.perf_counter()
+    if remaining > spin_time:
+        time.sleep(remaining - spin_time)
+    now = time.perf_counter()
+    while now < deadline:
+        time.sleep(0)  # yield (and release the GIL to other threads) while spinning
+        now = time.perf_counter()
+    return now - deadline
+
+
+class DeadlineScheduler:
+    """
+    Run actions at deadlines (s, relative to t0) on time.perf_counter(), which is monotonic and unaffected by
+    wall-clock adjustments. Each wait sleeps until just before the deadline and spins the rest (see sleep_until), so
+    the timing is as tight as a busy-wait loop while using a small fraction of the CPU. The start and completion of
+    every event is logged, for jitter statistics:
+
+        scheduler = DeadlineScheduler(name='6517b')
+        scheduler.start()  # deadlines are relative to start (or to t0)
+        scheduler.run_at(0.5, k1.write, ':SOUR:VOLT 100')
+        scheduler.run_at(1.5, k1.write, ':SOUR:VOLT 0')
+        data = scheduler.poll(k1.query_ascii_values, period=0.1, duration=5, args=(':FETCh?',))
+        scheduler.print_jitter_summary()
+
+    NOTE: a deadline that has already passed runs immediately (and is logged as late).
+    """
+
+    def __init__(self, name='scheduler', spin_time=default_spin_time):
+        self.name = name
+        self.spin_time = spin_time
+        self.records = []
+        self.t0 = None
+
+    def start(self, t0=None):
+        """ Deadlines are relative to t0 (time.perf_counter(); default: now). """
+        self.t0 = time.perf_counter() if t0 is None else t0
+
+    def now(self):
+        """ Time (s) since t0. """
+        return time.perf_counter() - self.t0
+
+    def wait_until(self, at, name='wait'):
+        """ Wait until time at (s, relative to t0). :return: lateness (s) """
+        lateness = sleep_until(self.t0 + at, self.spin_time)
+        self.records.append((name, at, at + lateness, at + lateness))
+        return lateness
+
+    def run_at(self, at, func, *args, name=None, **kwargs):
+        """ Call func(*args, **kwargs) at time at (s, relative to t0). :return: func's return value """
+        start = sleep_until(self.t0 + at, self.spin_time) + at
+        result = func(*args, **kwargs)
+        self.records.append((name or getattr(func, '__name__', 'call'), at, start, self.now()))
+        return result
+
+    def poll(self, func, period, duration, max_count=None, args=(), kwargs=None, name=None):
+        """
+        Call func every period s (at 0, period, 2 * period, ... relative to the first call) for duration s, or until
+        it has been called max_count times.
+
+        NOTE: if a call overruns its period, the missed deadlines are skipped (instead of calling func back-to-back).
+
+        :return: list of func's return values
+        """
+        kwargs = {} if kwargs is None else kwargs
+        results = []
+        at = self.now()
+        end = at + duration
+        while at < end and (max_count is None or len(results) < max_count):
+            results.append(self.run_at(at, func, *args, name=name, **kwargs))
+            at += period
+            if at < self.now():
+                at += np.ceil((self.now() - at) / period) * period
+        return results
+
+    def log(self, name=None):
+        """ Scheduled time, start and completion (s, relative to t0) and lateness (start - scheduled) of each event. """
+        df = pd.DataFrame(self.records, columns=['name', 'scheduled', 'start', 'stop'])
+        df['lateness'] = df['start'] - df['scheduled']
+        df['duration'] = df['stop'] - df['start']
+        return df if name is None else df[df['name'] == name]
+
+    def jitter_summary(self, name=None):
+        lateness = self.log(name)['lateness'].to_numpy()
+        return {
+            'num_events': len(lateness),
+            'lateness_mean': np.mean(lateness),
+            'lateness_std': np.std(lateness),
+            'lateness_p99': np.percentile(lateness, 99),
+            'lateness_max': np.max(lateness),
+        }
+
+    def print_jitter_summary(self, name=None):
+        if len(self.log(name)) == 0:
+            return
+        summary = self.jitter_summary(name)
+        print("--- {}: {} scheduled events, lateness (start - scheduled): mean = {} ms, std = {} ms, "
+              "p99 = {} ms, max = {} ms".format(self.name if name is None else '{} ({})'.format(self.name, name),
+                                                summary['num_events'],
+                                                *[np.round(summary[k] * 1e3, 3) for k in ['lateness_mean',
+                                                                                          'lateness_std',
+                                                                                          'lateness_p99',
+                                                                                          'lateness_max']]))
+
+
+# --- RUN DURATION MODEL
+
+# every recorded run is appended here, so the model improves as more runs are made
+default_run_durations_file = os.path.join(os.path.expanduser('~'), 'py-pennathur-lab_run_durations.csv')
+
+run_duration_columns = ['instrument', 'mode', 'display', 'data_format', 'num_points', 'nplc', 'source_delay',
+                        'duration']
+
+# columns that group runs (runs are only fit against runs of the same group)
+run_duration_groups = ['instrument', 'mode', 'display', 'data_format']
+
+
+def run_duration_features(num_points, nplc, source_delay, line_frequency=60):
+    """
+    Features of: duration = num_points * (overhead/point + k_int * integration period + k_delay * source delay)
+    + overhead/run
+    """
+    num_points = np.asarray(num_points, dtype=float)
+    return np.column_stack([num_points,
+                            num_points * np.asarray(nplc, dtype=float) / line_frequency,
+                            num_points * np.asarray(source_delay, dtype=float),
+                            np.ones_like(num_points)])
+
+
+class RunDurationModel:
+    """
+    Predict how long a run takes (and the PyVISA timeout it needs) from runs recorded on the same instrument.
+
+    Runs are grouped by (instrument, mode, display, data_format), because those change the per-reading overhead. mode
+    names the acquisition (e.g., 'LIST_SWEEP' or 'FETCH_LOOP', or the script), so that runs of unrelated acquisitions
+    on the same instrument are not fit together. Within a group, duration is fit by least squares as a linear function
+    of num_points, num_points * integration period and num_points * source delay (see run_duration_features). The
+    timeout is the prediction plus a confidence margin from the fit residuals (at least min_margin of the prediction).
+    The timeout falls back to fallback_factor times the theoretical duration (i.e., the hand-tuned formulas that were
+    used before) until a group has enough runs, and for runs the fit can't predict: an NPLC or source delay outside the
+    recorded range, or a combination of features the recorded runs don't determine (e.g., a new NPLC when every run
+    was recorded at the same NPLC).
+
+        run_model = RunDurationModel()
+        k1.timeout = run_model.timeout('2410', num_points, nplc=NPLC, source_delay=delay, mode='LIST_SWEEP') * 1000
+        ...
+        run_model.record('2410', num_points_measured, duration, nplc=NPLC, source_delay=delay, mode='LIST_SWEEP')
+
+    NOTE: record the number of readings actually taken, and time the run from its :INIT (not from the setup).
+    """
+
+    def __init__(self, records_file=default_run_durations_file, line_frequency=60, min_runs=6, fallback_factor=3,
+                 min_timeout=2.0, min_margin=0.1):
+        self.records_file = records_file
+        self.line_frequency = line_frequency
+        self.min_runs = min_runs
+        self.fallback_factor = fallback_factor
+        self.min_timeout = min_timeout
+        self.min_margin = min_margin
+        self.rewrite_records = False
+        if records_file is not None and os.path.exists(records_file):
+            self.records = pd.read_csv(records_file, dtype={x: str for x in run_duration_groups})
+            # files recorded before runs were grouped by mode: those runs are in the '' mode
+            self.rewrite_records = list(self.records.columns) != run_duration_columns
+            self.records = self.records.reindex(columns=run_duration_columns)
+            self.records[run_duration_groups] = self.records[run_duration_groups].fillna('')
+        else:
+            self.records = pd.DataFrame(columns=run_duration_columns)
+        self.fits = {}
+
+    def record(self, instrument, num_points, duration, nplc=1, source_delay=0, display='ON', data_format='ASCii',
+               mode='', save=True):
+        """ Add a completed run (num_points readings taken in duration seconds) and append it to records_file. """
+        run = pd.DataFrame([[instrument, mode, display, data_format, num_points, nplc, source_delay, duration]],
+                           columns=run_duration_columns)
+        self.records = pd.concat([self.records, run], ignore_index=True) if len(self.records) else run
+        self.fits.pop((instrument, mode, display, data_format), None)
+        if save and self.records_file is not None:
+            if self.rewrite_records:
+                self.records.to_csv(self.records_file, index=False)
+                self.rewrite_records = False
+            else:
+                run.to_csv(self.records_file, mode='a', index=False, header=not os.path.exists(self.records_file))
+
+    def fit(self, instrument, display='ON', data_format='ASCii', mode=''):
+        """
+        Fit the runs of one group.
+
+        :return: dict of the coefficients, residual standard deviation ('residual_std'), number of runs ('num_runs'),
+            median num_points, the recorded NPLC and source delay ranges, and an orthonormal basis of the features the
+            runs determine ('basis'), or None if there are too few runs
+        """
+        key = (instrument, mode, display, data_format)
+        if key not in self.fits:
+            df = self.records[(self.records[run_duration_groups] == list(key)).all(axis=1)]
+            if len(df) < self.min_runs:
+                return None
+            X = run_duration_features(df['num_points'], df['nplc'], df['source_delay'], self.line_frequency)
+            y = df['duration'].to_numpy(dtype=float)
+            coefficients = np.linalg.lstsq(X, y, rcond=None)[0]
+            residuals = y - X @ coefficients
+            dof = max(len(y) - X.shape[1], 1)
+            # the fit only predicts features in the row space of X (e.g., not a new NPLC if every run had the same one)
+            _, singular_values, vt = np.linalg.svd(X, full_matrices=False)
+            rank = int(np.sum(singular_values > singular_values[0] * 1e-9))
+            nplcs, source_delays = df['nplc'].astype(float), df['source_delay'].astype(float)
+            self.fits[key] = {
+                'coefficients': coefficients,
+                'residual_std': np.sqrt(np.sum(residuals ** 2) / dof),
+                'num_runs': len(y),
+                'median_num_points': df['num_points'].astype(float).median(),
+                'nplc_range': (nplcs.min(), nplcs.max()),
+                'source_delay_range': (source_delays.min(), source_delays.max()),
+                'basis': vt[:rank],
+            }
+        return self.fits[key]
+
+    def covers(self, fit, num_points, nplc=1, source_delay=0):
+        """
+        True if the fit can predict this run: no extrapolation in NPLC or source delay, or along features that the
+        recorded runs don't determine.
+        """
+        if not fit['nplc_range'][0] <= nplc <= fit['nplc_range'][1]:
+            return False
+        if not fit['source_delay_range'][0] <= source_delay <= fit['source_delay_range'][1]:
+            return False
+        x = run_duration_features(num_points, nplc, source_delay, self.line_frequency)[0]
+        x_out = x - fit['basis'].T @ (fit['basis'] @ x)
+        return np.linalg.norm(x_out) <= 1e-6 * np.linalg.norm(x)
+
+    def theoretical_duration(self, num_points, nplc=1, source_delay=0):
+        return num_points * (nplc / self.line_frequency + source_delay)
+
+    def predict(self, instrument, num_points, nplc=1, source_delay=0, display='ON', data_format='ASCii', mode=''):
+        """
+        Predicted run duration (s). Falls back to the theoretical duration if the group has too few runs or the fit
+        doesn't cover the run (see covers).
+        """
+        fit = self.fit(instrument, display, data_format, mode)
+        if fit is None or not self.covers(fit, num_points, nplc, source_delay):
+            return self.theoretical_duration(num_points, nplc, source_delay)
+        X = run_duration_features(num_points, nplc, source_delay, self.line_frequency)
+        return max(float((X @ fit['coefficients'])[0]), 0.0)
+
+    def timeout(self, instrument, num_points, nplc=1, source_delay=0, display='ON', data_format='ASCii', mode='',
+                confidence=0.999):
+        """
+        Timeout (s) that the run should finish within, with probability ~confidence (assuming normal residuals).
+        """
+        fit = self.fit(instrument, display, data_format, mode)
+        if fit is None or not self.covers(fit, num_points, nplc, source_delay):
+            estimate = self.fallback_factor * self.theoretical_duration(num_points, nplc, source_delay)
+        else:
+            z = NormalDist().inv_cdf(confidence)
+            prediction = self.predict(instrument, num_points, nplc, source_delay, display, data_format, mode)
+            # the margin scales with the run length (relative to the runs it was fit to), since the per-point overhead
+            # is what varies between runs
+            scale = max(1.0, num_points / fit['median_num_points'])
+            estimate = prediction + max(z * fit['residual_std'] * scale, self.min_margin * prediction)
+        return max(estimate, self.min_timeout)
@@ -0,0 +1,211 @@
+import json
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from utils.scpi import split_command
+
+
+# --- SCPI TRANSACTION TRACING
+
+# resource methods that are traced (everything else is passed through untouched)
+traced_methods = ['write', 'write_raw', 'write_binary_values', 'read', 'read_raw', 'query', 'query_ascii_values',
+                  'query_binary_values', 'read_stb', 'wait_for_srq', 'assert_trigger', 'clear']
+
+# one record per transaction (24 bytes): instrument, method and command are indices into the tracer's name tables
+trace_dtype = np.dtype([
+    ('start', 'f8'),  # (s) since the tracer was created
+    ('duration', 'f4'),  # (s)
+    ('sent', 'u4'),  # bytes written
+    ('received', 'u4'),  # bytes read (decoded size for query_ascii_values and query_binary_values)
+    ('instrument', 'u1'),
+    ('method', 'u1'),
+    ('command', 'u2'),
+])
+
+# latency histogram bin edges (s): 100 us to 100 s, 3 bins per decade
+default_latency_bins = np.logspace(-4, 2, 19)
+
+
+def command_key(message):
+    """ Group a message by its headers, without parameters (e.g., 'VOLT 1.25' -> 'VOLT', ':A 1;:B 2' -> ':A;:B'). """
+    if isinstance(message, bytes):
+        message = message[:message.index(b'#')] if b'#' in message else message
+        message = message.decode(errors='replace')
+    return ';'.join(split_command(command)[0] for command in message.strip().split(';') if command.strip())
+
+
+def response_size(response):
+    if isinstance(response, (str, bytes)):
+        return len(response)
+    if response is None or isinstance(response, (int, float)):
+        return 0
+    return np.asarray(response).nbytes
+
+
+class SCPITracer:
+    """
+    Record every transaction with one or more instruments into a fixed-size ring buffer of compact binary records.
+
+    Wrap each resource with trace() (opt-in: the instruments are not touched otherwise), run as usual, then look at
+    where the time went:
+
+        tracer = SCPITracer()
+        k1, awg = tracer.trace(k1, 'k1'), tracer.trace(awg, 'awg')
+        ...
+        tracer.print_summary()  # bus time vs. time waiting on the instrument, per command
+        tracer.print_histograms()  # per-command latency histograms
+        tracer.export_timeline('trace.json')  # open in chrome://tracing or https://ui.perfetto.dev
+
+    NOTE: when the ring buffer is full, the oldest records are overwritten (see num_dropped).
+    """
+
+    def __init__(self, capacity=100000):
+        self.records = np.zeros(capacity, dtype=trace_dtype)
+        self.num_records = 0
+        self.instruments, self.methods, self.commands = [], list(traced_methods), []
+        self.lock = threading.Lock()  # instruments may be used from several threads (e.g., InstrumentGroup)
+        self.t0 = time.perf_counter()
+
+    @staticmethod
+    def _index(names, name):
+        if name not in names:
+            names.append(name)
+        return names.index(name)
+
+    def record(self, instrument, method, command, start, stop, sent=0, received=0):
+        with self.lock:
+            i = self.num_records % len(self.records)
+            self.records[i] = (start - self.t0, stop - start, sent, received, self._index(self.instruments, instrument),
+                               self._index(self.methods, method), self._index(self.commands, command))
+            self.num_records += 1
+
+    def trace(self, inst, name=None):
+        """ Wrap a resource so that its transactions are recorded under name (default: its resource name). """
+        if name is None:
+            name = getattr(inst, 'resource_name', 'inst{}'.format(len(self.instruments)))
+        self._index(self.instruments, name)
+        return TracedInstrument(inst, self, name)
+
+    @property
+    def num_dropped(self):
+        return max(0, self.num_records - len(self.records))
+
+    def clear(self):
+        self.num_records = 0
+        self.t0 = time.perf_counter()
+
+    # - analysis
+
+    def to_dataframe(self):
+        """ Every record still in the ring buffer, in chronological order. """
+        with self.lock:
+            if self.num_records <= len(self.records):
+                records = self.records[:self.num_records].copy()
+            else:
+                i = self.num_records % len(self.records)
+                records = np.concatenate([self.records[i:], self.records[:i]])
+        df = pd.DataFrame(records)
+        df['duration'] = df['duration'].astype(float)
+        df['stop'] = df['start'] + df['duration']
+        for column, names in zip(['instrument', 'method', 'command'], [self.instruments, self.methods, self.commands]):
+            df[column] = pd.Categorical.from_codes(df[column].astype(int), categories=names)
+        return df[['instrument', 'method', 'command', 'start', 'stop', 'duration', 'sent', 'received']]
+
+    def summary(self):
+        """
+        Count, latency and bytes per (instrument, method, command), with the total time split into bus time and the time
+        spent waiting on the instrument.
+
+        NOTE: bus time is estimated as count x the fastest transaction of each command (i.e., a transaction that did not
+        wait on the instrument), and the rest is attributed to the instrument (e.g., a :FETCh? that waits for a reading).
+        """
+        df = self.to_dataframe()
+        dfg = df.groupby(['instrument', 'method', 'command'], observed=True).agg(
+            count=('duration', 'size'), total_time=('duration', 'sum'), mean_time=('duration', 'mean'),
+            median_time=('duration', 'median'), min_time=('duration', 'min'), max_time=('duration', 'max'),
+            sent=('sent', 'sum'), received=('received', 'sum'))
+        dfg['bus_time'] = dfg['count'] * dfg['min_time']
+        dfg['instrument_time'] = dfg['total_time'] - dfg['bus_time']
+        return dfg.sort_values('total_time', ascending=False)
+
+    def histograms(self, bins=default_latency_bins):
+        """ Number of transactions per latency bin (columns: upper bin edge, in s), per (instrument, method, command). """
+        df = self.to_dataframe()
+        df['bin'] = pd.cut(df['duration'].clip(bins[0], bins[-1]), bins=bins, include_lowest=True,
+                           labels=bins[1:])
+        return df.groupby(['instrument', 'method', 'command', 'bin'], observed=True).size().unstack(fill_value=0)
+
+    def print_summary(self):
+        dfg = self.summary()
+        wall_time = self.to_dataframe()['stop'].max() - self.to_dataframe()['start'].min() if len(dfg) else 0
+        print("--- SCPI trace: {} transactions in {} s ({} dropped)".format(
+            int(dfg['count'].sum()), np.round(wall_time, 3), self.num_dropped))
+        print("Time in transactions: {} s (bus: {} s, waiting on instruments: {} s)".format(
+            np.round(dfg['total_time'].sum(), 3), np.round(dfg['bus_time'].sum(), 3),
+            np.round(dfg['instrument_time'].sum(), 3)))
+        print(dfg[['count', 'total_time', 'median_time', 'max_time', 'bus_time', 'instrument_time', 'sent',
+                   'received']].to_string(float_format=lambda x: '{:.4g}'.format(x)))
+
+    def print_histograms(self, bins=default_latency_bins, width=40):
+        dfh = self.histograms(bins=bins)
+        for key, counts in dfh.iterrows():
+            counts = counts[counts > 0]
+            print("--- {} (n = {})".format(' '.join(str(x) for x in key), int(counts.sum())))
+            for upper, n in counts.items():
+                print("  <= {:>9.3f} ms | {:<{}} {}".format(float(upper) * 1e3, '#' * int(np.ceil(width * n / counts.max())),
+                                                           width, n))
+
+    def export_timeline(self, path):
+        """
+        Export every transaction as a timeline: Chrome trace format if path ends with '.json' (one row per
+        instrument in chrome://tracing or https://ui.perfetto.dev), otherwise CSV.
+        """
+        df = self.to_dataframe()
+        if not path.endswith('.json'):
+            df.to_csv(path, index=False)
+            return
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': i, 'args': {'name': name}}
+                  for i, name in enumerate(self.instruments)]
+        for row in df.itertuples(index=False):
+            events.append({'name': row.command or row.method, 'cat': row.method, 'ph': 'X', 'pid': 0,
+                           'tid': self.instruments.index(row.instrument), 'ts': row.start * 1e6,
+                           'dur': row.duration * 1e6, 'args': {'sent': int(row.sent), 'received': int(row.received)}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class TracedInstrument:
+    """
+    Stand-in for a pyvisa resource that records every transaction (see traced_methods) with its SCPITracer.
+    Everything else (e.g., timeout, close) is passed through to the resource.
+    """
+
+    def __init__(self, inst, tracer, name):
+        self.__dict__['inst'] = inst
+        self.__dict__['tracer'] = tracer
+        self.__dict__['name'] = name
+
+    def _traced(self, method):
+        func = getattr(self.inst, method)
+
+        def traced(*args, **kwargs):
+            message = args[0] if args and isinstance(args[0], (str, bytes)) else ''
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            stop = time.perf_counter()
+            self.tracer.record(self.name, method, command_key(message), start, stop,
+                               sent=len(message) if method.startswith(('write', 'query')) else 0,
+                               received=0 if method.startswith('write') else response_size(result))
+            return result
+
+        return traced
+
+    def __getattr__(self, name):
+        if name in traced_methods:
+            return self._traced(name)
+        return getattr(self.inst, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.inst, name, value)
@@ -0,0 +1,200 @@
+import hashlib
+import numpy as np
+
+
+# --- ON-INSTRUMENT SWEEP SCRIPTS (TSP)
+# NOTE: TSP is only available on TSP instruments (e.g., 2450/2460/2461 in TSP mode, 2600 series). The 6517b and 2410
+# are SCPI-only, so they use the buffered sweeps in utils/keithley_6517.py and utils/keithley_2410.py instead.
+
+def sweep_function_source(params, first_level, loop):
+    """ Source of a sweep function: setup, loop (which calls step(level, dwell) for every point), output off. """
+    return """
+function {name}(""" + params + """, nplc, irange)
+    local function step(level, dwell)
+        smu.source.level = level
+        delay(dwell)
+        smu.measure.read(defbuffer1)
+    end
+    defbuffer1.clear()
+    smu.source.func = smu.FUNC_DC_VOLTAGE
+    smu.measure.func = smu.FUNC_DC_CURRENT
+    smu.measure.nplc = nplc
+    smu.measure.range = irange
+    smu.source.level = """ + first_level + """
+    smu.source.output = smu.ON
+""" + loop + """
+    smu.source.level = 0
+    smu.source.output = smu.OFF
+end
+"""
+
+
+# every sweep function clears defbuffer1, runs the sweep with on-instrument timing (delay()), and leaves the readings,
+# relative timestamps and source values in defbuffer1. {name} is replaced by the deployed (hashed) function name.
+# Each level is held for its dwell and measured at the end of it, i.e., the same schedule that the host-timed scripts
+# step through. 'ramp', 'hold', 'pulse' and 'bipolar_square' take the parameters of the utils.waveforms builders of
+# the same name, and 'sequence' runs levels and dwells tables that are stored on the instrument (see store_sequence).
+dict_tsp_sweeps = {
+    'ramp': sweep_function_source('start, step_size, num_points, dwell', 'start', """
+    for i = 0, num_points - 1 do
+        step(start + i * step_size, dwell)
+    end"""),
+    'hold': sweep_function_source('level, num_points, dwell', 'level', """
+    for i = 1, num_points do
+        step(level, dwell)
+    end"""),
+    'pulse': sweep_function_source('base, peak, width, dwell', 'base', """
+    step(base, dwell)
+    for i = 1, width do
+        step(peak, dwell)
+    end
+    step(base, dwell)"""),
+    'bipolar_square': sweep_function_source('amplitude, n_cycles, dwell', '0', """
+    for i = 1, n_cycles do
+        step(0, dwell)
+        step(amplitude, dwell)
+        step(0, dwell)
+        step(-amplitude, dwell)
+        step(0, dwell)
+    end"""),
+    'sequence': sweep_function_source('levels, dwells', 'levels[1]', """
+    for i = 1, table.getn(levels) do
+        step(levels[i], dwells[i])
+    end"""),
+}
+
+# number of values per line of a stored sequence (keeps every message short)
+values_per_line = 100
+
+
+def sequence_arguments(sequence):
+    """
+    Sweep function and arguments that run a utils.waveforms.Sequence from the parameters it was built from, or None if
+    it isn't a single ramp, hold, pulse or bipolar square wave (e.g., a concatenation: see store_sequence).
+    """
+    kind, levels = sequence.key[0], sequence.levels
+    if kind == 'ramp':
+        step_size = levels[1] - levels[0] if len(levels) > 1 else 0.0
+        return kind, (levels[0], step_size, len(levels), sequence.key[-1])
+    if kind in ['hold', 'pulse', 'bipolar_square']:
+        return kind, sequence.key[1:]  # (level, num_points, dwell), (base, peak, width, dwell), ...
+    return None
+
+
+class LuaName(str):
+    """ Lua expression (e.g., a table stored on the instrument) passed to a sweep function as is, not as a string. """
+
+
+def tsp_function_name(kind, source):
+    """ Name a deployed function by the hash of its source, e.g., 'list_3f2a9c1b'. """
+    return '{}_{}'.format(kind, hashlib.sha1(source.encode()).hexdigest()[:8])
+
+
+def to_lua(value):
+    """ Format a Python value (number, string or sequence of numbers) as a Lua literal. """
+    if isinstance(value, LuaName):
+        return str(value)
+    if isinstance(value, str):
+        return '"{}"'.format(value)
+    if np.ndim(value) > 0:
+        return '{' + ','.join(repr(float(x)) for x in np.ravel(value)) + '}'
+    return repr(float(value))
+
+
+class TSPSweepDeployer:
+    """
+    Deploy sweep functions onto a TSP instrument once and call them by name afterwards.
+
+    Each function is loaded as a named script ('load_<name>') whose name contains the hash of its source, saved to
+    nonvolatile memory, and run once to define the function. On the next run (or script invocation), the function is
+    found on the instrument and the upload is skipped. If the function's source changes, so does its name. Sequences
+    that aren't a single builder (e.g., concatenations) are stored the same way, as tables named by the hash of their
+    levels and dwells, so a repeated run only sends the function call.
+
+        deployer = TSPSweepDeployer(smu)
+        Vs = concatenate(hold(0, 5, dwell=0.01), pulse(0, 50, 7, dwell=0.01))  # utils/waveforms.py
+        data = deployer.run_sequence(Vs, nplc=0.01, irange=1e-3)  # (N, 3): reading, relative timestamp, source value
+
+    NOTE: scripts are uploaded one line per message, so no message grows with the length of a sequence.
+    """
+
+    def __init__(self, inst, sweeps=None, save=True):
+        self.inst = inst
+        self.sweeps = dict_tsp_sweeps if sweeps is None else sweeps
+        self.save = save
+        self.deployed = {}
+        self.stored = set()
+        self.num_uploads = 0
+
+    def is_deployed(self, name):
+        return self.inst.query('print({} ~= nil)'.format(name)).strip() == 'true'
+
+    def load(self, name, source):
+        """ Define name on the instrument by running the script 'load_<name>' (uploaded first if it isn't there). """
+        if self.is_deployed(name):
+            return
+        script = 'load_' + name
+        # the script may already be in nonvolatile memory (e.g., after a power cycle): run it instead of uploading
+        if not self.is_deployed(script):
+            self.inst.write('loadscript {}'.format(script))
+            for line in source.strip().splitlines():
+                self.inst.write(line)
+            self.inst.write('endscript')
+            self.num_uploads += 1
+            if self.save:
+                self.inst.write('{}.save()'.format(script))
+        self.inst.write('{}()'.format(script))
+
+    def deploy(self, kind):
+        """ Make sure the sweep function for kind is defined on the instrument, and return its name. """
+        if kind not in self.deployed:
+            name = tsp_function_name(kind, self.sweeps[kind])
+            self.load(name, self.sweeps[kind].format(name=name))
+            self.deployed[kind] = name
+        return self.deployed[kind]
+
+    def store_sequence(self, sequence):
+        """ Store a sequence's levels and dwells on the instrument (once), and return the name of their table. """
+        levels, dwells = np.ascontiguousarray(sequence.levels), np.ascontiguousarray(sequence.dwells)
+        name = 'seq_' + hashlib.sha1(levels.tobytes() + dwells.tobytes()).hexdigest()[:8]
+        if name not in self.stored:
+            lines = ['{} = {{levels = {{}}, dwells = {{}}}}'.format(name)]
+            for key, values in [('levels', levels), ('dwells', dwells)]:
+                for i in range(0, len(values), values_per_line):
+                    lines.append('for _, v in ipairs({}) do table.insert({}.{}, v) end'.format(
+                        to_lua(values[i:i + values_per_line]), name, key))
+            self.load(name, '\n'.join(lines))
+            self.stored.add(name)
+        return name
+
+    def call(self, kind, *args):
+        """ Call the deployed sweep function with arguments (numbers, strings or lists) and wait for it to finish. """
+        name = self.deploy(kind)
+        self.inst.write('{}({})'.format(name, ','.join(to_lua(x) for x in args)))
+        self.inst.query('waitcomplete() print(1)')
+
+    def read_buffer(self):
+        """ Readings, relative timestamps and source values in defbuffer1, as an (N, 3) array. """
+        num_readings = int(float(self.inst.query('print(defbuffer1.n)')))
+        if num_readings == 0:
+            return np.empty((0, 3))
+        values = self.inst.query_ascii_values(
+            'printbuffer(1, defbuffer1.n, defbuffer1.readings, defbuffer1.relativetimestamps, '
+            'defbuffer1.sourcevalues)', container=np.array)
+        return np.reshape(values, (num_readings, 3))
+
+    def run(self, kind, *args):
+        self.call(kind, *args)
+        return self.read_buffer()
+
+    def run_sequence(self, sequence, nplc=1, irange=1e-3):
+        """
+        Run a utils.waveforms.Sequence: a single ramp, hold, pulse or bipolar square wave calls its own function with
+        the parameters it was built from, and any other sequence calls 'sequence' with its stored tables.
+        """
+        arguments = sequence_arguments(sequence)
+        if arguments is not None:
+            kind, args = arguments
+            return self.run(kind, *args, nplc, irange)
+        name = self.store_sequence(sequence)
+        return self.run('sequence', LuaName(name + '.levels'), LuaName(name + '.dwells'), nplc, irange)
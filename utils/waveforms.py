@@ -0,0 +1,204 @@
+import functools
+import hashlib
+import numpy as np
+
+
+# --- VOLTAGE SEQUENCES
+
+# max number of distinct sequences kept by each memoized builder
+cache_size = 256
+
+
+class Sequence:
+    """
+    Voltage schedule: levels[i] is held for dwells[i] s (i.e., a staircase), built from composable segments:
+
+        cycle = mirror(concatenate(ramp(0, 100, step=25), hold(100, 3)))  # 0, 25, ... 100, 100, 100, 100, 75, ... 0
+        Vs = repeat(cycle, 1000, join_smooth=True)
+        t, V = Vs.t, Vs.V  # start time (s) and level of each point
+
+    Every builder is memoized on its parameters (sequences are hashed by how they were built), so rebuilding the same
+    schedule in a loop or in another script costs nothing. Sequences are read-only and can be passed wherever an array
+    of voltages is expected (e.g., run_6517_buffered_sweep, run_list_sweep), since np.asarray(sequence) == sequence.V.
+    """
+
+    def __init__(self, levels, dwells, key):
+        # copies: the sequence is frozen below, and must neither freeze nor follow the caller's arrays
+        self.levels = np.array(levels, dtype=float)
+        self.dwells = np.broadcast_to(np.array(dwells, dtype=float), self.levels.shape)
+        self.levels.setflags(write=False)
+        self.key = key
+
+    @property
+    def V(self):
+        return self.levels
+
+    @functools.cached_property
+    def t(self):
+        """ Start time (s) of each point. """
+        t = np.cumsum(self.dwells) - self.dwells
+        t.setflags(write=False)
+        return t
+
+    @property
+    def duration(self):
+        return float(np.sum(self.dwells))
+
+    def __len__(self):
+        return len(self.levels)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.levels if dtype is None else self.levels.astype(dtype)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, Sequence) and self.key == other.key
+
+    def __repr__(self):
+        return 'Sequence({} points, {} s)'.format(len(self), self.duration)
+
+
+def from_levels(levels, dwell=1.0):
+    """ Sequence of arbitrary levels, each held for dwell s (dwell may also be an array). """
+    levels, dwells = np.asarray(levels, dtype=float), np.asarray(dwell, dtype=float)
+    key = ('levels', hashlib.sha1(levels.tobytes() + dwells.tobytes()).hexdigest(), dwells.shape)
+    return Sequence(levels, dwells, key)
+
+
+@functools.lru_cache(maxsize=cache_size)
+def ramp(start, stop, step=None, num=None, dwell=1.0):
+    """
+    Linear ramp from start to stop (inclusive), by step (e.g., 0, 25, ..., 100) or in num points.
+    NOTE: with step, stop is included if it is a whole number of steps from start (like np.arange(start, stop + step)).
+    """
+    if num is None:
+        step = abs(step) * np.sign(stop - start) if stop != start else abs(step)
+        num = int(np.floor(round((stop - start) / step, 9))) + 1
+    return Sequence(start + (stop - start) * np.linspace(0, 1, num) if step is None else start + step * np.arange(num),
+                    dwell, ('ramp', start, stop, step, num, dwell))
+
+
+@functools.lru_cache(maxsize=cache_size)
+def hold(level, num_points=1, dwell=1.0):
+    """ Hold level for num_points points. """
+    return Sequence(np.full(num_points, float(level)), dwell, ('hold', level, num_points, dwell))
+
+
+@functools.lru_cache(maxsize=cache_size)
+def pulse(base, peak, width=1, dwell=1.0):
+    """ base, then peak for width points, then back to base. """
+    levels = np.full(width + 2, float(peak))
+    levels[[0, -1]] = base
+    return Sequence(levels, dwell, ('pulse', base, peak, width, dwell))
+
+
+@functools.lru_cache(maxsize=cache_size)
+def bipolar_square(amplitude, n_cycles, dwell=1.0):
+    """ n_cycles of 0, amplitude, 0, -amplitude, 0. """
+    return Sequence(np.tile([0.0, amplitude, 0.0, -amplitude, 0.0], n_cycles), dwell,
+                    ('bipolar_square', amplitude, n_cycles, dwell))
+
+
+@functools.lru_cache(maxsize=cache_size)
+def mirror(sequence, repeat_peak=False):
+    """ Append the sequence to itself in reverse order (e.g., ramp up -> ramp up and down). """
+    start = 0 if repeat_peak else 1
+    return Sequence(np.concatenate([sequence.levels, sequence.levels[::-1][start:]]),
+                    np.concatenate([sequence.dwells, sequence.dwells[::-1][start:]]),
+                    ('mirror', sequence.key, repeat_peak))
+
+
+@functools.lru_cache(maxsize=cache_size)
+def repeat(sequence, n, join_smooth=False):
+    """
+    Repeat the sequence n times. If join_smooth, the last point of each repetition (but the last) is dropped, so that
+    cycles that end where they start (e.g., 0 -> V -> 0) are not joined by a repeated point.
+    """
+    if join_smooth and len(sequence) > 1:
+        levels = np.append(np.tile(sequence.levels[:-1], n), sequence.levels[-1])
+        dwells = np.append(np.tile(sequence.dwells[:-1], n), sequence.dwells[-1])
+    else:
+        levels, dwells = np.tile(sequence.levels, n), np.tile(sequence.dwells, n)
+    return Sequence(levels, dwells, ('repeat', sequence.key, n, join_smooth))
+
+
+def concatenate(*sequences):
+    return _concatenate(tuple(sequences))
+
+
+@functools.lru_cache(maxsize=cache_size)
+def _concatenate(sequences):
+    return Sequence(np.concatenate([x.levels for x in sequences]), np.concatenate([x.dwells for x in sequences]),
+                    ('concatenate',) + tuple(x.key for x in sequences))
+
+
+@functools.lru_cache(maxsize=cache_size)
+def scale(sequence, factor, offset=0.0):
+    """ factor * sequence + offset (e.g., a normalized 0-1 sequence to volts). """
+    return Sequence(sequence.levels * factor + offset, sequence.dwells, ('scale', sequence.key, factor, offset))
+
+
+# --- ARRAY HELPERS (used by the scripts; return writable arrays of the input's dtype)
+
+def append_reverse(arr, single_point_max):
+    """
+    Append a NumPy array to itself in reverse order.
+    """
+    return mirror(from_levels(arr), repeat_peak=single_point_max is not True).V.astype(np.asarray(arr).dtype)
+
+
+def repeat_n_cycles(arr, n, join_smooth=False):
+    return repeat(from_levels(arr), n, join_smooth=join_smooth).V.astype(np.asarray(arr).dtype)
+
+
+def generate_bipolar_square_wave(Vmax, n_cycles):
+    """
+    Generate a bipolar square wave of voltages.
+
+    Parameters:
+        Vmax (float): Maximum voltage value.
+        n_cycles (int): Number of cycles of the waveform.
+
+    Returns:
+        numpy.ndarray: An array of the voltage values representing the bipolar square wave.
+    """
+    return bipolar_square(Vmax, n_cycles).V.astype(np.result_type(Vmax, 0))
+
+
+# --- STAIRCASE TRACES (FOR PLOTTING)
+
+def staircase_trace(t, levels, edge_time, edge='leading'):
+    """
+    (t, V) trace that shows a sampled staircase between its samples, for plotting. One extra point is interleaved with
+    the samples per step, so it is O(n) and needs no sort (samples must be in chronological order).
+
+        * 'leading': each level is held until edge_time before the next sample, i.e., the step is seen at the next
+          sample (e.g., edge_time = integration period).
+        * 'trailing': each level is held until edge_time after its sample, i.e., the step is seen at the next sample.
+        * 'applied': each level is applied edge_time before its sample (e.g., edge_time = source delay + integration
+          period), and ramps to the next level in between.
+
+    :param t: sample times (s)
+    :param levels: level at each sample time
+    :param edge_time: (s)
+    :param edge: 'leading', 'trailing' or 'applied'
+    :return: times (s), levels
+    """
+    t, levels = np.asarray(t, dtype=float), np.asarray(levels)
+    n = len(t)
+    if edge == 'applied':
+        trace_t, trace_v = np.empty(2 * n), np.empty(2 * n, dtype=levels.dtype)
+        trace_t[0::2], trace_t[1::2] = t - edge_time, t
+        trace_v[0::2], trace_v[1::2] = levels, levels
+    elif edge in ['leading', 'trailing']:
+        trace_t, trace_v = np.empty(max(2 * n - 1, 0)), np.empty(max(2 * n - 1, 0), dtype=levels.dtype)
+        trace_t[0::2], trace_v[0::2] = t, levels
+        if edge == 'leading':
+            trace_t[1::2], trace_v[1::2] = t[1:] - edge_time, levels[:-1]
+        else:
+            trace_t[1::2], trace_v[1::2] = t[:-1] + edge_time, levels[1:]
+    else:
+        raise ValueError("Edge not understood. Options are: ['leading', 'trailing', 'applied'].")
+    return trace_t, trace_v